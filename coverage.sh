@@ -3,5 +3,15 @@ python-coverage run /usr/bin/trial \
     tests/test_get_new_hosts.py \
     tests/test_models.py \
     tests/test_purge_methods.py \
-    tests/test_stats.py
+    tests/test_stats.py \
+    tests/test_utils.py \
+    tests/test_cracker_index.py \
+    tests/test_cracker_cache.py \
+    tests/test_legacy.py \
+    tests/test_cache.py \
+    tests/test_resolver.py \
+    tests/test_summary.py \
+    tests/test_metrics.py \
+    tests/test_loadgen.py \
+    tests/test_database.py
 python-coverage html
@@ -0,0 +1,112 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import hashlib
+import math
+import struct
+import time
+
+class LRUCache(object):
+    """
+    Size-bounded cache that evicts the least recently used entry first.
+    Entries can optionally expire after a time to live (in seconds).
+    Not thread safe; use from the reactor thread only.
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (value, expiry time or None)
+        self._entries = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            self.misses += 1
+            return default
+        # Re-insert to mark as most recently used
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, ttl=None):
+        if self.max_size <= 0:
+            return
+        if ttl is None:
+            ttl = self.ttl
+        self._entries.pop(key, None)
+        self._entries[key] = (value, time.time() + ttl if ttl is not None else None)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def expire_within(self, seconds):
+        """ Make all entries expire within the given number of seconds """
+        limit = time.time() + seconds
+        for key, (value, expiry) in self._entries.items():
+            if expiry is None or expiry > limit:
+                self._entries[key] = (value, limit)
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+class BloomFilter(object):
+    """
+    Set of strings that may report false positives, but no false negatives.
+    Sized for capacity items at the given false positive rate; items cannot
+    be removed. Not thread safe; use from the reactor thread only.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = max(int(capacity), 1)
+        self.num_bits = int(math.ceil(-self.capacity * math.log(error_rate) / math.log(2)**2))
+        self.num_hashes = max(1, int(round(float(self.num_bits) / self.capacity * math.log(2))))
+        self.count = 0
+        self._bits = bytearray((self.num_bits + 7) // 8)
+
+    def _positions(self, key):
+        # Double hashing with two 64 bit halves of a single digest
+        h1, h2 = struct.unpack("<QQ", hashlib.md5(key).digest())
+        return [(h1 + i*h2) % self.num_bits for i in xrange(self.num_hashes)]
+
+    def add(self, key):
+        for position in self._positions(key):
+            self._bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self._bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
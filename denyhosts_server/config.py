@@ -58,45 +58,66 @@ def _getfloat(config, section, option, default=None):
         result = default
     return result
 
+# Settings in the [database] section for the sqlite backend, which are not
+# passed on to the driver
+_sqlite_options = ["wal", "read_connections", "cache_size", "mmap_size"]
+
 def read_config(filename):
     global dbtype, dbparams
+    global sqlite_wal, sqlite_read_connections, sqlite_cache_size, sqlite_mmap_size
     global maintenance_interval, expiry_days, legacy_expiry_days
+    global counter_check_interval
     global max_reported_crackers
+    global ingest_batch_size, ingest_batch_delay
+    global cracker_index_hours, cracker_cache_size
+    global new_hosts_cache_size, new_hosts_cache_ttl, new_hosts_cache_granularity
+    global geoip_cache_size, graph_processes, graph_timeout
+    global resolve_timeout, resolve_cache_size
+    global resolve_cache_ttl, resolve_negative_cache_ttl
     global logfile
     global loglevel
     global xmlrpc_listen_port
     global legacy_server
     global legacy_frequency
     global legacy_threshold, legacy_resiliency
-    global enable_debug_methods
+    global enable_debug_methods, enable_metrics
     global stats_frequency
     global stats_resolve_hostnames
     global stats_listen_port
     global static_dir, graph_dir, template_dir
     global key_file, peers
+    global update_queue_size, update_retries, update_timeout
+    global update_batch_size, update_batch_delay
 
     _config = ConfigParser.SafeConfigParser()
     _config.readfp(open(filename,'r'))
 
     dbtype = _get(_config, "database", "type", "sqlite3")
-    if dbtype not in ["sqlite3","MySQLdb"]:
+    if dbtype not in ["sqlite3","MySQLdb","psycopg2"]:
         print("Database type {} not supported, exiting".format(dbtype))
         sys.exit()
 
     dbparams = {
         key: value 
         for (key,value) in _config.items("database") 
-        if key != "type"
+        if key != "type" and key not in _sqlite_options
     }
     if dbtype=="sqlite3":
         dbparams["check_same_thread"] = False
         dbparams["detect_types"] = sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES
         dbparams["cp_max"] = 1
+        # Prepared statements cached per connection, by query text
+        dbparams["cached_statements"] = int(dbparams.get("cached_statements", 250))
         if "database" not in dbparams:
             dbparams["database"] = "/var/lib/denyhosts-server/denyhosts.sqlite"
-    elif dbtype=="MySQLdb":
+    elif dbtype in ["MySQLdb", "psycopg2"]:
         dbparams["cp_reconnect"] = True
 
+    sqlite_wal = _getboolean(_config, "database", "wal", True)
+    sqlite_read_connections = _getint(_config, "database", "read_connections", 4)
+    sqlite_cache_size = _getint(_config, "database", "cache_size", 65536)
+    sqlite_mmap_size = _getint(_config, "database", "mmap_size", 268435456)
+
     if "cp_max" in dbparams:
         dbparams["cp_max"] = int(dbparams["cp_max"])
     if "cp_min" in dbparams:
@@ -111,14 +132,23 @@ def read_config(filename):
     maintenance_interval = _getint(_config, "maintenance", "interval_seconds", 3600)
     expiry_days = _getfloat(_config, "maintenance", "expiry_days", 30)
     legacy_expiry_days = _getfloat(_config, "maintenance", "legacy_expiry_days", 30)
+    counter_check_interval = _getint(_config, "maintenance", "counter_check_interval", 86400)
 
     max_reported_crackers = _getint(_config, "sync", "max_reported_crackers", 50)
     xmlrpc_listen_port = _getint(_config, "sync", "listen_port", 9911)
     enable_debug_methods = _getboolean(_config, "sync", "enable_debug_methods", False)
+    enable_metrics = _getboolean(_config, "sync", "enable_metrics", True)
     legacy_server = _get(_config, "sync", "legacy_server", None)
     legacy_frequency = _getint(_config, "sync", "legacy_frequency", 300)
     legacy_threshold = _getint(_config, "sync", "legacy_threshold", 10)
     legacy_resiliency = _getint(_config, "sync", "legacy_resiliency", 10800)
+    ingest_batch_size = _getint(_config, "sync", "ingest_batch_size", 500)
+    ingest_batch_delay = _getfloat(_config, "sync", "ingest_batch_delay", 0.05)
+    cracker_index_hours = _getfloat(_config, "sync", "cracker_index_hours", 0)
+    cracker_cache_size = _getint(_config, "sync", "cracker_cache_size", 10000)
+    new_hosts_cache_size = _getint(_config, "sync", "new_hosts_cache_size", 0)
+    new_hosts_cache_ttl = _getint(_config, "sync", "new_hosts_cache_ttl", 60)
+    new_hosts_cache_granularity = _getint(_config, "sync", "new_hosts_cache_granularity", 60)
 
     logfile = _get(_config, "logging", "logfile", "/var/log/denyhosts-server/denyhosts-server.log")
     loglevel = _get(_config, "logging", "loglevel", "INFO")
@@ -140,9 +170,21 @@ def read_config(filename):
     graph_dir = _get(_config, "stats", "graph_dir", os.path.join(static_dir, "graph"))
     template_dir = _get(_config, "stats", "template_dir", os.path.join(package_dir, "template"))
     stats_resolve_hostnames = _getboolean(_config, "stats", "resolve_hostnames", True)
+    resolve_timeout = _getfloat(_config, "stats", "resolve_timeout", 5)
+    resolve_cache_size = _getint(_config, "stats", "resolve_cache_size", 1000)
+    resolve_cache_ttl = _getint(_config, "stats", "resolve_cache_ttl", 86400)
+    resolve_negative_cache_ttl = _getint(_config, "stats", "resolve_negative_cache_ttl", 3600)
     stats_listen_port = _getint(_config, "stats", "listen_port", 9911)
+    geoip_cache_size = _getint(_config, "stats", "geoip_cache_size", 10000)
+    graph_processes = _getint(_config, "stats", "graph_processes", 1)
+    graph_timeout = _getfloat(_config, "stats", "graph_timeout", 300)
 
     key_file = _get(_config, "peering", "key_file", os.path.join(package_dir, "private.key"))
+    update_queue_size = _getint(_config, "peering", "update_queue_size", 10000)
+    update_retries = _getint(_config, "peering", "update_retries", 3)
+    update_timeout = _getfloat(_config, "peering", "update_timeout", 30)
+    update_batch_size = _getint(_config, "peering", "update_batch_size", 100)
+    update_batch_delay = _getfloat(_config, "peering", "update_batch_delay", 1.0)
 
     peers = {}
     for item in _config.items("peering"):
@@ -14,41 +14,284 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import datetime
 import logging
 import time
-import xmlrpclib
 
+from twisted.internet import defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.threads  import deferToThread
+from twisted.python import failure
+from twistar.registry import Registry
 
+import cache
 import config
+import cracker_cache
+import cracker_index
 import database
+import geo
+import metrics
 import models
-from models import Cracker, Report, Legacy
+from models import Cracker, Report
+import stats
+import summary
 import utils
 
 def get_cracker(ip_address):
-    return Cracker.find(where=["ip_address=?",ip_address], limit=1)
+    return Cracker.find(where=["ip_address=?", database.ip_param(ip_address)], limit=1)
+
+def check_report_source(client_ip, timestamp):
+    """ Check the address of a reporting client and the time of its report.
+    Returns the canonical form of client_ip. Raises ValueError when either
+    cannot be stored """
+    client_ip = utils.normalize_ip(client_ip)
+    if isinstance(timestamp, bool) or not isinstance(timestamp, (int, long, float)):
+        raise ValueError("Illegal timestamp {!r}".format(timestamp))
+    try:
+        datetime.date.fromtimestamp(timestamp)
+    except (ValueError, OverflowError, OSError):
+        raise ValueError("Illegal timestamp {!r}".format(timestamp))
+    return client_ip
 
-@inlineCallbacks
 def handle_report_from_client(client_ip, timestamp, hosts):
-    for cracker_ip in hosts:
-        if not utils.is_valid_ip_address(cracker_ip):
-            logging.warning("Illegal host ip address {} from {}".format(cracker_ip, client_ip))
-            raise Exception("Illegal IP address \"{}\".".format(cracker_ip))
+    """ Validate and queue the hosts reported by a client. Returns a Deferred
+    that fires once the reports have been stored in the database """
+    try:
+        client_ip = check_report_source(client_ip, timestamp)
+    except ValueError, e:
+        logging.warning("Illegal report from client {!r}: {}".format(client_ip, e))
+        return defer.fail(Exception("Illegal report: {}".format(e)))
+
+    invalid = utils.split_valid_ip_addresses(hosts)[1]
+    if len(invalid) > 0:
+        logging.warning("Illegal host ip address {} from {}".format(invalid[0], client_ip))
+        return defer.fail(Exception("Illegal IP address \"{}\".".format(invalid[0])))
+
+    logging.debug("Adding reports for {} from {}".format(hosts, client_ip))
+    return queue_reports([(client_ip, timestamp, hosts)])
+
+# Report ingestion. Reports are collected in a queue and stored in the
+# database in a single transaction, when config.ingest_batch_size hosts are
+# waiting or config.ingest_batch_delay seconds after the first report was
+# queued, whichever comes first.
+_report_queue = []
+_report_queue_size = 0
+_report_flush_call = None
+
+def queue_reports(records):
+    """ Queue a list of (client_ip, timestamp, hosts) records for storage.
+    Returns a Deferred that fires once they have been committed to the
+    database """
+    global _report_queue_size, _report_flush_call
+
+    d = defer.Deferred()
+    _report_queue.append((records, d))
+    _report_queue_size += sum(len(hosts) for (client_ip, timestamp, hosts) in records)
+
+    if (_report_queue_size >= config.ingest_batch_size
+            or config.ingest_batch_delay <= 0):
+        flush_reports()
+    elif _report_flush_call is None:
+        _report_flush_call = reactor.callLater(config.ingest_batch_delay, flush_reports)
+    return d
+
+def flush_reports():
+    """ Store all queued reports now. Returns a Deferred that fires when done """
+    global _report_queue, _report_queue_size, _report_flush_call
+
+    if _report_flush_call is not None and _report_flush_call.active():
+        _report_flush_call.cancel()
+    _report_flush_call = None
+
+    queue = _report_queue
+    _report_queue = []
+    _report_queue_size = 0
+    if len(queue) == 0:
+        return defer.succeed(0)
+
+    reports = [
+        (client_ip, timestamp, cracker_ip)
+        for (records, d) in queue
+        for (client_ip, timestamp, hosts) in records
+        for cracker_ip in hosts
+    ]
+
+    def done(result):
+        age_new_hosts_cache()
+        for (records, d) in queue:
+            d.callback(0)
+        return 0
+
+    def failed(failure):
+        logging.warning("Error storing {} reports: {}".format(len(reports), failure.getErrorMessage()))
+        for (records, d) in queue:
+            d.errback(failure)
+        return 0
+
+    return _store_reports(reports).addCallbacks(done, failed)
 
-        logging.debug("Adding report for {} from {}".format(cracker_ip, client_ip))
-        yield utils.wait_and_lock_host(cracker_ip)
+@inlineCallbacks
+def _store_reports(reports):
+    # Addresses are compared in the form they are read back from the database
+    reports = [(utils.normalize_ip(client_ip), timestamp, utils.normalize_ip(cracker_ip))
+        for (client_ip, timestamp, cracker_ip) in reports]
+    # Lock in sorted order, so concurrent batches cannot deadlock
+    hosts = sorted(set(cracker_ip for (client_ip, timestamp, cracker_ip) in reports))
+    for host in hosts:
+        yield utils.wait_and_lock_host(host)
+    try:
+        logging.debug("Storing {} reports for {} hosts".format(len(reports), len(hosts)))
+        cached, new = cracker_cache.lookup(hosts)
         try:
-            cracker = yield Cracker.find(where=['ip_address=?', cracker_ip], limit=1)
-            if cracker is None:
-                cracker = Cracker(ip_address=cracker_ip, first_time=timestamp,
-                    latest_time=timestamp, resiliency=0, total_reports=0, current_reports=0)
-                yield cracker.save()
-            yield add_report_to_cracker(cracker, client_ip, when=timestamp)
-        finally:
-            utils.unlock_host(cracker_ip)
-        logging.debug("Done adding report for {} from {}".format(cracker_ip,client_ip))
+            fetched, crackers = yield Registry.DBPOOL.runInteraction(_store_reports_txn,
+                reports, cached, new)
+        except cracker_cache.StaleEntry:
+            logging.info("Cracker cache out of date, storing {} reports again".format(len(reports)))
+            metrics.cracker_cache_stale.inc()
+            cracker_cache.invalidate(hosts)
+            fetched, crackers = yield Registry.DBPOOL.runInteraction(_store_reports_txn,
+                reports, {}, set())
+        cracker_index.update(fetched)
+        cracker_cache.update(crackers)
+    finally:
+        for host in hosts:
+            utils.unlock_host(host)
+
+database.register_query("store_reports.select_crackers", """
+    SELECT id, ip_address, first_time, total_reports, current_reports
+    FROM crackers WHERE ip_address IN ({})""")
+database.register_query("store_reports.insert_crackers", lambda: database.insert_ignore("crackers") + """
+    (ip_address, first_time, latest_time, resiliency,
+        total_reports, current_reports, country_code)
+    VALUES (?,?,?,?,?,?,?)""")
+database.register_query("store_reports.select_cracker_ids",
+    "SELECT id, ip_address FROM crackers WHERE ip_address IN ({})")
+database.register_query("store_reports.select_reports", """
+    SELECT id, cracker_id, ip_address, first_report_time, latest_report_time
+    FROM reports
+    WHERE cracker_id IN ({}) AND ip_address IN ({{}})""")
+database.register_query("store_reports.insert_reports", """
+    INSERT INTO reports (cracker_id, ip_address, first_report_time, latest_report_time)
+    VALUES (?,?,?,?)""")
+database.register_query("store_reports.update_reports",
+    "UPDATE reports SET latest_report_time=? WHERE id=?")
+database.register_query("store_reports.update_crackers", """
+    UPDATE crackers
+    SET latest_time=?, resiliency=?, total_reports=?, current_reports=?
+    WHERE id=? AND total_reports=?""")
+
+def _store_reports_txn(txn, reports, cached, new):
+    """ Store reports, a list of (client ip, timestamp, cracker ip) tuples.
+    cached and new are the hints from cracker_cache.lookup(); raises
+    cracker_cache.StaleEntry if they turn out to be wrong """
+    # Existing crackers
+    hosts = list(set(cracker_ip for (client_ip, timestamp, cracker_ip) in reports))
+    crackers = cached
+    for row in database.select_in(txn, "store_reports.select_crackers",
+            [database.ip_param(h) for h in hosts if h not in cached and h not in new]):
+        crackers[database.ip_value(row[1])] = {
+            "id": row[0], "first_time": row[2],
+            "total_reports": row[3], "current_reports": row[4]
+        }
+    for cracker in crackers.itervalues():
+        cracker["stored_total"] = cracker["total_reports"]
+
+    # Insert new crackers with the time of their first report in this batch
+    new_crackers = []
+    for (client_ip, timestamp, cracker_ip) in reports:
+        if cracker_ip not in crackers:
+            crackers[cracker_ip] = {
+                "id": None, "first_time": timestamp,
+                "total_reports": 0, "current_reports": 0, "stored_total": 0
+            }
+            new_crackers.append((database.ip_param(cracker_ip), timestamp, timestamp, 0, 0, 0,
+                geo.country_code(cracker_ip)))
+    if len(new_crackers) > 0:
+        database.executemany(txn, "store_reports.insert_crackers", new_crackers)
+        if txn.rowcount != len(new_crackers):
+            raise cracker_cache.StaleEntry("New crackers already in database")
+        for row in database.select_in(txn, "store_reports.select_cracker_ids",
+                [c[0] for c in new_crackers]):
+            crackers[database.ip_value(row[1])]["id"] = row[0]
+
+    # Existing reports by these clients for these crackers, by (cracker_id, client_ip)
+    cracker_ids = list(set(crackers[h]["id"] for h in hosts))
+    client_ips = list(set(client_ip for (client_ip, timestamp, cracker_ip) in reports))
+    existing = {}
+    for ids in database.chunks(cracker_ids, database.max_in_params):
+        query, ids = database.expand_in("store_reports.select_reports", ids)
+        for row in database.select_in(txn, query,
+                [database.ip_param(ip) for ip in client_ips], *ids):
+            existing.setdefault((row[1], database.ip_value(row[2])), []).append(
+                {"id": row[0], "first": row[3], "latest": row[4]})
+    for key in existing:
+        existing[key].sort(key=lambda r: r["latest"])
+
+    # Apply the report merging rules of add_report_to_cracker() in order of arrival
+    new_reports = []
+    # For the daily counters: (date, cracker id, client ip, new_report)
+    # for every added or updated report
+    activity = []
+    for (client_ip, when, cracker_ip) in reports:
+        cracker = crackers[cracker_ip]
+        key = (cracker["id"], client_ip)
+        cracker_reports = existing.setdefault(key, [])
+        if len(cracker_reports) == 0:
+            cracker["current_reports"] += 1
+        if len(cracker_reports) < 3:
+            # Add second and third report after 24 hours
+            if (len(cracker_reports) == 0 or
+                    when > cracker_reports[-1]["latest"] + 24*3600):
+                report = {"id": None, "first": when, "latest": when, "key": key}
+                cracker_reports.append(report)
+                new_reports.append(report)
+                activity.append((datetime.date.fromtimestamp(when), key[0], client_ip, True))
+        else:
+            latest_report = cracker_reports[-1]
+            # A report is active on the days of its first and latest times
+            date = datetime.date.fromtimestamp(when)
+            activity.append((date, key[0], client_ip,
+                date != datetime.date.fromtimestamp(latest_report["first"]) and
+                date != datetime.date.fromtimestamp(latest_report["latest"])))
+            latest_report["latest"] = when
+            cracker_reports.sort(key=lambda r: r["latest"])
+            if latest_report["id"] is not None:
+                latest_report["dirty"] = True
+
+        cracker["total_reports"] += 1
+        cracker["latest_time"] = when
+        cracker["resiliency"] = when - cracker["first_time"]
+
+    if len(new_reports) > 0:
+        database.executemany(txn, "store_reports.insert_reports",
+            [(r["key"][0], database.ip_param(r["key"][1]), r["first"], r["latest"])
+                for r in new_reports])
+
+    report_updates = [
+        (r["latest"], r["id"])
+        for cracker_reports in existing.itervalues()
+        for r in cracker_reports
+        if r.get("dirty")
+    ]
+    if len(report_updates) > 0:
+        database.executemany(txn, "store_reports.update_reports", report_updates)
+
+    database.executemany(txn, "store_reports.update_crackers",
+        [(c["latest_time"], c["resiliency"], c["total_reports"], c["current_reports"],
+            c["id"], c["stored_total"])
+            for c in crackers.itervalues()])
+    if txn.rowcount != len(crackers):
+        raise cracker_cache.StaleEntry("Crackers changed or removed")
+
+    stats.add_daily_activity_txn(txn, activity)
+
+    reporters = {}
+    for r in new_reports:
+        reporters[r["key"][1]] = reporters.get(r["key"][1], 0) + 1
+    summary.update_txn(txn, num_hosts=len(new_crackers), num_reports=len(new_reports),
+        reporters=reporters)
+
+    return (cracker_index.fetch_txn(txn, cracker_ids), crackers)
 
 # Note: lock cracker IP first!
 # Report merging algorithm by Anne Bezemer, see 
@@ -59,7 +302,7 @@ def add_report_to_cracker(cracker, client_ip, when=None):
         when = time.time()
 
     reports = yield Report.find(
-        where=["cracker_id=? AND ip_address=?", cracker.id, client_ip], 
+        where=["cracker_id=? AND ip_address=?", cracker.id, database.ip_param(client_ip)],
         orderby='latest_report_time ASC'
     )
     if len(reports) == 0:
@@ -91,81 +334,276 @@ def add_report_to_cracker(cracker, client_ip, when=None):
     cracker.resiliency = when - cracker.first_time
 
     yield cracker.save()
+    cracker_cache.invalidate([cracker.ip_address])
+
+# Number of candidate crackers for which the reports are fetched in a single
+# query. Keep this well below the maximum number of host parameters sqlite
+# allows in a single statement (999)
+_qualifying_batch_size = 200
+
+database.register_query("get_new_hosts.select_reports", """
+    SELECT cracker_id, first_report_time, latest_report_time
+    FROM reports
+    WHERE cracker_id IN ({})
+    ORDER BY cracker_id, first_report_time ASC""")
+database.register_query("get_new_hosts.select_candidates", """
+    SELECT DISTINCT c.id, c.ip_address, c.first_time
+    FROM crackers c
+    WHERE (c.current_reports >= ?)
+        AND (c.resiliency >= ?)
+        AND (c.latest_time >= ?)
+    ORDER BY c.first_time DESC""")
+
+def get_reports_for_crackers(cracker_ids):
+    """ Fetch the (first_report_time, latest_report_time) pairs of all reports
+    for a list of crackers in a single query. Returns a Deferred firing with a
+    dict mapping cracker id to the list of its reports, sorted by
+    first_report_time """
+    def collect(rows):
+        result = {}
+        for cracker_id, first_report_time, latest_report_time in rows or []:
+            result.setdefault(cracker_id, []).append(
+                (first_report_time, latest_report_time))
+        return result
+
+    query, cracker_ids = database.expand_in("get_new_hosts.select_reports", cracker_ids)
+    return database.run_read_query(query, *cracker_ids).addCallback(collect)
+
+def cracker_qualifies(first_time, reports, min_reports, min_resilience, previous_timestamp):
+    """ Check conditions (c) and (d) of the synchronisation algorithm for a
+    single cracker. reports is a list of (first_report_time,
+    latest_report_time) tuples, sorted by first_report_time """
+    if (len(reports)>=max(min_reports, 1) and
+        reports[min_reports-1][0] >= previous_timestamp):
+        # condition (c) satisfied
+        return True
+
+    # Condition (d): at least one report after previous_timestamp that
+    # satisfies the resiliency (d1), but none before (d2)
+    satisfied = False
+    for first_report_time, latest_report_time in reports:
+        if latest_report_time-first_time < min_resilience:
+            continue
+        if latest_report_time <= previous_timestamp:
+            # d2 failed
+            return False
+        satisfied = True
+    return satisfied
+
+def _qualifying_from_index(min_reports, min_resilience, previous_timestamp,
+        max_crackers, latest_added_hosts):
+    result = []
+    for cracker_id, ip_address, first_time, reports in cracker_index.find_candidates(
+            min_reports, min_resilience, previous_timestamp):
+        if ip_address in latest_added_hosts:
+            continue
+        if cracker_qualifies(first_time, reports,
+                min_reports, min_resilience, previous_timestamp):
+            result.append(ip_address)
+            if len(result)>=max_crackers:
+                break
+    return result
 
 @inlineCallbacks
-def get_qualifying_crackers(min_reports, min_resilience, previous_timestamp,
+def _qualifying_from_database(min_reports, min_resilience, previous_timestamp,
         max_crackers, latest_added_hosts):
-    # Thank to Anne Bezemer for the algorithm in this function. 
-    # See https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=622697
-   
     # This query takes care of conditions (a) and (b)
     # cracker_ids = yield database.runGetPossibleQualifyingCrackerQuery(min_reports, min_resilience, previous_timestamp)
-    cracker_ids = yield database.run_query("""
-            SELECT DISTINCT c.id, c.ip_address 
-            FROM crackers c 
-            WHERE (c.current_reports >= ?)
-                AND (c.resiliency >= ?)
-                AND (c.latest_time >= ?)
-            ORDER BY c.first_time DESC
-            """, min_reports, min_resilience, previous_timestamp)
+    cracker_ids = yield database.run_read_query("get_new_hosts.select_candidates",
+        min_reports, min_resilience, previous_timestamp)
   
     if cracker_ids is None:
         returnValue([])
 
-    # Now look for conditions (c) and (d)
-    result = []
-    for c in cracker_ids:
-        cracker_id = c[0]
-        if c[1] in latest_added_hosts:
-            logging.debug("Skipping {}, just reported by client".format(c[1]))
-            continue
-        cracker = yield Cracker.find(cracker_id)
-        if cracker is None:
+    candidates = []
+    for (cracker_id, ip_address, first_time) in cracker_ids:
+        ip_address = database.ip_value(ip_address)
+        if ip_address in latest_added_hosts:
+            logging.debug("Skipping {}, just reported by client".format(ip_address))
             continue
-        logging.debug("Examining cracker:")
-        logging.debug(cracker)
-        reports = yield cracker.reports.get(orderby="first_report_time ASC")
-        #logging.debug("reports:")
-        #for r in reports:
-        #    logging.debug("    "+str(r))
-        logging.debug("r[m-1].first, prev: {}, {}".format(reports[min_reports-1].first_report_time, previous_timestamp))
-        if (len(reports)>=min_reports and 
-            reports[min_reports-1].first_report_time >= previous_timestamp): 
-            # condition (c) satisfied
-            logging.debug("c")
-            result.append(cracker.ip_address)
-        else:
-            logging.debug("checking (d)...")
-            satisfied = False
-            for report in reports:
-                #logging.debug("    "+str(report))
-                if (not satisfied and 
-                    report.latest_report_time>=previous_timestamp and
-                    report.latest_report_time-cracker.first_time>=min_resilience):
-                    logging.debug("    d1")
-                    satisfied = True
-                if (report.latest_report_time<=previous_timestamp and 
-                    report.latest_report_time-cracker.first_time>=min_resilience):
-                    logging.debug("    d2 failed")
-                    satisfied = False
+        candidates.append((cracker_id, ip_address, first_time))
+
+    # Now look for conditions (c) and (d). Fetch the reports for a batch of
+    # candidates at a time, so we can stop early once we have enough hosts
+    result = []
+    for start in xrange(0, len(candidates), _qualifying_batch_size):
+        batch = candidates[start:start+_qualifying_batch_size]
+        reports = yield get_reports_for_crackers([c[0] for c in batch])
+        for cracker_id, ip_address, first_time in batch:
+            if cracker_qualifies(first_time, reports.get(cracker_id, []),
+                    min_reports, min_resilience, previous_timestamp):
+                logging.debug("Appending {}".format(ip_address))
+                result.append(ip_address)
+                if len(result)>=max_crackers:
                     break
-            if satisfied:
-                logging.debug("Appending {}".format(cracker.ip_address))
-                result.append(cracker.ip_address)
-            else:
-                logging.debug("    skipping")
         if len(result)>=max_crackers:
             break
+    returnValue(result)
+
+# Snapshot of the legacy list, which only changes when it is downloaded from
+# the legacy server or expired: the retrieved times in ascending order, and
+# the ip addresses in the same order. None if not loaded, then the legacy
+# table is queried instead
+_legacy_times = None
+_legacy_hosts = None
+# Number of snapshot loads started, so an older load that finishes late does
+# not replace a newer snapshot
+_legacy_generation = 0
+
+def _load_legacy_txn(txn):
+    database.execute(txn, """
+        SELECT ip_address, retrieved_time FROM legacy
+        WHERE retrieved_time IS NOT NULL
+        ORDER BY retrieved_time""")
+    times = []
+    hosts = []
+    for row in txn.fetchall():
+        hosts.append(database.ip_value(row[0]))
+        times.append(row[1])
+    return times, hosts
+
+@inlineCallbacks
+def load_legacy_snapshot():
+    """ Load the legacy list into memory. Called at startup and after every
+    change to the legacy table """
+    global _legacy_times, _legacy_hosts, _legacy_generation
+    _legacy_generation += 1
+    generation = _legacy_generation
+    times, hosts = yield database.run_read_interaction(_load_legacy_txn)
+    if generation == _legacy_generation:
+        _legacy_times, _legacy_hosts = times, hosts
+        logging.debug("Loaded {} legacy hosts into memory".format(len(hosts)))
+    returnValue(len(hosts))
+
+def clear_legacy_snapshot():
+    global _legacy_times, _legacy_hosts, _legacy_generation
+    _legacy_generation += 1
+    _legacy_times = None
+    _legacy_hosts = None
+
+def _legacy_from_snapshot(previous_timestamp, max_hosts):
+    """ The ip addresses of at most max_hosts legacy hosts retrieved after
+    previous_timestamp, most recent first """
+    start = max(bisect.bisect_right(_legacy_times, previous_timestamp),
+        len(_legacy_hosts) - max_hosts)
+    return _legacy_hosts[start:][::-1]
+
+database.register_query("get_new_hosts.select_legacy", """
+    SELECT ip_address FROM legacy
+    WHERE retrieved_time>?
+    ORDER BY retrieved_time DESC
+    LIMIT ?""")
+
+@inlineCallbacks
+def get_qualifying_crackers(min_reports, min_resilience, previous_timestamp,
+        max_crackers, latest_added_hosts):
+    # Thank to Anne Bezemer for the algorithm in this function. 
+    # See https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=622697
+
+    if cracker_index.covers(previous_timestamp):
+        result = _qualifying_from_index(min_reports, min_resilience,
+            previous_timestamp, max_crackers, latest_added_hosts)
+    else:
+        result = yield _qualifying_from_database(min_reports, min_resilience,
+            previous_timestamp, max_crackers, latest_added_hosts)
 
     if len(result) < max_crackers:
         # Add results from legacy server
-        extras = yield Legacy.find(where=["retrieved_time>?", previous_timestamp],
-            orderby="retrieved_time DESC", limit=max_crackers-len(result))
-        result = result + [extra.ip_address for extra in extras]
+        if _legacy_times is not None:
+            extras = _legacy_from_snapshot(previous_timestamp, max_crackers-len(result))
+        else:
+            rows = yield database.run_read_query("get_new_hosts.select_legacy",
+                previous_timestamp, max_crackers-len(result))
+            extras = [database.ip_value(row[0]) for row in rows]
+        result = result + extras
 
     logging.debug("Returning {} hosts".format(len(result)))
     returnValue(result)
 
+# Shared cache of get_new_hosts results. Most clients use the same
+# threshold and resiliency, and sync at similar times, so many requests can
+# be answered with the same list of hosts.
+_new_hosts_cache = cache.LRUCache(0)
+# Deferreds waiting for results being computed, by cache key
+_new_hosts_pending = {}
+# Number of hosts cached beyond max_reported_crackers, to allow for
+# filtering out the hosts a client has just added
+_new_hosts_cache_margin = 50
+# After the database has changed, cached results are used for at most this
+# many seconds
+_new_hosts_cache_write_ttl = 5
+
+def configure_new_hosts_cache():
+    global _new_hosts_cache
+    _new_hosts_cache = cache.LRUCache(config.new_hosts_cache_size,
+        config.new_hosts_cache_ttl)
+
+def age_new_hosts_cache():
+    _new_hosts_cache.expire_within(_new_hosts_cache_write_ttl)
+
+def get_new_hosts_cache_stats():
+    return _new_hosts_cache.stats()
+
+@inlineCallbacks
+def _compute_new_hosts(key, min_reports, min_resilience, previous_timestamp, max_crackers):
+    now = long(time.time())
+    hosts = yield get_qualifying_crackers(min_reports, min_resilience,
+        previous_timestamp, max_crackers, set())
+    entry = (now, hosts, len(hosts) < max_crackers)
+    _new_hosts_cache.put(key, entry)
+    returnValue(entry)
+
+def _notify_waiters(result, key):
+    for waiter in _new_hosts_pending.pop(key):
+        if isinstance(result, failure.Failure):
+            waiter.errback(result)
+        else:
+            waiter.callback(result)
+
+@inlineCallbacks
+def get_new_hosts(min_reports, min_resilience, previous_timestamp,
+        max_crackers, latest_added_hosts):
+    """ Like get_qualifying_crackers, but using the shared result cache if
+    enabled. Returns a (timestamp, hosts) tuple, where timestamp should be
+    used by the client in its next request.
+
+    Cached results are computed for previous_timestamp rounded down to
+    new_hosts_cache_granularity, so clients may get some hosts that they
+    already received in their previous request.
+    """
+    if _new_hosts_cache.max_size <= 0:
+        now = long(time.time())
+        hosts = yield get_qualifying_crackers(min_reports, min_resilience,
+            previous_timestamp, max_crackers, latest_added_hosts)
+        returnValue((now, hosts))
+
+    granularity = max(config.new_hosts_cache_granularity, 1)
+    bucket = previous_timestamp - previous_timestamp % granularity
+    key = (min_reports, min_resilience, bucket, max_crackers)
+    entry = _new_hosts_cache.get(key)
+    if entry is None:
+        # Concurrent requests for the same key share a single computation
+        waiter = defer.Deferred()
+        if key in _new_hosts_pending:
+            _new_hosts_pending[key].append(waiter)
+        else:
+            _new_hosts_pending[key] = [waiter]
+            _compute_new_hosts(key, min_reports, min_resilience, bucket,
+                max_crackers + _new_hosts_cache_margin).addBoth(_notify_waiters, key)
+        entry = yield waiter
+
+    computed, hosts, complete = entry
+    result = [host for host in hosts if host not in latest_added_hosts][:max_crackers]
+    if len(result) < max_crackers and not complete:
+        # Too many hosts filtered out, the cached list is not long enough
+        now = long(time.time())
+        result = yield get_qualifying_crackers(min_reports, min_resilience,
+            previous_timestamp, max_crackers, latest_added_hosts)
+        returnValue((now, result))
+
+    logging.debug("Returning {} hosts from cache".format(len(result)))
+    returnValue((computed, result))
+
 # Periodical database maintenance
 # From algorithm by Anne Bezemer, see https://bugs.debian.org/cgi-bin/bugreport.cgi?bug=622697
 # Expiry/maintenance every hour/day:
@@ -177,6 +615,54 @@ def get_qualifying_crackers(min_reports, min_resilience, previous_timestamp,
 
 # TODO remove reports by identified crackers
 
+# Check the expiry time again, the report may have been updated since it
+# was selected
+database.register_query("expire.count_reporters", """
+    SELECT ip_address, COUNT(*) FROM reports
+    WHERE id IN ({}) AND latest_report_time<?
+    GROUP BY ip_address""")
+database.register_query("expire.delete_reports",
+    "DELETE FROM reports WHERE id IN ({}) AND latest_report_time<?")
+database.register_query("expire.update_crackers", """
+    UPDATE crackers
+    SET current_reports = (
+        SELECT COUNT(DISTINCT ip_address) FROM reports
+        WHERE reports.cracker_id = crackers.id
+    )
+    WHERE id IN ({})""")
+database.register_query("expire.delete_crackers",
+    "DELETE FROM crackers WHERE id IN ({}) AND current_reports=0")
+database.register_query("expire.select_reports", """
+    SELECT r.id, r.cracker_id, c.ip_address
+    FROM reports r LEFT JOIN crackers c ON r.cracker_id = c.id
+    WHERE r.latest_report_time<?
+    LIMIT ?""")
+
+def _expire_reports_txn(txn, report_ids, cracker_ids, limit):
+    reports_deleted = 0
+    reporters = {}
+    for chunk in database.chunks(report_ids, database.max_in_params):
+        query, values = database.expand_in("expire.count_reporters", chunk)
+        database.execute(txn, query, values + (limit,))
+        for ip_address, count in txn.fetchall():
+            ip_address = database.ip_value(ip_address)
+            reporters[ip_address] = reporters.get(ip_address, 0) - count
+        query, values = database.expand_in("expire.delete_reports", chunk)
+        database.execute(txn, query, values + (limit,))
+        reports_deleted += txn.rowcount
+
+    crackers_deleted = 0
+    for chunk in database.chunks(cracker_ids, database.max_in_params):
+        database.execute(txn, *database.expand_in("expire.update_crackers", chunk))
+        database.execute(txn, *database.expand_in("expire.delete_crackers", chunk))
+        crackers_deleted += txn.rowcount
+
+    summary.update_txn(txn, num_hosts=-crackers_deleted, num_reports=-reports_deleted,
+        reporters=reporters)
+
+    return (reports_deleted, crackers_deleted, cracker_index.fetch_txn(txn, cracker_ids))
+
+@metrics.timed_job("maintenance")
 @inlineCallbacks
 def perform_maintenance(limit = None, legacy_limit = None):
     logging.info("Starting maintenance job...")
@@ -196,99 +682,150 @@ def perform_maintenance(limit = None, legacy_limit = None):
     batch_size = 1000
   
     while True:
-        old_reports = yield Report.find(where=["latest_report_time<?", limit], limit=batch_size)
+        old_reports = yield database.run_query("expire.select_reports", limit, batch_size)
         if len(old_reports) == 0:
             break
         logging.debug("Removing batch of {} old reports".format(len(old_reports)))
-        for report in old_reports:
-            cracker = yield report.cracker.get()
-            yield utils.wait_and_lock_host(cracker.ip_address)
-            try:
-                logging.debug("Maintenance: removing report from {} for cracker {}".format(report.ip_address, cracker.ip_address))
-                yield report.cracker.clear()
-                yield report.delete()
-                reports_deleted += 1
-
-                current_reports = yield cracker.reports.get(group='ip_address')
-                cracker.current_reports = len(current_reports)
-                yield cracker.save()
-
-                if cracker.current_reports == 0:
-                    logging.debug("Maintenance: removing cracker {}".format(cracker.ip_address))
-                    yield cracker.delete()
-                    crackers_deleted += 1
-            finally:
-                utils.unlock_host(cracker.ip_address)
-            logging.debug("Maintenance on report from {} for cracker {} done".format(report.ip_address, cracker.ip_address))
-
-    legacy_reports = yield Legacy.find(where=["retrieved_time<?", legacy_limit])
-    if legacy_reports is not None:
-        for legacy in legacy_reports:
-            yield legacy.delete()
-            legacy_deleted += 1
+
+        report_ids = [row[0] for row in old_reports]
+        cracker_ids = list(set(row[1] for row in old_reports))
+        hosts = sorted(set(database.ip_value(row[2]) for row in old_reports if row[2] is not None))
+        for host in hosts:
+            yield utils.wait_and_lock_host(host)
+        try:
+            deleted = yield Registry.DBPOOL.runInteraction(_expire_reports_txn,
+                report_ids, cracker_ids, limit)
+            cracker_index.update(deleted[2])
+            cracker_cache.invalidate(hosts, removed=deleted[1])
+        finally:
+            for host in hosts:
+                utils.unlock_host(host)
+        reports_deleted += deleted[0]
+        crackers_deleted += deleted[1]
+
+    cracker_index.prune()
+    yield cracker_cache.maintain()
+    age_new_hosts_cache()
+
+    yield Registry.DBPOOL.runInteraction(stats.prune_daily_activity_txn)
+
+    if summary.recount_due():
+        yield summary.recount()
+
+    legacy_deleted = yield Registry.DBPOOL.runInteraction(_expire_legacy_txn, legacy_limit)
+    if legacy_deleted > 0 and _legacy_times is not None:
+        yield load_legacy_snapshot()
 
     logging.info("Done maintenance job")
     logging.info("Expired {} reports and {} hosts, plus {} hosts from the legacy list".format(reports_deleted, crackers_deleted, legacy_deleted))
+    metrics.job_items.inc(reports_deleted, job="maintenance", item="reports")
+    metrics.job_items.inc(crackers_deleted, job="maintenance", item="hosts")
+    metrics.job_items.inc(legacy_deleted, job="maintenance", item="legacy_hosts")
     returnValue(0)
 
+database.register_query("expire.delete_legacy",
+    "DELETE FROM legacy WHERE retrieved_time<?")
+
+def _expire_legacy_txn(txn, legacy_limit):
+    database.execute(txn, "expire.delete_legacy", (legacy_limit,))
+    return txn.rowcount
+
+database.register_query("legacy_sync.update_time",
+    "UPDATE info SET `value`=? WHERE `key`='last_legacy_sync'")
+
+def _store_legacy_hosts_txn(txn, hosts, now, last_legacy_sync_time):
+    database.set_rows(txn, "legacy", ["ip_address", "retrieved_time"],
+        [(database.ip_param(host), now) for host in hosts], keys=["ip_address"])
+    database.execute(txn, "legacy_sync.update_time", (str(last_legacy_sync_time),))
+
+@metrics.timed_job("legacy_sync")
 @inlineCallbacks
 def download_from_legacy_server():
     if config.legacy_server is None or config.legacy_server == "":
         returnValue(0)
 
     logging.info("Downloading hosts from legacy server...")
-    rows = yield database.run_query('SELECT `value` FROM info WHERE `key`="last_legacy_sync"')
+    rows = yield database.run_query("SELECT `value` FROM info WHERE `key`='last_legacy_sync'")
     last_legacy_sync_time = int(rows[0][0])
 
     try:
-        server = yield deferToThread(xmlrpclib.ServerProxy, config.legacy_server)
-
-        response = yield deferToThread(server.get_new_hosts, 
+        response = yield utils.xmlrpc_call(config.legacy_server, "get_new_hosts",
             last_legacy_sync_time, config.legacy_threshold, [],
             config.legacy_resiliency)
         try:
             last_legacy_sync_time = int(response["timestamp"])
         except:
-            logging.ERROR("Illegal timestamp {} from legacy server".format(response["timestamp"]))
-        #Registry.DBPOOL.runOperation('UPDATE info SET `value`=%s WHERE `key`="last_legacy_sync"', (str(last_legacy_sync_time),))
-        database.run_operation('UPDATE info SET `value`=? WHERE `key`="last_legacy_sync"', str(last_legacy_sync_time))
+            logging.error("Illegal timestamp {} from legacy server".format(response["timestamp"]))
         now = time.time()
         logging.debug("Got {} hosts from legacy server".format(len(response["hosts"])))
-        for host in response["hosts"]:
-            legacy = yield Legacy.find(where=["ip_address=?",host], limit=1)
-            if legacy is None:
-                logging.debug("New host from legacy server: {}".format(host))
-                legacy = Legacy(ip_address=host, retrieved_time=now)
-            else:
-                logging.debug("Known host from legacy server: {}".format(host))
-                legacy.retrieved_time = now
-            yield legacy.save()
+        metrics.job_items.inc(len(response["hosts"]), job="legacy_sync", item="hosts")
+        valid, invalid = utils.split_valid_ip_addresses(response["hosts"])
+        for host in invalid:
+            logging.warning("Illegal host ip address {} from legacy server".format(host))
+        hosts = sorted(set(utils.normalize_ip(host) for host in valid))
+        yield Registry.DBPOOL.runInteraction(_store_legacy_hosts_txn,
+            hosts, now, last_legacy_sync_time)
+        if _legacy_times is not None:
+            yield load_legacy_snapshot()
     except Exception, e:
         logging.error("Error retrieving info from legacy server: {}".format(e))
 
+    age_new_hosts_cache()
     logging.info("Done downloading hosts from legacy server.")
     returnValue(0)
 
 @inlineCallbacks
 def purge_legacy_addresses():
     yield database.run_truncate_query('legacy')
-    yield database.run_query('UPDATE info SET `value`=0 WHERE `key`="last_legacy_sync"')
+    yield database.run_operation("UPDATE info SET `value`=0 WHERE `key`='last_legacy_sync'")
+    if _legacy_times is not None:
+        yield load_legacy_snapshot()
+    _new_hosts_cache.clear()
     returnValue(0)
 
 @inlineCallbacks
 def purge_reported_addresses():
     yield database.run_truncate_query('crackers')
     yield database.run_truncate_query('reports')
+    yield summary.recount()
+    if cracker_index.is_loaded():
+        cracker_index.clear()
+        yield cracker_index.configure()
+    if cracker_cache.is_enabled():
+        cracker_cache.clear()
+        yield cracker_cache.configure()
+    _new_hosts_cache.clear()
     returnValue(0)
 
-@inlineCallbacks
-def purge_ip(ip):
-    yield database.run_query("""DELETE FROM reports
+def _purge_ip_txn(txn, ip):
+    ip = database.ip_param(ip)
+    txn.execute(database.translate_query("""
+        SELECT r.ip_address, COUNT(*)
+        FROM reports r JOIN crackers c ON r.cracker_id = c.id
+        WHERE c.ip_address=?
+        GROUP BY r.ip_address"""), (ip,))
+    reporters = { database.ip_value(row[0]): -row[1] for row in txn.fetchall() }
+    txn.execute(database.translate_query("""DELETE FROM reports
         WHERE cracker_id IN (
             SELECT id FROM crackers WHERE ip_address=?
-            )""", ip)
-    yield database.run_query("DELETE FROM crackers WHERE ip_address=?", ip)
-    yield database.run_query("DELETE FROM legacy WHERE ip_address=?", ip)
+            )"""), (ip,))
+    reports_deleted = txn.rowcount
+    txn.execute(database.translate_query("DELETE FROM crackers WHERE ip_address=?"), (ip,))
+    crackers_deleted = txn.rowcount
+    summary.update_txn(txn, num_hosts=-crackers_deleted, num_reports=-reports_deleted,
+        reporters=reporters)
+    return crackers_deleted
+
+@inlineCallbacks
+def purge_ip(ip):
+    ip = utils.normalize_ip(ip)
+    removed = yield Registry.DBPOOL.runInteraction(_purge_ip_txn, ip)
+    cracker_index.remove_ip(ip)
+    cracker_cache.invalidate([ip], removed=removed)
+    yield database.run_operation("DELETE FROM legacy WHERE ip_address=?", database.ip_param(ip))
+    if _legacy_times is not None:
+        yield load_legacy_snapshot()
+    _new_hosts_cache.clear()
     returnValue(0)
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,166 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cache of crackers, so reports can be stored without looking up their
+# crackers first. Most reports are about a small set of very active
+# crackers: an LRU cache maps their ip addresses to their id and the
+# counters that storing a report updates. A Bloom filter holds the
+# addresses of all crackers in the database, so addresses that were never
+# reported before are inserted without looking them up.
+#
+# Both are hints only. Storing reports checks that every cached cracker
+# still has the total_reports it was cached with, and that every new
+# cracker was really inserted, and stores the reports again without the
+# cache if not (see controllers._store_reports). Crackers changed by other
+# means are invalidated, so this rarely happens.
+
+import logging
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import cache
+import config
+import database
+import metrics
+
+# Minimum number of addresses the filter is sized for
+_min_filter_capacity = 100000
+
+# ip address -> dict with id, first_time, total_reports and current_reports
+_crackers = cache.LRUCache(0)
+# Addresses of all crackers in the database. None if not loaded
+_filter = None
+# Addresses added while the filter is being loaded. None if not loading
+_loading = None
+# Number of crackers removed from the database since the filter was loaded
+_removed = 0
+
+class StaleEntry(Exception):
+    """ Raised when storing reports finds that the cache did not match the
+    database """
+
+def is_enabled():
+    return _crackers.max_size > 0
+
+def configure():
+    """ Set up or clear the cache, depending on the configuration """
+    global _crackers
+    if config.cracker_cache_size <= 0:
+        clear()
+    elif config.cracker_cache_size != _crackers.max_size:
+        _crackers = cache.LRUCache(config.cracker_cache_size)
+    if is_enabled() and _filter is None:
+        return load_filter()
+    return defer.succeed(0)
+
+def clear():
+    global _crackers, _filter, _removed
+    _crackers = cache.LRUCache(0)
+    _filter = None
+    _removed = 0
+
+def _build_filter_txn(txn):
+    database.execute(txn, "SELECT COUNT(*) FROM crackers")
+    count = txn.fetchone()[0]
+    bloom = cache.BloomFilter(max(2*count, _min_filter_capacity))
+    database.execute(txn, "SELECT ip_address FROM crackers")
+    while True:
+        rows = txn.fetchmany(10000)
+        if len(rows) == 0:
+            break
+        for row in rows:
+            bloom.add(database.ip_value(row[0]))
+    return bloom
+
+@inlineCallbacks
+def load_filter():
+    """ Fill the filter with the addresses of all crackers in the database """
+    global _filter, _loading, _removed
+    if _loading is not None:
+        returnValue(0)
+    logging.info("Loading cracker addresses into memory...")
+    _loading = []
+    try:
+        bloom = yield database.run_read_interaction(_build_filter_txn)
+    finally:
+        added, _loading = _loading, None
+    for ip_address in added:
+        bloom.add(ip_address)
+    _filter = bloom
+    _removed = 0
+    logging.info("Loaded {} cracker addresses into memory".format(bloom.count))
+    returnValue(bloom.count)
+
+def maintain():
+    """ Load the filter again when it has become too full, or too many of
+    its addresses were removed from the database """
+    if _filter is not None and (_filter.count > _filter.capacity or
+            _removed > _filter.capacity // 2):
+        return load_filter()
+    return defer.succeed(0)
+
+def lookup(hosts):
+    """ Returns the cached crackers among hosts, as a dict of ip address ->
+    copy of the cached entry, and the set of hosts that are not in the
+    database according to the filter """
+    if not is_enabled():
+        return {}, set()
+    cached = {}
+    new = set()
+    for host in hosts:
+        entry = _crackers.get(host)
+        if entry is not None:
+            cached[host] = dict(entry)
+        elif _filter is not None and host not in _filter:
+            new.add(host)
+    metrics.cracker_cache_lookups.inc(len(cached), result="hit")
+    metrics.cracker_cache_lookups.inc(len(new), result="new")
+    metrics.cracker_cache_lookups.inc(len(hosts) - len(cached) - len(new), result="miss")
+    return cached, new
+
+def update(crackers):
+    """ Cache the crackers just stored, a dict of ip address -> dict with
+    at least the keys of the cache entries """
+    if not is_enabled():
+        return
+    for ip_address, cracker in crackers.iteritems():
+        _crackers.put(ip_address, {
+            "id": cracker["id"],
+            "first_time": cracker["first_time"],
+            "total_reports": cracker["total_reports"],
+            "current_reports": cracker["current_reports"],
+        })
+        if _filter is not None and ip_address not in _filter:
+            _filter.add(ip_address)
+        if _loading is not None:
+            _loading.append(ip_address)
+
+def invalidate(hosts, removed=0):
+    """ Forget the cached crackers of hosts, after they were changed by
+    other means than storing reports. removed is the number of crackers
+    that were removed from the database """
+    global _removed
+    for host in hosts:
+        _crackers.invalidate(host)
+    _removed += removed
+
+def stats():
+    result = _crackers.stats()
+    result["filter_size"] = _filter.count if _filter is not None else 0
+    return result
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,241 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# In-memory index of recently active crackers, used to answer get_new_hosts
+# requests without querying the database. The index contains every cracker
+# with a latest_time at or after _coverage_start, together with the report
+# times needed to evaluate the synchronisation conditions.
+#
+# The index is updated after every transaction that changes crackers or
+# reports, while the host locks of the changed crackers are still held, so
+# updates are applied in the same order as they were committed.
+
+import bisect
+import logging
+import time
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twistar.registry import Registry
+
+import config
+import database
+import utils
+
+# cracker id -> dict with ip_address, first_time, latest_time,
+# current_reports, resiliency and reports, a list of
+# (first_report_time, latest_report_time) tuples sorted by first_report_time
+_crackers = {}
+# (latest_time, cracker id) tuples, sorted
+_by_latest = []
+# All crackers with a latest_time at or after this time are in the index.
+# None if the index is not loaded.
+_coverage_start = None
+# Results of fetch_txn() passed to update() while the index is being
+# loaded, applied once it is loaded. None if not loading
+_loading = None
+
+def is_loaded():
+    return _coverage_start is not None
+
+def covers(timestamp):
+    """ Whether all crackers with latest_time >= timestamp are in the index """
+    return _coverage_start is not None and timestamp >= _coverage_start
+
+def _window_start():
+    return time.time() - config.cracker_index_hours * 3600
+
+def configure():
+    """ Load or clear the index, depending on the configuration """
+    if config.cracker_index_hours > 0:
+        if not is_loaded() and _loading is None:
+            return load()
+    else:
+        clear()
+    return defer.succeed(0)
+
+def clear():
+    global _crackers, _by_latest, _coverage_start, _loading
+    _crackers = {}
+    _by_latest = []
+    _coverage_start = None
+    _loading = None
+
+def _fetch_since_txn(txn, since):
+    txn.execute(database.translate_query("""
+        SELECT id, ip_address, first_time, latest_time, current_reports, resiliency
+        FROM crackers
+        WHERE latest_time>=?"""), (since,))
+    cracker_rows = txn.fetchall()
+    txn.execute(database.translate_query("""
+        SELECT r.cracker_id, r.first_report_time, r.latest_report_time
+        FROM reports r JOIN crackers c ON r.cracker_id = c.id
+        WHERE c.latest_time>=?
+        ORDER BY r.cracker_id, r.first_report_time ASC"""), (since,))
+    return (cracker_rows, txn.fetchall())
+
+database.register_query("cracker_index.select_crackers", """
+    SELECT id, ip_address, first_time, latest_time, current_reports, resiliency
+    FROM crackers
+    WHERE id IN ({})""")
+database.register_query("cracker_index.select_reports", """
+    SELECT cracker_id, first_report_time, latest_report_time
+    FROM reports
+    WHERE cracker_id IN ({})
+    ORDER BY cracker_id, first_report_time ASC""")
+
+def fetch_txn(txn, cracker_ids):
+    """ Fetch the current state of some crackers within a transaction, to be
+    passed to update() after the transaction has been committed. Returns
+    None when the index is neither loaded nor being loaded """
+    if (not is_loaded() and _loading is None) or len(cracker_ids) == 0:
+        return None
+    cracker_rows = database.select_in(txn, "cracker_index.select_crackers", cracker_ids)
+    report_rows = database.select_in(txn, "cracker_index.select_reports", cracker_ids)
+    return (cracker_ids, cracker_rows, report_rows)
+
+def _build(cracker_rows, report_rows):
+    crackers = {}
+    for (cracker_id, ip_address, first_time, latest_time, current_reports, resiliency) in cracker_rows:
+        crackers[cracker_id] = {
+            "ip_address": database.ip_value(ip_address),
+            "first_time": first_time,
+            "latest_time": latest_time,
+            "current_reports": current_reports,
+            "resiliency": resiliency,
+            "reports": [],
+        }
+    for (cracker_id, first_report_time, latest_report_time) in report_rows:
+        if cracker_id in crackers:
+            crackers[cracker_id]["reports"].append((first_report_time, latest_report_time))
+    for cracker in crackers.itervalues():
+        cracker["reports"].sort()
+    return crackers
+
+def _remove(cracker_id):
+    cracker = _crackers.pop(cracker_id, None)
+    if cracker is not None:
+        key = (cracker["latest_time"], cracker_id)
+        i = bisect.bisect_left(_by_latest, key)
+        if i < len(_by_latest) and _by_latest[i] == key:
+            del _by_latest[i]
+
+def update(fetched):
+    """ Apply the result of fetch_txn() to the index """
+    if fetched is None:
+        return
+    if _loading is not None:
+        # May have been committed after the load read the database
+        _loading.append(fetched)
+        return
+    if not is_loaded():
+        return
+    cracker_ids, cracker_rows, report_rows = fetched
+    crackers = _build(cracker_rows, report_rows)
+    for cracker_id in cracker_ids:
+        _remove(cracker_id)
+        cracker = crackers.get(cracker_id)
+        if cracker is not None and cracker["latest_time"] >= _coverage_start:
+            _crackers[cracker_id] = cracker
+            bisect.insort(_by_latest, (cracker["latest_time"], cracker_id))
+
+def remove_ip(ip_address):
+    ip_address = utils.normalize_ip(ip_address)
+    for cracker_id, cracker in _crackers.items():
+        if cracker["ip_address"] == ip_address:
+            _remove(cracker_id)
+
+@inlineCallbacks
+def load():
+    """ Fill the index from the database """
+    global _crackers, _by_latest, _coverage_start, _loading
+    since = _window_start()
+    logging.info("Loading crackers active in the past {} hours into memory...".format(
+        config.cracker_index_hours))
+    # Transactions committing from now on pass their changes to update(),
+    # which keeps them until the index is loaded
+    _loading = pending = []
+    try:
+        cracker_rows, report_rows = yield Registry.DBPOOL.runInteraction(_fetch_since_txn, since)
+    finally:
+        if _loading is pending:
+            _loading = None
+    _crackers = _build(cracker_rows, report_rows)
+    _by_latest = sorted((c["latest_time"], cracker_id) for cracker_id, c in _crackers.iteritems())
+    _coverage_start = since
+    # Apply the changes in the order they were committed; those already
+    # seen by the load are applied again without harm
+    for fetched in pending:
+        update(fetched)
+    logging.info("Loaded {} crackers and {} reports into memory".format(
+        len(_crackers), len(report_rows)))
+    returnValue(len(_crackers))
+
+def prune():
+    """ Remove crackers that have not been active within the configured window """
+    global _coverage_start
+    if not is_loaded():
+        return
+    since = _window_start()
+    i = bisect.bisect_left(_by_latest, (since,))
+    for latest_time, cracker_id in _by_latest[:i]:
+        del _crackers[cracker_id]
+    del _by_latest[:i]
+    _coverage_start = max(_coverage_start, since)
+    logging.debug("Pruned {} crackers from index, {} left".format(i, len(_crackers)))
+
+def find_candidates(min_reports, min_resilience, previous_timestamp):
+    """ Conditions (a) and (b) of the synchronisation algorithm. Returns a
+    list of (cracker id, ip address, first_time, reports) tuples, ordered by
+    first_time, newest first """
+    i = bisect.bisect_left(_by_latest, (previous_timestamp,))
+    candidates = []
+    for latest_time, cracker_id in _by_latest[i:]:
+        cracker = _crackers[cracker_id]
+        if (cracker["current_reports"] >= min_reports and
+                cracker["resiliency"] >= min_resilience):
+            candidates.append((cracker_id, cracker["ip_address"],
+                cracker["first_time"], cracker["reports"]))
+    candidates.sort(key=lambda c: (c[2], c[0]), reverse=True)
+    return candidates
+
+@inlineCallbacks
+def check_consistency():
+    """ Compare the index with the database. Returns a list of descriptions
+    of the differences found """
+    if not is_loaded():
+        returnValue([])
+    cracker_rows, report_rows = yield Registry.DBPOOL.runInteraction(
+        _fetch_since_txn, _coverage_start)
+    expected = _build(cracker_rows, report_rows)
+
+    differences = []
+    for cracker_id in set(expected) | set(_crackers):
+        if cracker_id not in _crackers:
+            differences.append("Cracker {} missing from index".format(expected[cracker_id]["ip_address"]))
+        elif cracker_id not in expected:
+            differences.append("Cracker {} in index but not in database".format(_crackers[cracker_id]["ip_address"]))
+        elif _crackers[cracker_id] != expected[cracker_id]:
+            differences.append("Cracker {} differs from database".format(expected[cracker_id]["ip_address"]))
+    if len(_by_latest) != len(_crackers):
+        differences.append("Index has {} crackers but {} entries sorted by time".format(
+            len(_crackers), len(_by_latest)))
+
+    for difference in differences:
+        logging.warning("Cracker index inconsistency: {}".format(difference))
+    returnValue(differences)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -16,18 +16,26 @@
 
 import logging
 import datetime
+import re
 import time
+from cStringIO import StringIO
 
 from twistar.registry import Registry
-from twisted.internet.defer import inlineCallbacks, returnValue
-
-import GeoIP
+from twisted.enterprise import adbapi
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
 
 import config
-import stats
+import geo
+import metrics
+import utils
+
+# stats and summary register their queries when they are imported, so they
+# are imported where they are used, after this module has been loaded
 
 _quiet = False
 
+supported_dbtypes = ["sqlite3", "MySQLdb", "psycopg2"]
+
 def _remove_tables(txn):
     global _quiet
     if not _quiet: 
@@ -38,113 +46,377 @@ def _remove_tables(txn):
     txn.execute("DROP TABLE IF EXISTS legacy")
     txn.execute("DROP TABLE IF EXISTS history")
     txn.execute("DROP TABLE IF EXISTS country_history")
+    txn.execute("DROP TABLE IF EXISTS daily_counters")
+    txn.execute("DROP TABLE IF EXISTS daily_reporters")
+    txn.execute("DROP TABLE IF EXISTS daily_crackers")
+    txn.execute("DROP TABLE IF EXISTS counters")
+    txn.execute("DROP TABLE IF EXISTS reporters")
 
 def _evolve_database_initial(txn, dbtype):
     if dbtype=="sqlite3":
-        autoincrement="AUTOINCREMENT"
+        id_column="id INTEGER PRIMARY KEY AUTOINCREMENT"
     elif dbtype=="MySQLdb":
-        autoincrement="AUTO_INCREMENT"
+        id_column="id INTEGER PRIMARY KEY AUTO_INCREMENT"
+    elif dbtype=="psycopg2":
+        id_column="id SERIAL PRIMARY KEY"
 
-    txn.execute("""CREATE TABLE crackers (
-        id INTEGER PRIMARY KEY {},
+    execute(txn, """CREATE TABLE crackers (
+        {},
         ip_address CHAR(15), 
         first_time INTEGER, 
         latest_time INTEGER, 
         total_reports INTEGER, 
         current_reports INTEGER
-    )""".format(autoincrement))
-    txn.execute("CREATE UNIQUE INDEX cracker_ip_address ON crackers (ip_address)")
+    )""".format(id_column))
+    execute(txn, "CREATE UNIQUE INDEX cracker_ip_address ON crackers (ip_address)")
 
-    txn.execute("""CREATE TABLE reports(
-        id INTEGER PRIMARY KEY {}, 
+    execute(txn, """CREATE TABLE reports(
+        {}, 
         cracker_id INTEGER, 
         ip_address CHAR(15), 
         first_report_time INTEGER, 
         latest_report_time INTEGER
-    )""".format(autoincrement))
-    txn.execute("CREATE INDEX report_first_time ON reports (first_report_time)")
-    txn.execute("CREATE UNIQUE INDEX report_cracker_ip ON reports (cracker_id, ip_address)")
-    txn.execute("CREATE INDEX report_cracker_first ON reports (cracker_id, first_report_time)")
+    )""".format(id_column))
+    execute(txn, "CREATE INDEX report_first_time ON reports (first_report_time)")
+    execute(txn, "CREATE UNIQUE INDEX report_cracker_ip ON reports (cracker_id, ip_address)")
+    if dbtype=="psycopg2":
+        # Covering index, so the reports of the candidate crackers in
+        # get_new_hosts are read from the index only
+        execute(txn, """CREATE INDEX report_cracker_first ON reports (cracker_id, first_report_time)
+            INCLUDE (latest_report_time)""")
+    else:
+        execute(txn, "CREATE INDEX report_cracker_first ON reports (cracker_id, first_report_time)")
 
-    txn.execute("""CREATE TABLE legacy(
-        id INTEGER PRIMARY KEY {}, 
+    execute(txn, """CREATE TABLE legacy(
+        {}, 
         ip_address CHAR(15), 
         retrieved_time INTEGER
-    )""".format(autoincrement))
-    txn.execute("CREATE UNIQUE INDEX legacy_ip ON legacy (ip_address)")
-    txn.execute("CREATE INDEX legacy_retrieved ON legacy (retrieved_time)")
+    )""".format(id_column))
+    execute(txn, "CREATE UNIQUE INDEX legacy_ip ON legacy (ip_address)")
+    execute(txn, "CREATE INDEX legacy_retrieved ON legacy (retrieved_time)")
 
 def _evolve_database_v1(txn, dbtype):
-    txn.execute("""CREATE TABLE info (
+    execute(txn, """CREATE TABLE info (
         `key` CHAR(32) PRIMARY KEY,
         `value` VARCHAR(255)
     )""")
-    if dbtype=="sqlite3":
-        txn.execute('INSERT INTO info VALUES ("schema_version", ?)', (str(_schema_version),))
-    elif dbtype=="MySQLdb":
-        txn.execute('INSERT INTO info VALUES ("schema_version", %s)', (str(_schema_version),))
-    txn.execute('INSERT INTO info VALUES ("last_legacy_sync", 0)')
+    execute(txn, "INSERT INTO info VALUES ('schema_version', ?)", (str(_schema_version),))
+    execute(txn, "INSERT INTO info VALUES ('last_legacy_sync', 0)")
 
 def _evolve_database_v2(txn, dbtype):
-    txn.execute("ALTER TABLE crackers ADD resiliency INTEGER")
-    txn.execute("CREATE INDEX cracker_qual ON crackers (current_reports, resiliency, latest_time, first_time)")
-    txn.execute("CREATE INDEX cracker_first ON crackers (first_time)")
-    txn.execute("UPDATE crackers SET resiliency=latest_time-first_time")
+    execute(txn, "ALTER TABLE crackers ADD resiliency INTEGER")
+    execute(txn, "CREATE INDEX cracker_qual ON crackers (current_reports, resiliency, latest_time, first_time)")
+    execute(txn, "CREATE INDEX cracker_first ON crackers (first_time)")
+    execute(txn, "UPDATE crackers SET resiliency=latest_time-first_time")
 
 def _evolve_database_v3(txn, dbtype):
-    if dbtype=="sqlite3":
-        txn.execute("DROP INDEX cracker_qual")
-    elif dbtype=="MySQLdb":
-        txn.execute("ALTER TABLE crackers DROP INDEX cracker_qual")
-    txn.execute("CREATE INDEX cracker_qual ON crackers (latest_time, current_reports, resiliency, first_time)")
+    if dbtype=="MySQLdb":
+        execute(txn, "ALTER TABLE crackers DROP INDEX cracker_qual")
+    else:
+        execute(txn, "DROP INDEX cracker_qual")
+    if dbtype=="psycopg2":
+        # Covering index for the qualifying crackers query of get_new_hosts
+        execute(txn, """CREATE INDEX cracker_qual ON crackers (latest_time, current_reports, resiliency)
+            INCLUDE (first_time, ip_address)""")
+    else:
+        execute(txn, "CREATE INDEX cracker_qual ON crackers (latest_time, current_reports, resiliency, first_time)")
 
 def _evolve_database_v4(txn, dbtype):
-    txn.execute("CREATE INDEX report_latest ON reports (latest_report_time)")
+    execute(txn, "CREATE INDEX report_latest ON reports (latest_report_time)")
 
 def _evolve_database_v5(txn, dbtype):
-    if dbtype=="sqlite3":
-        txn.execute("DROP INDEX report_cracker_ip")
-    elif dbtype=="MySQLdb":
-        txn.execute("ALTER TABLE reports DROP INDEX report_cracker_ip")
-    txn.execute("CREATE INDEX report_cracker_ip ON reports (cracker_id, ip_address, latest_report_time)")
+    if dbtype=="MySQLdb":
+        execute(txn, "ALTER TABLE reports DROP INDEX report_cracker_ip")
+    else:
+        execute(txn, "DROP INDEX report_cracker_ip")
+    execute(txn, "CREATE INDEX report_cracker_ip ON reports (cracker_id, ip_address, latest_report_time)")
 
 def _evolve_database_v6(txn, dbtype):
     # Remove crackers without reports from database. This may have occured
     # because of a bug in controllers.perform_maintenance()
-    txn.execute("""
+    execute(txn, """
         DELETE FROM crackers 
         WHERE id NOT IN
             ( SELECT cracker_id FROM reports )
         """)
 
 def _evolve_database_v7(txn, dbtype):
-    txn.execute("""CREATE TABLE history (
+    import stats
+    execute(txn, """CREATE TABLE history (
         `date` DATE PRIMARY KEY,
         num_reports INTEGER,
         num_contributors INTEGER, 
         num_reported_hosts INTEGER 
     )""")
 
-    stats.update_recent_history_txn(txn)
+    stats.fixup_history_txn(txn)
 
 def _evolve_database_v8(txn, dbtype):
+    import stats
     global _quiet
-    txn.execute("""CREATE TABLE country_history (
+    execute(txn, """CREATE TABLE country_history (
         country_code CHAR(5) PRIMARY KEY,
         country VARCHAR(50),
         num_reports INTEGER 
     )""")
-    txn.execute("CREATE INDEX country_history_count ON country_history(num_reports)")
-    txn.execute('INSERT INTO `info` VALUES ("last_country_history_update", "1900-01-01")')
+    execute(txn, "CREATE INDEX country_history_count ON country_history(num_reports)")
+    execute(txn, "INSERT INTO `info` VALUES ('last_country_history_update', '1900-01-01')")
 
-    if not _quiet:
-        print("Calculating per-country totals...")
-    stats.update_country_history_txn(txn, None, include_history=True)
+    # The per-country totals are calculated in version 10
 
     if not _quiet:
         print("Fixing up historical data...")
     stats.fixup_history_txn(txn)
 
+def _evolve_database_v9(txn, dbtype):
+    import stats
+    # Per-day counters, maintained when storing reports, to fill the
+    # history table without scanning the reports table
+    execute(txn, """CREATE TABLE daily_counters (
+        `date` DATE PRIMARY KEY,
+        num_reports INTEGER,
+        num_contributors INTEGER,
+        num_reported_hosts INTEGER
+    )""")
+    # The reporters and crackers seen per day, to count the distinct ones.
+    # Only kept for the last few days
+    execute(txn, """CREATE TABLE daily_reporters (
+        `date` DATE,
+        ip_address CHAR(15),
+        PRIMARY KEY (`date`, ip_address)
+    )""")
+    execute(txn, """CREATE TABLE daily_crackers (
+        `date` DATE,
+        cracker_id INTEGER,
+        PRIMARY KEY (`date`, cracker_id)
+    )""")
+
+    if not _quiet:
+        print("Calculating daily counters...")
+    stats.rebuild_daily_counters_txn(txn)
+
+def _evolve_database_v10(txn, dbtype):
+    import stats
+    execute(txn, "ALTER TABLE crackers ADD country_code CHAR(5)")
+
+    if not _quiet:
+        print("Looking up countries of crackers...")
+    last_id = 0
+    while True:
+        execute(txn, """
+            SELECT id, ip_address FROM crackers
+            WHERE id>?
+            ORDER BY id
+            LIMIT 1000""", (last_id,))
+        rows = txn.fetchall()
+        if len(rows) == 0:
+            break
+        executemany(txn, "UPDATE crackers SET country_code=? WHERE id=?",
+            [(geo.country_code(ip_address), cracker_id) for (cracker_id, ip_address) in rows])
+        last_id = rows[-1][0]
+
+    execute(txn, "SELECT COUNT(*) FROM country_history")
+    if txn.fetchall()[0][0] == 0:
+        if not _quiet:
+            print("Calculating per-country totals...")
+        stats.update_country_history_txn(txn, None, include_history=True)
+    else:
+        # Keep the existing totals, continue counting from today
+        yesterday = datetime.date.today() - datetime.timedelta(days=1)
+        execute(txn, "UPDATE info SET `value`=? WHERE `key`='last_country_history_update'",
+            (yesterday.isoformat(),))
+
+def _evolve_database_v11(txn, dbtype):
+    import summary
+    # Summary counters for the statistics page, see the summary module
+    execute(txn, """CREATE TABLE counters (
+        name VARCHAR(30) PRIMARY KEY,
+        `value` BIGINT
+    )""")
+    execute(txn, """CREATE TABLE reporters (
+        ip_address CHAR(15) PRIMARY KEY,
+        num_reports INTEGER
+    )""")
+    execute(txn, "CREATE INDEX cracker_total_reports ON crackers (total_reports)")
+
+    if not _quiet:
+        print("Calculating summary counters...")
+    summary.recount_txn(txn)
+
+# Tables with an ip_address column. The reporters and daily_reporters tables
+# are derived from the reports table, and are filled again after converting
+_ip_tables = ["crackers", "reports", "legacy", "reporters", "daily_reporters"]
+_derived_ip_tables = ["reporters", "daily_reporters"]
+
+def _rebuild_sqlite_table(txn, table, column, column_type):
+    """ Change the type of a column of a sqlite table, by copying it into a
+    new table with the changed definition """
+    txn.execute("SELECT sql FROM sqlite_master WHERE type='table' AND name=?", (table,))
+    create = txn.fetchone()[0]
+    txn.execute("SELECT sql FROM sqlite_master WHERE type='index' AND tbl_name=? AND sql IS NOT NULL",
+        (table,))
+    indexes = [row[0] for row in txn.fetchall()]
+    txn.execute("SELECT seq FROM sqlite_sequence WHERE name=?", (table,))
+    sequence = txn.fetchone()
+
+    create = re.sub(r"^CREATE TABLE\s+{}\b".format(table), "CREATE TABLE {}_new".format(table), create)
+    create = re.sub(r"\b{} CHAR\(\d+\)".format(column), "{} {}".format(column, column_type), create)
+    txn.execute(create)
+    txn.execute("INSERT INTO {0}_new SELECT * FROM {0}".format(table))
+    txn.execute("DROP TABLE {}".format(table))
+    txn.execute("ALTER TABLE {0}_new RENAME TO {0}".format(table))
+    for index in indexes:
+        txn.execute(index)
+    if sequence is not None:
+        txn.execute("UPDATE sqlite_sequence SET seq=? WHERE name=?", (sequence[0], table))
+
+def _merge_cracker_txn(txn, cracker_id, kept_id):
+    """ Merge a cracker into the cracker with another spelling of the same
+    ip address """
+    execute(txn, "UPDATE reports SET cracker_id=? WHERE cracker_id=?", (kept_id, cracker_id))
+    execute(txn, "SELECT `date` FROM daily_crackers WHERE cracker_id=?", (cracker_id,))
+    executemany(txn, "daily_activity.insert_crackers",
+        [(row[0], kept_id) for row in txn.fetchall()])
+    execute(txn, "DELETE FROM daily_crackers WHERE cracker_id=?", (cracker_id,))
+
+    execute(txn, """
+        SELECT id, first_time, latest_time, total_reports FROM crackers
+        WHERE id IN (?,?)""", (cracker_id, kept_id))
+    rows = txn.fetchall()
+    first_time = min(row[1] for row in rows)
+    latest_time = max(row[2] for row in rows)
+    execute(txn, """
+        UPDATE crackers SET first_time=?, latest_time=?, resiliency=?, total_reports=?
+        WHERE id=?""", (first_time, latest_time, latest_time - first_time,
+            sum(row[3] for row in rows), kept_id))
+    execute(txn, "DELETE FROM crackers WHERE id=?", (cracker_id,))
+
+def _merge_legacy_txn(txn, legacy_id, kept_id):
+    """ Merge a legacy host into the one with another spelling of the same
+    ip address """
+    execute(txn, "SELECT retrieved_time FROM legacy WHERE id=?", (legacy_id,))
+    retrieved_time = txn.fetchone()[0]
+    execute(txn, "UPDATE legacy SET retrieved_time=? WHERE id=? AND retrieved_time<?",
+        (retrieved_time, kept_id, retrieved_time))
+    execute(txn, "DELETE FROM legacy WHERE id=?", (legacy_id,))
+
+# Tables with a unique ip_address, and how to merge a row into the row with
+# another spelling of its address
+_ip_merges = {
+    "crackers": _merge_cracker_txn,
+    "legacy": _merge_legacy_txn,
+}
+
+def _pack_ip_column(txn, table):
+    """ Convert the ip addresses in table to binary form. Rows with an
+    invalid address are removed. When the address of a row was converted
+    before in another spelling, the row is merged into that one if the
+    address is unique in the table. Returns the number of removed rows and
+    a dict of cracker id -> number of reports removed, for the crackers
+    whose reports changed """
+    removed = 0
+    changed_crackers = {}
+    merge = _ip_merges.get(table)
+    last_id = 0
+    while True:
+        execute(txn, """
+            SELECT id, ip_address FROM {}
+            WHERE id>?
+            ORDER BY id
+            LIMIT 1000""".format(table), (last_id,))
+        rows = txn.fetchall()
+        if len(rows) == 0:
+            break
+        addresses = []
+        invalid = []
+        for (row_id, ip_address) in rows:
+            try:
+                addresses.append((row_id, utils.normalize_ip(str(ip_address).strip())))
+            except (ValueError, UnicodeError):
+                invalid.append((row_id,))
+
+        kept = {}
+        if merge is not None:
+            # Rows converted in an earlier chunk
+            for row in select_in(txn,
+                    "SELECT id, ip_address FROM {} WHERE ip_address IN ({{}})".format(table),
+                    list(set(ip_param(address) for (row_id, address) in addresses))):
+                kept[ip_value(row[1])] = row[0]
+        updates = []
+        for (row_id, address) in addresses:
+            if address in kept:
+                merge(txn, row_id, kept[address])
+                if table == "crackers":
+                    changed_crackers.setdefault(kept[address], 0)
+                removed += 1
+            else:
+                if merge is not None:
+                    kept[address] = row_id
+                updates.append((ip_param(address), row_id))
+        executemany(txn, "UPDATE {} SET ip_address=? WHERE id=?".format(table), updates)
+
+        if len(invalid) > 0:
+            if table == "crackers":
+                executemany(txn, "DELETE FROM reports WHERE cracker_id=?", invalid)
+            elif table == "reports":
+                for row in select_in(txn, "SELECT cracker_id FROM reports WHERE id IN ({})",
+                        [row_id for (row_id,) in invalid]):
+                    changed_crackers[row[0]] = changed_crackers.get(row[0], 0) + 1
+            executemany(txn, "DELETE FROM {} WHERE id=?".format(table), invalid)
+            removed += len(invalid)
+        last_id = rows[-1][0]
+    return removed, changed_crackers
+
+def _recount_crackers_txn(txn, changed_crackers):
+    """ Update the report counters of crackers after merging them or
+    removing some of their reports. changed_crackers is a dict of cracker
+    id -> number of removed reports. Crackers without reports are removed """
+    counts = {}
+    for row in select_in(txn, """
+            SELECT cracker_id, COUNT(*), COUNT(DISTINCT ip_address) FROM reports
+            WHERE cracker_id IN ({})
+            GROUP BY cracker_id""", changed_crackers.keys()):
+        counts[row[0]] = (row[1], row[2])
+    executemany(txn, """
+        UPDATE crackers SET total_reports=CASE WHEN total_reports-?>? THEN total_reports-? ELSE ? END,
+            current_reports=?
+        WHERE id=?""",
+        [(num_removed, counts[cracker_id][0], num_removed, counts[cracker_id][0],
+            counts[cracker_id][1], cracker_id)
+            for cracker_id, num_removed in changed_crackers.iteritems() if cracker_id in counts])
+    executemany(txn, "DELETE FROM crackers WHERE id=?",
+        [(cracker_id,) for cracker_id in changed_crackers if cracker_id not in counts])
+
+def _evolve_database_v12(txn, dbtype):
+    import stats
+    import summary
+    # Store ip addresses in binary form, see ip_param()
+    if not _quiet:
+        print("Converting ip addresses to binary form...")
+    removed = 0
+    changed_crackers = {}
+    for table in _ip_tables:
+        if dbtype=="sqlite3":
+            _rebuild_sqlite_table(txn, table, "ip_address", "BLOB")
+        elif dbtype=="MySQLdb":
+            execute(txn, "ALTER TABLE {} MODIFY ip_address VARBINARY(16)".format(table))
+        elif dbtype=="psycopg2":
+            execute(txn, """ALTER TABLE {} ALTER COLUMN ip_address TYPE BYTEA
+                USING convert_to(ip_address, 'UTF8')""".format(table))
+        if table in _derived_ip_tables:
+            execute(txn, "DELETE FROM {}".format(table))
+        else:
+            table_removed, table_changed = _pack_ip_column(txn, table)
+            removed += table_removed
+            for cracker_id, num_removed in table_changed.iteritems():
+                changed_crackers[cracker_id] = changed_crackers.get(cracker_id, 0) + num_removed
+
+    if removed > 0 and not _quiet:
+        print("Removed {} rows with an invalid or duplicate ip address".format(removed))
+    _recount_crackers_txn(txn, changed_crackers)
+    stats.fill_daily_reporters_txn(txn)
+    summary.recount_txn(txn)
+
 _evolutions = {
     1: _evolve_database_v1,
     2: _evolve_database_v2,
@@ -153,7 +425,11 @@ _evolutions = {
     5: _evolve_database_v5,
     6: _evolve_database_v6,
     7: _evolve_database_v7,
-    8: _evolve_database_v8
+    8: _evolve_database_v8,
+    9: _evolve_database_v9,
+    10: _evolve_database_v10,
+    11: _evolve_database_v11,
+    12: _evolve_database_v12
 }
 
 _schema_version = len(_evolutions)
@@ -164,8 +440,11 @@ def _evolve_database(txn):
         print("Evolving database")
     dbtype = config.dbtype
 
+    if dbtype=="psycopg2":
+        # A failed statement aborts the whole transaction in PostgreSQL
+        txn.execute("SAVEPOINT schema_version")
     try:
-        txn.execute('SELECT `value` FROM info WHERE `key`="schema_version"')
+        execute(txn, "SELECT `value` FROM info WHERE `key`='schema_version'")
         result = txn.fetchone()
         if result is not None:
             current_version = int(result[0])
@@ -177,6 +456,8 @@ def _evolve_database(txn):
     except:
         if not _quiet:
             print("No schema version in database")
+        if dbtype=="psycopg2":
+            txn.execute("ROLLBACK TO SAVEPOINT schema_version")
         _evolve_database_initial(txn, dbtype)
         current_version = 0
 
@@ -194,10 +475,7 @@ def _evolve_database(txn):
             print("Evolving database to version {}...".format(current_version))
         _evolutions[current_version](txn, dbtype)
 
-        if dbtype=="sqlite3":
-            txn.execute('UPDATE info SET `value`=? WHERE `key`="schema_version"', (str(current_version),))
-        elif dbtype=="MySQLdb":
-            txn.execute('UPDATE info SET `value`=%s WHERE `key`="schema_version"', (str(current_version),))
+        execute(txn, "UPDATE info SET `value`=? WHERE `key`='schema_version'", (str(current_version),))
 
     if not _quiet:
         print("Updated database schema, current version is {}".format(_schema_version))
@@ -215,7 +493,7 @@ def clean_database(quiet = False):
 @inlineCallbacks
 def get_schema_version():
     try:
-        rows = yield Registry.DBPOOL.runQuery('SELECT `value` FROM `info` WHERE `key`="schema_version"')
+        rows = yield run_query("SELECT `value` FROM `info` WHERE `key`='schema_version'")
         if rows is not None:
             current_version = int(rows[0][0])
         else:
@@ -241,38 +519,442 @@ def check_database_version():
         logging.info("Database schema is up to date (version {})".format(current_version))
         returnValue(current_version)
 
-# FIXME Not the proper way. What if there's a question mark somewhere
-# else in the query?
+# Named queries, see register_query()
+_queries = {}
+# Query text for the database driver, by (dbtype, query or name). Used
+# from the database threads as well, so this is a plain dict, which is
+# cleared when it grows too large
+_translated = {}
+_max_translated = 2000
+
+def register_query(name, query):
+    """ Register a query under a name. The name can be passed instead of the
+    query text to translate_query() and the functions running queries, so
+    the query is only translated once per database type and the driver
+    always gets the same text, which lets sqlite reuse its prepared
+    statement. query can also be a function returning the text, for
+    queries that depend on the database type. Returns the name """
+    _queries[name] = query
+    return name
+
+def _query_text(query):
+    query = _queries.get(query, query)
+    if callable(query):
+        query = query()
+    return query
+
+def _translate(query, dbtype):
+    if dbtype == "sqlite3":
+        return query
+    # MySQLdb and psycopg2 use %s placeholders and format the query with the
+    # % operator, so literal % signs must be doubled. Question marks in
+    # quoted strings and identifiers are not placeholders. PostgreSQL quotes
+    # identifiers with double quotes instead of backticks
+    result = []
+    quote = None
+    escaped = False
+    for c in query:
+        if c == "%":
+            result.append("%%")
+            continue
+        if quote is not None:
+            if escaped:
+                escaped = False
+            elif c == "\\" and dbtype == "MySQLdb":
+                escaped = True
+            elif c == quote:
+                quote = None
+        elif c in "'\"`":
+            quote = c
+        elif c == "?":
+            c = "%s"
+        if c == "`" and dbtype == "psycopg2":
+            c = '"'
+        result.append(c)
+    query = "".join(result)
+
+    if dbtype == "psycopg2":
+        statement = query.lstrip().upper()
+        if statement.startswith("INSERT IGNORE INTO"):
+            query = query.replace("INSERT IGNORE INTO", "INSERT INTO", 1).rstrip() + \
+                " ON CONFLICT DO NOTHING"
+        elif statement.startswith("CREATE TABLE") or statement.startswith("ALTER TABLE"):
+            # CHAR columns are padded with spaces when read back
+            query = re.sub(r"\bCHAR\(", "VARCHAR(", query)
+    return query
+
 def translate_query(query):
+    """ Translate a query (or the name of a registered query) with ? placeholders
+    for the configured database driver """
     global _quiet
-    if config.dbtype == "MySQLdb":
-        return query.replace('?', '%s')
-    elif config.dbtype == "sqlite3":
-        return query
-    else:
+    if config.dbtype not in supported_dbtypes:
         if not _quiet:
             print("unsupported database {}".format(config.dbtype))
-        return query
+        return _query_text(query)
+    key = (config.dbtype, query)
+    translated = _translated.get(key)
+    if translated is None:
+        if len(_translated) >= _max_translated:
+            _translated.clear()
+        translated = _translated[key] = _translate(_query_text(query), config.dbtype)
+    return translated
+
+def execute(txn, query, args=()):
+    txn.execute(translate_query(query), tuple(args))
+
+def executemany(txn, query, rows):
+    txn.executemany(translate_query(query), rows)
+
+def insert_ignore(table):
+    """ Start of an INSERT statement that skips rows with duplicate keys. For
+    PostgreSQL, translate_query() turns this into ON CONFLICT DO NOTHING """
+    if config.dbtype in ["MySQLdb", "psycopg2"]:
+        return "INSERT IGNORE INTO {}".format(table)
+    else:
+        return "INSERT OR IGNORE INTO {}".format(table)
+
+def local_date(column):
+    """ SQL expression for the date, in local time, of a timestamp column.
+    PostgreSQL uses the time zone of the session """
+    if config.dbtype == "MySQLdb":
+        return "DATE(FROM_UNIXTIME({}))".format(column)
+    elif config.dbtype == "psycopg2":
+        return "CAST(to_timestamp({}) AS DATE)".format(column)
+    else:
+        return "date({}, 'unixepoch', 'localtime')".format(column)
+
+def hours_since(column):
+    """ SQL expression for the number of whole hours from a timestamp, given
+    as query parameter, to a later timestamp column """
+    if config.dbtype == "psycopg2":
+        return "CAST(FLOOR(({}-?)/3600) AS INTEGER)".format(column)
+    return "CAST(({}-?)/3600 AS UNSIGNED INTEGER)".format(column)
+
+def any_value(column):
+    """ SQL aggregate for a value of column from any row of the group.
+    PostgreSQL has no MIN() for binary columns """
+    if config.dbtype == "psycopg2":
+        return "(array_agg({}))[1]".format(column)
+    return "MIN({})".format(column)
+
+def ip_param(ip_address):
+    """ Query parameter for an ip_address column. Addresses are stored in
+    the 16 byte binary form of utils.pack_ip(). Raises ValueError for
+    strings that are not an IP address """
+    packed = utils.pack_ip(ip_address)
+    if config.dbtype == "MySQLdb":
+        return packed
+    return buffer(packed)
+
+def ip_value(value):
+    """ The ip address string of an ip_address column value """
+    if value is None:
+        return None
+    value = str(value)
+    if len(value) != 16:
+        # Not converted yet, while evolving a database from before
+        # schema version 12
+        return value
+    return utils.unpack_ip(value)
+
+# Primary key columns of the tables whose rows are replaced or added to
+_primary_keys = {
+    "crackers": ["id"],
+    "reports": ["id"],
+    "legacy": ["id"],
+    "info": ["`key`"],
+    "history": ["`date`"],
+    "country_history": ["country_code"],
+    "daily_counters": ["`date`"],
+    "counters": ["name"],
+}
+
+def _conflict_update(table, columns, assignment, keys=None):
+    if keys is None:
+        keys = _primary_keys[table]
+    updates = ",".join(assignment.format(column=column, table=table)
+        for column in columns if column not in keys)
+    if config.dbtype == "MySQLdb":
+        return " ON DUPLICATE KEY UPDATE " + updates
+    return " ON CONFLICT ({}) DO UPDATE SET {}".format(",".join(keys), updates)
+
+def replace_into(table, columns):
+    """ Statement inserting a row, or replacing the row with the same
+    primary key """
+    values = "({}) VALUES ({})".format(",".join(columns), ",".join("?"*len(columns)))
+    if config.dbtype == "psycopg2":
+        return "INSERT INTO {} {}".format(table, values) + \
+            _conflict_update(table, columns, "{column}=EXCLUDED.{column}")
+    return "REPLACE INTO {} {}".format(table, values)
+
+def add_to_rows(txn, table, columns, rows):
+    """ Add values to the columns of rows, inserting the rows that do not
+    exist yet. columns starts with the primary key of table; rows are tuples
+    with the primary key and the values to add """
+    if len(rows) == 0:
+        return
+    keys = _primary_keys[table]
+    counts = columns[len(keys):]
+    if config.dbtype in ["MySQLdb", "psycopg2"]:
+        if config.dbtype == "MySQLdb":
+            assignment = "{column}={column}+VALUES({column})"
+        else:
+            assignment = "{column}={table}.{column}+EXCLUDED.{column}"
+        executemany(txn, "INSERT INTO {} ({}) VALUES ({})".format(
+                table, ",".join(columns), ",".join("?"*len(columns))) +
+            _conflict_update(table, columns, assignment), rows)
+    else:
+        executemany(txn, "{} ({}) VALUES ({})".format(insert_ignore(table),
+                ",".join(columns), ",".join(["?"]*len(keys) + ["0"]*len(counts))),
+            [row[:len(keys)] for row in rows])
+        executemany(txn, "UPDATE {} SET {} WHERE {}".format(table,
+                ",".join("{0}={0}+?".format(column) for column in counts),
+                " AND ".join("{}=?".format(key) for key in keys)),
+            [row[len(keys):] + row[:len(keys)] for row in rows])
+
+def set_rows(txn, table, columns, rows, keys=None):
+    """ Set the columns of rows, inserting the rows that do not exist yet.
+    columns starts with keys, a unique key of table (default: its primary
+    key); rows are tuples with the key and the new values. Every key may
+    occur only once in rows """
+    if len(rows) == 0:
+        return
+    if keys is None:
+        keys = _primary_keys[table]
+    values = columns[len(keys):]
+    if config.dbtype in ["MySQLdb", "psycopg2"]:
+        if config.dbtype == "MySQLdb":
+            assignment = "{column}=VALUES({column})"
+        else:
+            assignment = "{column}=EXCLUDED.{column}"
+        row_placeholders = "({})".format(",".join("?"*len(columns)))
+        for chunk in chunks(rows, max_in_params // len(columns)):
+            execute(txn, "INSERT INTO {} ({}) VALUES {}".format(table, ",".join(columns),
+                    ",".join([row_placeholders]*len(chunk))) +
+                _conflict_update(table, columns, assignment, keys),
+                [value for row in chunk for value in row])
+    else:
+        executemany(txn, "{} ({}) VALUES ({})".format(insert_ignore(table),
+                ",".join(columns), ",".join("?"*len(columns))),
+            rows)
+        executemany(txn, "UPDATE {} SET {} WHERE {}".format(table,
+                ",".join("{}=?".format(column) for column in values),
+                " AND ".join("{}=?".format(key) for key in keys)),
+            [row[len(keys):] + row[:len(keys)] for row in rows])
+
+def _copy_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, buffer):
+        return "\\x" + str(value).encode("hex")
+    if isinstance(value, float):
+        value = repr(value)
+    elif isinstance(value, datetime.date):
+        value = value.isoformat()
+    elif isinstance(value, unicode):
+        value = value.encode("utf-8")
+    return '"' + str(value).replace('"', '""') + '"'
+
+def bulk_insert(txn, table, columns, rows, replace=False):
+    """ Insert many rows at once; with replace, rows replace the existing
+    rows with the same primary key. columns is None for all columns of the
+    table, in order. On PostgreSQL the rows are loaded with COPY """
+    if len(rows) == 0:
+        return
+    if config.dbtype != "psycopg2":
+        if columns is None:
+            query = "{} INTO {} VALUES ({})".format("REPLACE" if replace else "INSERT",
+                table, ",".join("?"*len(rows[0])))
+        elif replace:
+            query = replace_into(table, columns)
+        else:
+            query = "INSERT INTO {} ({}) VALUES ({})".format(table, ",".join(columns),
+                ",".join("?"*len(columns)))
+        executemany(txn, query, [tuple(row) for row in rows])
+        return
+
+    data = StringIO("".join(",".join(_copy_value(value) for value in row) + "\n"
+        for row in rows))
+    column_list = "" if columns is None else "({})".format(translate_query(",".join(columns)))
+    if replace:
+        keys = translate_query(",".join(_primary_keys[table]))
+        txn.execute("CREATE TEMPORARY TABLE bulk_rows (LIKE {})".format(table))
+        txn.copy_expert("COPY bulk_rows {} FROM STDIN WITH (FORMAT csv)".format(column_list), data)
+        txn.execute("DELETE FROM {0} WHERE ({1}) IN (SELECT {1} FROM bulk_rows)".format(table, keys))
+        txn.execute("INSERT INTO {0} {1} SELECT {2} FROM bulk_rows".format(table, column_list,
+            column_list[1:-1] or "*"))
+        txn.execute("DROP TABLE bulk_rows")
+    else:
+        txn.copy_expert("COPY {} {} FROM STDIN WITH (FORMAT csv)".format(table, column_list), data)
+    if _primary_keys.get(table) == ["id"]:
+        # Rows were inserted with their ids, so move the sequence past them
+        txn.execute("SELECT setval(pg_get_serial_sequence('{0}', 'id'), "
+            "COALESCE(MAX(id), 1)) FROM {0}".format(table))
+
+def chunks(items, size):
+    for start in xrange(0, len(items), size):
+        yield items[start:start+size]
+
+# Maximum number of parameters in a single IN (...) clause. Keep this well
+# below the maximum number of host parameters sqlite allows in a single
+# statement (999)
+max_in_params = 500
+
+def in_list(values):
+    """ Placeholders for an IN list of values, and the values to pass for
+    them. The list is padded to a power of two by repeating the last value,
+    so only a few distinct query texts are sent to the database """
+    size = 1
+    while size < len(values):
+        size *= 2
+    size = min(size, max(max_in_params, len(values)))
+    values = tuple(values)
+    if len(values) > 0:
+        values += values[-1:] * (size - len(values))
+    return (",".join("?"*len(values)), values)
+
+def expand_in(query, values):
+    """ Fill in the {} placeholder for an IN list in query (or the name of a
+    registered query). Returns the query and the values to pass for the
+    list, see in_list() """
+    placeholders, values = in_list(values)
+    return (_query_text(query).format(placeholders), values)
+
+def select_in(txn, query, values, *args):
+    """ Execute query (or the name of a registered query), which should
+    contain a single {} placeholder for an IN list, for all values in
+    chunks, and return all rows. Extra args are passed before the values """
+    rows = []
+    for chunk in chunks(values, max_in_params):
+        chunk_query, chunk = expand_in(query, chunk)
+        execute(txn, chunk_query, tuple(args) + chunk)
+        rows.extend(txn.fetchall())
+    return rows
+
+def _timed(kind, d):
+    metrics.db_queries_in_progress.inc()
+    def done(result):
+        metrics.db_queries_in_progress.dec()
+        return result
+    return metrics.db_query_duration.time(d, kind=kind).addBoth(done)
 
 def run_query(query, *args):
-    return Registry.DBPOOL.runQuery(translate_query(query), args)
+    return _timed("query", Registry.DBPOOL.runQuery(translate_query(query), args))
 
 def run_operation(query, *args):
-    return Registry.DBPOOL.runOperation(translate_query(query), args)
+    return _timed("operation", Registry.DBPOOL.runOperation(translate_query(query), args))
+
+def _run_many_txn(txn, query, rows):
+    executemany(txn, query, rows)
+    return txn.rowcount
+
+def run_many(query, rows):
+    """ Execute query for every row of parameters, as a single executemany()
+    in one transaction. Returns a Deferred firing with the row count """
+    return _timed("many", Registry.DBPOOL.runInteraction(_run_many_txn, query, rows))
+
+# Pool of read-only connections, for sqlite with write-ahead logging. None
+# if reads use the connection pool of Registry.DBPOOL
+_read_pool = None
+
+def _open_sqlite_connection(conn, read_only=False):
+    cursor = conn.cursor()
+    if config.sqlite_wal:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.fetchall()
+        # Durable at every checkpoint instead of every commit
+        cursor.execute("PRAGMA synchronous=NORMAL")
+    if config.sqlite_cache_size > 0:
+        # Negative sizes are in KiB instead of pages
+        cursor.execute("PRAGMA cache_size=-{}".format(config.sqlite_cache_size))
+    cursor.execute("PRAGMA mmap_size={}".format(config.sqlite_mmap_size))
+    cursor.fetchall()
+    if read_only:
+        cursor.execute("PRAGMA query_only=ON")
+    cursor.close()
+
+def _open_sqlite_reader(conn):
+    _open_sqlite_connection(conn, read_only=True)
+
+def connect():
+    """ Create the connection pools, closing the ones created before. For
+    sqlite, Registry.DBPOOL has a single connection that does all writes;
+    with write-ahead logging, a separate pool of read-only connections is
+    used for the queries that can run next to the writes """
+    global _read_pool
+    if Registry.DBPOOL is not None:
+        Registry.DBPOOL.close()
+    if _read_pool is not None:
+        _read_pool.close()
+        _read_pool = None
+
+    params = dict(config.dbparams)
+    if config.dbtype == "sqlite3":
+        params["cp_openfun"] = _open_sqlite_connection
+    Registry.DBPOOL = adbapi.ConnectionPool(config.dbtype, **params)
+
+    if (config.dbtype == "sqlite3" and config.sqlite_wal
+            and config.sqlite_read_connections > 0
+            and params["database"] != ":memory:"):
+        params.update(cp_min=1, cp_max=config.sqlite_read_connections,
+            cp_openfun=_open_sqlite_reader)
+        _read_pool = adbapi.ConnectionPool(config.dbtype, **params)
+
+def read_pool():
+    """ The connection pool for read-only queries """
+    if _read_pool is not None:
+        return _read_pool
+    return Registry.DBPOOL
+
+def run_read_query(query, *args):
+    """ Like run_query(), for queries that do not modify the database """
+    return _timed("read_query", read_pool().runQuery(translate_query(query), args))
+
+def run_read_interaction(interaction, *args):
+    """ Run interaction, which must not modify the database, in a
+    transaction on a read-only connection if there is one """
+    return _timed("read_interaction", read_pool().runInteraction(interaction, *args))
+
+def _pool_statistics():
+    pool = Registry.DBPOOL
+    threadpool = getattr(pool, "threadpool", None)
+    if threadpool is None:
+        return (0, 0)
+    return (threadpool.q.qsize(), len(threadpool.working))
+
+metrics.Gauge("denyhosts_db_pool_backlog",
+    "Number of database interactions waiting for a connection",
+    function=lambda: _pool_statistics()[0])
+metrics.Gauge("denyhosts_db_pool_busy",
+    "Number of database connections in use",
+    function=lambda: _pool_statistics()[1])
 
 def run_truncate_query(table):
     global _quiet
-    if config.dbtype == "MySQLdb":
+    if config.dbtype in ["MySQLdb", "psycopg2"]:
         query = "TRUNCATE TABLE `{}`".format(table)
     elif config.dbtype == "sqlite3":
         query = "DELETE FROM `{}`".format(table)
     else:
         if not _quiet:
             print("unsupported database {}".format(config.dbtype))
-    return Registry.DBPOOL.runQuery(query)
+    return run_operation(query)
+
+def _dump_txn(txn, query, *args):
+    """ Run a query, and return the rows as lists of JSON and XML-RPC
+    serializable values, with the ip addresses as strings """
+    execute(txn, query, args)
+    ip_columns = [i for i, column in enumerate(txn.description) if column[0] == "ip_address"]
+    rows = []
+    for row in txn.fetchall():
+        row = [_dump_value(value) for value in row]
+        for i in ip_columns:
+            row[i] = ip_value(row[i])
+        rows.append(row)
+    return rows
 
 def dump_crackers():
-    return run_query("SELECT * FROM crackers")
+    return run_read_interaction(_dump_txn, "SELECT * FROM crackers")
 
 @inlineCallbacks
 def dump_table(table):
@@ -286,9 +968,82 @@ def dump_table(table):
                 l[j] =time.mktime(row[j].timetuple())
                 rows[i] = tuple(l)
 
+# Tables that are copied when bootstrapping from a peer, in order, with the
+# column used to page through them. Tables paged by id are copied in id
+# order, so an interrupted bootstrap can be resumed from the highest id
+# present locally. The other tables are small; they are paged by offset and
+# copied completely, replacing existing rows.
+bootstrap_tables = [
+    ("crackers", "id"),
+    ("reports", "id"),
+    ("legacy", "id"),
+    ("info", "`key`"),
+    ("history", "`date`"),
+    ("country_history", "country_code"),
+    ("daily_counters", "`date`"),
+]
+_bootstrap_order = dict(bootstrap_tables)
+
+def _ip_columns_txn(txn, table):
+    """ Positions of the ip_address columns in the rows of table """
+    txn.execute("SELECT * FROM {} WHERE 1=0".format(table))
+    columns = [i for i, column in enumerate(txn.description) if column[0] == "ip_address"]
+    txn.fetchall()
+    return columns
+
+def _dump_value(value):
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return value
+
+@inlineCallbacks
+def dump_chunk(table, cursor, limit):
+    """ Return a list of at most limit rows of table, starting after cursor,
+    and the cursor to use for the next chunk. Rows are lists of JSON
+    serializable values """
+    order = _bootstrap_order[table]
+    if order == "id":
+        rows = yield run_read_interaction(_dump_txn,
+            "SELECT * FROM {} WHERE id>? ORDER BY id LIMIT ?".format(table), cursor, limit)
+        if len(rows) > 0:
+            cursor = rows[-1][0]
+    else:
+        rows = yield run_read_interaction(_dump_txn,
+            "SELECT * FROM {} ORDER BY {} LIMIT ? OFFSET ?".format(table, order), limit, cursor)
+        cursor += len(rows)
+    returnValue((rows, cursor))
+
+def _bootstrap_rows_txn(txn, table, rows):
+    ip_columns = _ip_columns_txn(txn, table)
+    if len(ip_columns) > 0:
+        rows = [list(row) for row in rows]
+        for row in rows:
+            for i in ip_columns:
+                row[i] = ip_param(row[i])
+    bulk_insert(txn, table, None, rows, replace=_bootstrap_order[table] != "id")
+    return len(rows)
+
+def bootstrap_rows(table, rows):
+    """ Insert a chunk of rows from dump_chunk() in a single transaction """
+    if table == "info":
+        rows = [row for row in rows if row[0] != "schema_version"]
+    if len(rows) == 0:
+        return succeed(0)
+    return _timed("many", Registry.DBPOOL.runInteraction(_bootstrap_rows_txn, table, rows))
+
+@inlineCallbacks
+def get_bootstrap_cursor(table):
+    """ The cursor to resume copying table from """
+    if _bootstrap_order[table] == "id":
+        rows = yield run_query("SELECT MAX(id) FROM {}".format(table))
+        returnValue(rows[0][0] or 0)
+    returnValue(0)
+
 def dump_reports_for_cracker(cracker_ip):
     logging.debug("database.dump_reports_for_cracker({})".format(cracker_ip))
-    return run_query("SELECT r.* FROM reports r JOIN crackers c ON r.cracker_id = c.id WHERE c.ip_address=?", cracker_ip) 
+    return run_read_interaction(_dump_txn,
+        "SELECT r.* FROM reports r JOIN crackers c ON r.cracker_id = c.id WHERE c.ip_address=?",
+        ip_param(cracker_ip))
 
 def bootstrap_table(table, params):
     if table=="info" and params[0]=="schema_version":
@@ -28,6 +28,9 @@ import models
 from models import Cracker, Report
 import config
 import controllers
+import cracker_cache
+import cracker_index
+import peering
 import utils
 
 class DebugServer(xmlrpc.XMLRPC):
@@ -90,7 +93,7 @@ class DebugServer(xmlrpc.XMLRPC):
 
             yield utils.wait_and_lock_host(cracker_ip)
             
-            cracker = yield Cracker.find(where=['ip_address=?', cracker_ip], limit=1)
+            cracker = yield controllers.get_cracker(cracker_ip)
             if cracker is None:
                 cracker = Cracker(ip_address=cracker_ip, first_time=when, latest_time=when, total_reports=0, current_reports=0)
                 yield cracker.save()
@@ -102,6 +105,22 @@ class DebugServer(xmlrpc.XMLRPC):
         total_reports = yield Report.count()
         returnValue((total,total_reports))
 
+    def xmlrpc_check_cracker_index(self):
+        """ Compare the in-memory cracker index with the database """
+        return cracker_index.check_consistency()
+
+    def xmlrpc_new_hosts_cache_stats(self):
+        """ Size and hit/miss counts of the get_new_hosts cache """
+        return controllers.get_new_hosts_cache_stats()
+
+    def xmlrpc_cracker_cache_stats(self):
+        """ Size and hit/miss counts of the cracker cache """
+        return cracker_cache.stats()
+
+    def xmlrpc_peer_update_stats(self):
+        """ Number of queued and dropped updates for peers """
+        return peering.get_update_queue_stats()
+
     def xmlrpc_clear_bulk_cracker_list(self):
         self._crackers = []
         return 0
@@ -122,6 +141,7 @@ class DebugServer(xmlrpc.XMLRPC):
         #logging.info("found reports: {}".format(reports))
         cracker_cols=['ip_address','first_time', 'latest_time', 'resiliency', 'total_reports', 'current_reports']
         report_cols=['ip_address','first_report_time', 'latest_report_time']
-        returnValue( [cracker.toHash(cracker_cols), [r.toHash(report_cols) for r in reports]] )
+        returnValue([{ col: getattr(cracker, col) for col in cracker_cols },
+            [{ col: getattr(r, col) for col in report_cols } for r in reports]])
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,81 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Country lookups of IP addresses, using a single GeoIP database handle and
+# a cache of recent lookups. Lookups are done both from the reactor thread
+# and from database transactions in the thread pool, so the cache is
+# protected by a lock.
+
+import logging
+import threading
+
+import GeoIP
+
+import cache
+import config
+
+unknown_country = ("ZZ", "(Unknown)")
+
+_gi = None
+_cache = cache.LRUCache(0)
+_lock = threading.Lock()
+# Country code -> name of the countries seen so far
+_country_names = { unknown_country[0]: unknown_country[1] }
+
+def configure():
+    """ Open the GeoIP database, if not opened yet, and set up the cache """
+    global _gi, _cache
+    with _lock:
+        if _gi is None:
+            _gi = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
+        _cache = cache.LRUCache(config.geoip_cache_size)
+
+def lookup(ip_address):
+    """ Returns the (country code, country name) tuple of ip_address, or
+    unknown_country if the country is unknown """
+    if _gi is None:
+        configure()
+    with _lock:
+        result = _cache.get(ip_address)
+        if result is not None:
+            return result
+
+        try:
+            country_code = _gi.country_code_by_addr(ip_address)
+            country = _gi.country_name_by_addr(ip_address)
+        except Exception, e:
+            logging.debug("Exception looking up country for {}: {}".format(ip_address, e))
+            country_code = None
+        if country_code is None:
+            result = unknown_country
+        else:
+            result = (country_code, country or country_code)
+            _country_names[country_code] = result[1]
+
+        _cache.put(ip_address, result)
+        return result
+
+def country_code(ip_address):
+    return lookup(ip_address)[0]
+
+def country_name(country_code):
+    """ The name of a country seen before, or the country code otherwise """
+    return _country_names.get(country_code, country_code)
+
+def get_cache_stats():
+    return _cache.stats()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,281 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Rendering of the graphs on the statistics page. The data for the graphs
+# is fetched from the database by the stats module; the rendering itself is
+# CPU bound and runs in a pool of worker processes, so it does not compete
+# with the reactor for the GIL. A graph is only rendered again when its data
+# has changed.
+
+import hashlib
+import logging
+import multiprocessing
+import os
+import os.path
+import signal
+import traceback
+
+from twisted.internet import defer, threads
+
+import matplotlib
+# Prevent errors from matplotlib instantiating a Tk window
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import matplotlib.dates as mdates
+import numpy
+
+import config
+
+_pool = None
+# graph filename -> hash of the data it was last rendered from
+_rendered = {}
+
+def humanize_number(number, pos):
+    """Return a humanized string representation of a number."""
+    abbrevs = (
+        (1E15, 'P'),
+        (1E12, 'T'),
+        (1E9, 'G'),
+        (1E6, 'M'),
+        (1E3, 'k'),
+        (1, '')
+    )
+    if number < 1000:
+        return str(number)
+    for factor, suffix in abbrevs:
+        if number >= factor:
+            break
+    return '%.*f%s' % (0, number / factor, suffix)
+
+def _trendline(x, y):
+    x_num = mdates.date2num(x)
+    z = numpy.polyfit(x_num, y, 1)
+    p = numpy.poly1d(z)
+    xx = numpy.linspace(x_num.min(), x_num.max(), 100)
+    return (mdates.num2date(xx), p(xx))
+
+def _no_data(fig):
+    fig.text(0.5, 0.5, "Not enough data", size="x-large",
+        ha="center", va="center")
+
+def render_hourly(data):
+    x, y = data["x"], data["y"]
+    trend_x, trend_y = _trendline(x, y)
+
+    fig = plt.figure()
+    ax = fig.gca()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
+    ax.xaxis.set_major_locator(mdates.HourLocator(interval=4))
+    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
+    ax.set_title("Reports per hour")
+    ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
+    ax.plot(trend_x, trend_y, "b--")
+    ax.set_ybound(lower=0)
+    fig.autofmt_xdate()
+    if data["no_data"]:
+        _no_data(fig)
+    return fig
+
+def render_monthly(data):
+    x, y = data["x"], data["y"]
+
+    fig = plt.figure()
+    ax = fig.gca()
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d %b'))
+    ax.xaxis.set_major_locator(mdates.DayLocator(interval=4))
+    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
+    ax.set_title("Reports per day")
+    ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
+    if not data["no_data"]:
+        trend_x, trend_y = _trendline(x, y)
+        ax.plot(trend_x, trend_y, "b--")
+    ax.set_ybound(lower=0)
+    fig.autofmt_xdate()
+    if data["no_data"]:
+        _no_data(fig)
+    return fig
+
+def _render_daily_series(data, title, trendline):
+    x, y = data["x"], data["y"]
+
+    fig = plt.figure()
+    ax = fig.gca()
+    locator = mdates.AutoDateLocator(interval_multiples=False)
+    ax.xaxis.set_major_locator(locator)
+    ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
+    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
+    ax.set_title(title)
+    if data["num_days"] < 100:
+        ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
+    else:
+        ax.plot(x,y, linestyle='solid', marker='')
+    if trendline and data["num_days"] > 0:
+        trend_x, trend_y = _trendline(x, y)
+        ax.plot(trend_x, trend_y, "b--")
+    ax.set_ybound(lower=0)
+    fig.autofmt_xdate()
+    if data["num_days"] == 0:
+        _no_data(fig)
+    return fig
+
+def render_history(data):
+    return _render_daily_series(data, "Reports per day", True)
+
+def render_contrib(data):
+    return _render_daily_series(data, "Number of contributors", False)
+
+def render_country_pie(data):
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+    ax.pie(data["sizes"], labels=data["labels"],
+            autopct='%1.1f%%', shadow=True, startangle=90)
+    # Set aspect ratio to be equal so that pie is drawn as a circle.
+    ax.axis('equal')
+    return fig
+
+def render_country_bar(data):
+    countries, counts = data["countries"], data["counts"]
+    total_reports = data["total_reports"]
+    max_count = max(counts)
+
+    fig = plt.figure()
+    ax = fig.add_subplot(111)
+
+    y_pos = numpy.arange(len(countries))
+    bars = ax.barh(y_pos, counts, align='center', alpha=0.6)
+    count = 0
+    for bar in bars:
+        height = bar.get_height()
+        ax.text(max_count / 20., bar.get_y() + height / 2.,
+            "{}% {}".format(round(counts[count]*1.0/total_reports*100), countries[count] ),
+            ha='left', va='center')
+        count += 1
+    ax.set_yticks(y_pos)
+    ax.set_yticklabels([])
+    ax.set_title('Number of attacks per country of origin (top {})'.format(data["limit"]))
+    ax.xaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
+    ax.set_ylim(ymin=-1)
+    fig.tight_layout()
+    if data["no_data"]:
+        _no_data(fig)
+    return fig
+
+# graph filename -> function rendering a figure from the graph data
+renderers = {
+    "hourly.svg": render_hourly,
+    "monthly.svg": render_monthly,
+    "history.svg": render_history,
+    "contrib.svg": render_contrib,
+    "country_pie.svg": render_country_pie,
+    "country_bar.svg": render_country_bar,
+}
+
+def render(filename, data, graph_dir):
+    """ Render a graph and write it to graph_dir. The file is written under
+    a temporary name first and then renamed, so the web server never serves
+    a partially written graph. Returns None on success or the formatted
+    exception. Runs in a worker process """
+    path = os.path.join(graph_dir, filename)
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    try:
+        fig = renderers[filename](data)
+        try:
+            fig.savefig(tmp_path, format=os.path.splitext(filename)[1][1:])
+        finally:
+            fig.clf()
+            plt.close(fig)
+        os.rename(tmp_path, path)
+        return None
+    except Exception:
+        try:
+            os.remove(tmp_path)
+        except Exception:
+            pass
+        return traceback.format_exc()
+
+def data_hash(data):
+    return hashlib.sha1(repr(sorted(data.items()))).hexdigest()
+
+def _init_worker():
+    # Workers are forked from the server process and inherit the signal
+    # handlers of the reactor, which would keep them from being terminated
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+def _get_pool():
+    global _pool
+    if _pool is None:
+        _pool = multiprocessing.Pool(processes=config.graph_processes,
+            initializer=_init_worker)
+    return _pool
+
+def _render_in_pool(filename, data, graph_dir):
+    # Wait for the result in a thread, so a worker that dies or hangs
+    # fails the Deferred instead of leaving it unfired
+    result = _get_pool().apply_async(render, (filename, data, graph_dir))
+    return threads.deferToThread(result.get, config.graph_timeout)
+
+def close():
+    """ Stop the worker processes """
+    global _pool
+    if _pool is not None:
+        _pool.terminate()
+        _pool = None
+
+@defer.inlineCallbacks
+def render_changed(graph_data):
+    """ Render the graphs whose data changed since they were last rendered.
+    graph_data is a dict of graph filename -> data, or None to leave the
+    graph alone. Returns a Deferred firing with the list of filenames
+    rendered """
+    jobs = []
+    for filename, data in sorted(graph_data.iteritems()):
+        if data is None:
+            continue
+        digest = data_hash(data)
+        path = os.path.join(config.graph_dir, filename)
+        if _rendered.get(filename) == digest and os.path.exists(path):
+            logging.debug("Graph {} unchanged, not rendering".format(filename))
+            continue
+        if config.graph_processes > 0:
+            d = _render_in_pool(filename, data, config.graph_dir)
+        else:
+            d = threads.deferToThread(render, filename, data, config.graph_dir)
+        jobs.append((filename, digest, d))
+
+    rendered = []
+    timed_out = False
+    for filename, digest, d in jobs:
+        try:
+            error = yield d
+        except multiprocessing.TimeoutError:
+            error = "timed out after {} seconds".format(config.graph_timeout)
+            timed_out = True
+        except Exception, e:
+            error = "{}: {}".format(e.__class__.__name__, e)
+        if error is None:
+            _rendered[filename] = digest
+            rendered.append(filename)
+        else:
+            _rendered.pop(filename, None)
+            logging.warning("Error rendering graph {}: {}".format(filename, error))
+    if timed_out:
+        # Replace the stuck worker processes
+        close()
+    defer.returnValue(rendered)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,337 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Open loop load generator, to benchmark a running server. Requests are
+# started at exponentially distributed intervals around the target rate,
+# whether or not earlier requests have finished, like independent clients
+# do. An overloaded server shows up as growing latencies and errors, not
+# as a lower request rate. Run as denyhosts-loadgen, see --help.
+
+from __future__ import print_function
+
+import argparse
+import bisect
+import json
+import math
+import random
+import sys
+import time
+import xmlrpclib
+
+from twisted.internet import defer, reactor, task
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import libnacl.public
+import libnacl.utils
+
+import utils
+
+methods = ("add_hosts", "get_new_hosts", "update_batch")
+
+# (threshold, resiliency) of get_new_hosts requests, with their weights.
+# Most clients use the defaults of DenyHosts
+_sync_settings = [((3, 18000), 6), ((1, 0), 2), ((5, 3600), 1), ((10, 86400), 1)]
+
+def _cumulative(weights):
+    total = 0.0
+    result = []
+    for weight in weights:
+        total += weight
+        result.append(total)
+    return result
+
+def _pick(rng, cumulative):
+    return bisect.bisect_right(cumulative, rng.random() * cumulative[-1])
+
+def random_ip_address(rng):
+    while True:
+        ip = ".".join(str(rng.randint(1, 254)) for _ in range(4))
+        if utils.is_valid_ip_address(ip):
+            return ip
+
+def parse_mix(mix):
+    """ Parse a request mix like "add_hosts=70,get_new_hosts=30" into a
+    list of (method, weight) tuples """
+    result = []
+    for item in mix.split(","):
+        name, sep, weight = item.partition("=")
+        name = name.strip()
+        if name not in methods:
+            raise ValueError("Unknown method {} in mix, use {}".format(name, ", ".join(methods)))
+        weight = float(weight) if sep else 1.0
+        if weight < 0:
+            raise ValueError("Negative weight for {}".format(name))
+        if weight > 0:
+            result.append((name, weight))
+    if len(result) == 0:
+        raise ValueError("Empty request mix")
+    return result
+
+def percentile(values, p):
+    """ The p-th percentile (nearest rank) of the sorted list values """
+    if len(values) == 0:
+        return None
+    return values[max(0, int(math.ceil(p / 100.0 * len(values))) - 1)]
+
+class Workload(object):
+    """
+    Seeded source of request arguments. The reporting clients and the
+    crackers are fixed pools of addresses, of which a few are much more
+    active than the rest (Zipf distributed), like on a real server. A
+    fraction of the reported crackers are new addresses.
+    """
+
+    def __init__(self, rng, num_clients=1000, num_crackers=20000, new_fraction=0.2,
+            max_hosts=10):
+        self.rng = rng
+        self.new_fraction = new_fraction
+        self.max_hosts = max_hosts
+        self.clients = [random_ip_address(rng) for i in xrange(num_clients)]
+        self.crackers = [random_ip_address(rng) for i in xrange(num_crackers)]
+        self._client_weights = _cumulative(1.0 / (i + 1) for i in xrange(num_clients))
+        self._cracker_weights = _cumulative(1.0 / (i + 1)**1.2 for i in xrange(num_crackers))
+        self._sync_weights = _cumulative(weight for settings, weight in _sync_settings)
+
+    def client(self):
+        return self.clients[_pick(self.rng, self._client_weights)]
+
+    def cracker(self):
+        if self.rng.random() < self.new_fraction:
+            return random_ip_address(self.rng)
+        return self.crackers[_pick(self.rng, self._cracker_weights)]
+
+    def hosts(self):
+        """ Hosts of one report: mostly one, sometimes a few """
+        count = min(int(self.rng.paretovariate(2.0)), self.max_hosts)
+        return list(set(self.cracker() for i in xrange(count)))
+
+    def sync_settings(self):
+        return _sync_settings[_pick(self.rng, self._sync_weights)][0]
+
+class Results(object):
+    """ Latencies and errors of the requests, per method """
+
+    def __init__(self):
+        self.latencies = { method: [] for method in methods }
+        self.errors = { method: {} for method in methods }
+        self.lags = []
+        self.sent = 0
+        self.skipped = 0
+
+    def record(self, method, latency, error=None):
+        if error is None:
+            self.latencies[method].append(latency)
+        else:
+            self.errors[method][error] = self.errors[method].get(error, 0) + 1
+
+    def report(self, target_rate, duration, elapsed):
+        result = {
+            "target_rate": target_rate,
+            "duration": duration,
+            "elapsed": round(elapsed, 3),
+            "sent": self.sent,
+            "skipped": self.skipped,
+            "methods": {},
+        }
+        completed = 0
+        failed = 0
+        for method in methods:
+            latencies = sorted(self.latencies[method])
+            errors = sum(self.errors[method].itervalues())
+            count = len(latencies) + errors
+            if count == 0:
+                continue
+            completed += len(latencies)
+            failed += errors
+            result["methods"][method] = {
+                "requests": count,
+                "errors": dict(self.errors[method]),
+                "error_rate": round(float(errors) / count, 4),
+                "throughput": round(len(latencies) / elapsed, 2),
+                "latency": {
+                    "p50": percentile(latencies, 50),
+                    "p95": percentile(latencies, 95),
+                    "p99": percentile(latencies, 99),
+                    "mean": sum(latencies) / len(latencies) if latencies else None,
+                    "max": latencies[-1] if latencies else None,
+                },
+            }
+        result["completed"] = completed
+        result["failed"] = failed
+        result["throughput"] = round(completed / elapsed, 2)
+        result["error_rate"] = round(float(failed) / max(completed + failed, 1), 4)
+        # How late requests were started; if this grows, the load generator
+        # itself cannot keep up with the target rate
+        lags = sorted(self.lags)
+        result["schedule_lag"] = {"p50": percentile(lags, 50), "p99": percentile(lags, 99)}
+        return result
+
+def _error_kind(failure):
+    if failure.check(xmlrpclib.Fault):
+        return "fault {}".format(failure.value.faultCode)
+    if failure.check(defer.CancelledError):
+        return "timeout"
+    return failure.type.__name__
+
+class LoadGenerator(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self._mix_weights = _cumulative(weight for method, weight in self.mix)
+        # Separate random streams, so the workload does not depend on the
+        # timing of the requests
+        self.schedule_rng = random.Random(args.seed)
+        self.mix_rng = random.Random(args.seed + 1)
+        self.workload = Workload(random.Random(args.seed + 2), args.clients, args.crackers,
+            args.new_fraction, args.max_hosts)
+        self.results = Results()
+        self.box = None
+        if any(method == "update_batch" for method, weight in self.mix):
+            own_key = libnacl.utils.load_key(args.peer_key)
+            self.own_key = own_key.pk.encode("hex")
+            self.box = libnacl.public.Box(own_key.sk,
+                libnacl.public.PublicKey(args.server_key.decode("hex")))
+
+    def call(self, method, *args, **kwargs):
+        kwargs["timeout"] = self.args.timeout
+        return utils.xmlrpc_call(self.args.url, method, *args, **kwargs)
+
+    def request_add_hosts(self):
+        return self.call("add_hosts", self.workload.hosts(),
+            headers={"X-Real-IP": self.workload.client()})
+
+    def request_get_new_hosts(self):
+        threshold, resiliency = self.workload.sync_settings()
+        # Clients sync every few minutes up to an hour
+        timestamp = int(time.time() - self.workload.rng.uniform(60, 3600))
+        return self.call("get_new_hosts", timestamp, threshold, self.workload.hosts(),
+            resiliency, headers={"X-Real-IP": self.workload.client()})
+
+    def request_update_batch(self):
+        now = time.time()
+        updates = [{
+                "client_ip": self.workload.client(),
+                "timestamp": now,
+                "hosts": self.workload.hosts(),
+            } for i in xrange(self.args.batch_size)]
+        data = self.box.encrypt(json.dumps({ "updates": updates })).encode("base64")
+        return self.call("peering.update_batch", self.own_key, data)
+
+    def start_request(self):
+        method = self.mix[_pick(self.mix_rng, self._mix_weights)][0]
+        start = time.time()
+        d = getattr(self, "request_" + method)()
+        def done(result):
+            self.results.record(method, time.time() - start)
+        def failed(failure):
+            self.results.record(method, time.time() - start, _error_kind(failure))
+        return d.addCallbacks(done, failed)
+
+    @inlineCallbacks
+    def run(self):
+        """ Send requests for args.duration seconds, then wait for the
+        requests in progress. Returns the report, as a dict """
+        pending = set()
+        start = time.time()
+        offset = 0.0
+        while True:
+            offset += self.schedule_rng.expovariate(self.args.rate)
+            if offset >= self.args.duration:
+                break
+            delay = start + offset - time.time()
+            # Also when behind schedule, let the reactor send the requests
+            yield task.deferLater(reactor, max(delay, 0), lambda: None)
+            self.results.lags.append(max(time.time() - start - offset, 0.0))
+            if len(pending) >= self.args.max_in_flight:
+                self.results.skipped += 1
+                continue
+            self.results.sent += 1
+            d = self.start_request()
+            pending.add(d)
+            d.addBoth(lambda result, d=d: pending.discard(d))
+        yield defer.DeferredList(list(pending))
+        elapsed = time.time() - start
+        yield utils.close_http_connections()
+        returnValue(self.results.report(self.args.rate, self.args.duration, elapsed))
+
+def argument_parser():
+    parser = argparse.ArgumentParser(description="Load generator for denyhosts-server. "
+        "Sends requests at a target rate and reports the latencies, throughput and "
+        "error rates as JSON")
+    parser.add_argument("--url", default="http://localhost:9911",
+        help="URL of the server (default: http://localhost:9911)")
+    parser.add_argument("-r", "--rate", type=float, default=100.0,
+        help="Target number of requests per second (default: 100)")
+    parser.add_argument("-d", "--duration", type=float, default=60.0,
+        help="Number of seconds to send requests (default: 60)")
+    parser.add_argument("--mix", default="add_hosts=70,get_new_hosts=30",
+        help="Relative weights of the request types, from {} "
+        "(default: add_hosts=70,get_new_hosts=30)".format(", ".join(methods)))
+    parser.add_argument("--seed", type=int, default=1,
+        help="Random seed of the workload (default: 1)")
+    parser.add_argument("--clients", type=int, default=1000,
+        help="Number of reporting clients (default: 1000)")
+    parser.add_argument("--crackers", type=int, default=20000,
+        help="Number of known crackers that are reported (default: 20000)")
+    parser.add_argument("--new-fraction", type=float, default=0.2,
+        help="Fraction of the reported hosts that are new addresses (default: 0.2)")
+    parser.add_argument("--max-hosts", type=int, default=10,
+        help="Maximum number of hosts per report (default: 10)")
+    parser.add_argument("--batch-size", type=int, default=10,
+        help="Number of updates per update_batch request (default: 10)")
+    parser.add_argument("--peer-key", metavar="KEY_FILE",
+        help="Key file of a peer of the server, for update_batch requests")
+    parser.add_argument("--server-key", metavar="HEX",
+        help="Public key of the server, for update_batch requests")
+    parser.add_argument("--timeout", type=float, default=30.0,
+        help="Timeout of a request in seconds (default: 30)")
+    parser.add_argument("--max-in-flight", type=int, default=1000,
+        help="Maximum number of requests in progress; requests beyond this "
+        "are skipped and counted (default: 1000)")
+    parser.add_argument("--connections", type=int, default=100,
+        help="Number of idle connections to keep open (default: 100)")
+    parser.add_argument("-o", "--output", metavar="FILE",
+        help="Write the report to FILE instead of standard output")
+    return parser
+
+def _run(reactor, args):
+    utils.max_persistent_connections = args.connections
+    d = LoadGenerator(args).run()
+    def write_report(report):
+        text = json.dumps(report, indent=2, sort_keys=True)
+        if args.output:
+            with open(args.output, "w") as f:
+                f.write(text + "\n")
+        else:
+            print(text)
+    return d.addCallback(write_report)
+
+def run_main():
+    parser = argument_parser()
+    args = parser.parse_args()
+    try:
+        mix = parse_mix(args.mix)
+    except ValueError, e:
+        parser.error(str(e))
+    if args.rate <= 0:
+        parser.error("--rate must be positive")
+    if any(method == "update_batch" for method, weight in mix) and not (
+            args.peer_key and args.server_key):
+        parser.error("update_batch requests need --peer-key and --server-key")
+    task.react(_run, [args])
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
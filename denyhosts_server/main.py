@@ -21,7 +21,6 @@ import sys
 import ConfigParser
 
 from twisted.web import server, resource, static
-from twisted.enterprise import adbapi
 from twisted.internet import task, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
@@ -34,7 +33,13 @@ import peering_views
 import models
 import controllers
 import config
+import cracker_cache
+import cracker_index
 import database
+import geo
+import graphs
+import metrics
+import resolver
 import stats
 import utils
 import peering
@@ -57,6 +62,13 @@ def sighup_handler(signum, frame):
 
     configure_logging()
     schedule_jobs()
+    cracker_index.configure().addErrback(
+        lambda f: logging.error("Error loading cracker index: {}".format(f.getErrorMessage())))
+    cracker_cache.configure().addErrback(
+        lambda f: logging.error("Error loading cracker cache: {}".format(f.getErrorMessage())))
+    controllers.configure_new_hosts_cache()
+    geo.configure()
+    resolver.configure()
 
     if debug_was_on and not config.enable_debug_methods:
         # Remove debug methods
@@ -87,7 +99,15 @@ def shutdown():
             logging.debug("Waiting, {} sessions still active".format(len(site.sessions)))
             yield task.deferLater(reactor, 1, lambda _:0, 0)
 
-        logging.info("No more sessions, waiting for locked hosts...")
+        logging.info("No more sessions, storing queued reports...")
+        yield controllers.flush_reports()
+
+        logging.info("Sending queued updates to peers...")
+        yield peering.flush_updates(10)
+        resolver.close()
+        graphs.close()
+
+        logging.info("Waiting for locked hosts...")
         while not utils.none_waiting():
             logging.info("Waiting to shut down, {} hosts still blocked".format(utils.count_waiting()))
             yield task.deferLater(reactor, 1, lambda _:0, 0)
@@ -166,6 +186,10 @@ def start_listening():
         d = debug_views.DebugServer(main_xmlrpc_handler)
         main_xmlrpc_handler.putSubHandler('debug', d)
 
+    # /metrics
+    if config.enable_metrics:
+        xmlrpc_root.putChild('metrics', metrics.MetricsResource())
+
     # /static
     stats_root.putChild('static', web_static)
     # /static/graphs
@@ -240,6 +264,8 @@ def run_main():
         help="Check if all peers are responsive, and if they agree about the peer list")
     parser.add_argument("--bootstrap-from-peer", action="store", metavar="PEER_URL",
         help="First wipe database and then bootstrap database from peer. DO NOT USE WHEN DENYHOSTS-SERVER IS RUNNING!")
+    parser.add_argument("--resume-bootstrap", action="store_true",
+        help="With --bootstrap-from-peer, do not wipe the database but continue an interrupted bootstrap")
     parser.add_argument("-f", "--force", action='store_true',
         help="Do not ask for confirmation, execute action immediately")
     args = parser.parse_args()
@@ -254,10 +280,12 @@ def run_main():
         sys.exit()
 
     configure_logging()
+    geo.configure()
+    resolver.configure()
 
     peering.load_keys()
 
-    Registry.DBPOOL = adbapi.ConnectionPool(config.dbtype, **config.dbparams)
+    database.connect()
     Registry.register(models.Cracker, models.Report, models.Legacy)
 
     single_shot = False
@@ -290,7 +318,7 @@ def run_main():
 
     if args.bootstrap_from_peer:
         single_shot = True
-        peering.bootstrap_from(args.bootstrap_from_peer).addCallbacks(stop_reactor, stop_reactor)
+        peering.bootstrap_from(args.bootstrap_from_peer, args.resume_bootstrap).addCallbacks(stop_reactor, stop_reactor)
 
     if args.purge_legacy_addresses:
         single_shot = True
@@ -307,6 +335,10 @@ def run_main():
     if not single_shot:
         signal.signal(signal.SIGHUP, sighup_handler)
         reactor.addSystemEventTrigger("after", "startup", database.check_database_version)
+        reactor.addSystemEventTrigger("after", "startup", cracker_index.configure)
+        reactor.addSystemEventTrigger("after", "startup", cracker_cache.configure)
+        reactor.addSystemEventTrigger("after", "startup", controllers.load_legacy_snapshot)
+        controllers.configure_new_hosts_cache()
         reactor.addSystemEventTrigger("before", "shutdown", shutdown)
 
         start_listening()
@@ -0,0 +1,236 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Metrics of the server, served in the Prometheus text format on /metrics.
+# All metrics are updated from the reactor thread only.
+
+import time
+
+from twisted.internet import defer
+from twisted.python import failure
+from twisted.web.resource import Resource
+
+# Default histogram buckets, in seconds
+duration_buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 60.0)
+
+# All metrics, in order of registration
+_metrics = []
+# Functions returning extra lines of exposition text
+_collectors = []
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, _escape(value)) for name, value in pairs) + "}"
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        _metrics.append(self)
+
+    def _key(self, labels):
+        return tuple(labels.get(name, "") for name in self.labelnames)
+
+    def samples(self):
+        """ List of (suffix, label values, extra labels, value) tuples """
+        return [("", key, (), value) for key, value in sorted(self._values.iteritems())]
+
+    def expose(self):
+        return exposition_lines(self.name, self.kind, self.help, self.samples(),
+            self.labelnames)
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+class Gauge(_Metric):
+    """ Gauge that is either set explicitly, or evaluates function when
+    the metrics are collected """
+    kind = "gauge"
+
+    def __init__(self, name, help, labelnames=(), function=None):
+        _Metric.__init__(self, name, help, labelnames)
+        self.function = function
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.function is not None:
+            return [("", (), (), self.function())]
+        return _Metric.samples(self)
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=duration_buckets):
+        _Metric.__init__(self, name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # Per bucket counts (not cumulative), then the sum
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        counts[i] += 1
+        counts[-1] += value
+
+    def samples(self):
+        return histogram_samples(self.buckets,
+            [(key, counts[:-1], counts[-1]) for key, counts in sorted(self._values.iteritems())])
+
+    def time(self, d, **labels):
+        """ Observe the time until Deferred d fires. Returns d """
+        start = time.time()
+        def observe(result):
+            self.observe(time.time() - start, **labels)
+            return result
+        return d.addBoth(observe)
+
+def histogram_samples(buckets, series):
+    """ Samples for a histogram with the given upper bucket bounds, from a
+    list of (label values, per bucket counts, sum) tuples. The counts
+    have an extra last bucket for the values above the last bound """
+    samples = []
+    for key, counts, total in series:
+        cumulative = 0
+        for bound, count in zip(tuple(buckets) + (float("inf"),), counts):
+            cumulative += count
+            samples.append(("_bucket", key, (("le", _format_value(bound)),), cumulative))
+        samples.append(("_sum", key, (), total))
+        samples.append(("_count", key, (), cumulative))
+    return samples
+
+def add_collector(collector):
+    """ Add a function returning a list of lines to expose, for metrics
+    kept elsewhere """
+    _collectors.append(collector)
+
+def expose():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.expose())
+    for collector in _collectors:
+        lines.extend(collector())
+    return "\n".join(lines) + "\n"
+
+def exposition_lines(name, kind, help, samples, labelnames=()):
+    """ Exposition lines for metrics kept elsewhere, see histogram_samples
+    for the format of samples """
+    lines = [
+        "# HELP {} {}".format(name, help),
+        "# TYPE {} {}".format(name, kind),
+    ]
+    for suffix, key, extra, value in samples:
+        lines.append("{}{}{} {}".format(name, suffix,
+            _format_labels(labelnames, key, extra), _format_value(value)))
+    return lines
+
+# Metrics of the server
+
+xmlrpc_duration = Histogram("denyhosts_xmlrpc_request_duration_seconds",
+    "Time to handle XML-RPC requests", ["method"])
+xmlrpc_errors = Counter("denyhosts_xmlrpc_errors_total",
+    "Number of XML-RPC requests that returned a fault", ["method"])
+
+db_query_duration = Histogram("denyhosts_db_query_duration_seconds",
+    "Time of database queries, including waiting for a connection", ["kind"])
+db_queries_in_progress = Gauge("denyhosts_db_queries_in_progress",
+    "Number of database queries started but not finished")
+
+cracker_cache_lookups = Counter("denyhosts_cracker_cache_lookups_total",
+    "Crackers looked up in the cache while storing reports, by result", ["result"])
+cracker_cache_stale = Counter("denyhosts_cracker_cache_stale_total",
+    "Number of report batches stored again because the cracker cache was out of date")
+
+job_duration = Histogram("denyhosts_job_duration_seconds",
+    "Duration of periodic jobs", ["job"],
+    buckets=(0.1, 1.0, 10.0, 60.0, 300.0, 1800.0, 3600.0))
+job_items = Counter("denyhosts_job_items_total",
+    "Number of items processed by periodic jobs", ["job", "item"])
+job_last_run = Gauge("denyhosts_job_last_run_timestamp_seconds",
+    "Time the periodic jobs last finished", ["job"])
+
+def timed_job(job):
+    """ Decorator for functions returning a Deferred, recording their
+    duration and finishing time as job """
+    def decorator(f):
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            def done(result):
+                now = time.time()
+                job_duration.observe(now - start, job=job)
+                job_last_run.set(now, job=job)
+                return result
+            return defer.maybeDeferred(f, *args, **kwargs).addBoth(done)
+        wrapper.__name__ = f.__name__
+        wrapper.__doc__ = f.__doc__
+        return wrapper
+    return decorator
+
+def timed_procedure(method, function):
+    """ Wrap an XML-RPC procedure to record its duration and faults """
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        def done(result):
+            xmlrpc_duration.observe(time.time() - start, method=method)
+            if isinstance(result, failure.Failure):
+                xmlrpc_errors.inc(method=method)
+            return result
+        return defer.maybeDeferred(function, *args, **kwargs).addBoth(done)
+    wrapper.withRequest = getattr(function, "withRequest", False)
+    wrapper.__name__ = getattr(function, "__name__", method)
+    wrapper.__doc__ = getattr(function, "__doc__", None)
+    wrapper.signature = getattr(function, "signature", None)
+    wrapper.help = getattr(function, "help", None)
+    return wrapper
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return expose()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
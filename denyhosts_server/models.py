@@ -18,22 +18,44 @@ import logging
 
 from twistar.dbobject import DBObject
 
-class Cracker(DBObject):
+import database
+import geo
+
+class _PackedIPAddress(object):
+    """ Mixin for models with an ip_address column. The address is a string
+    in the model, and stored in binary form, see database.ip_param() """
+
+    def afterInit(self):
+        self.ip_address = database.ip_value(getattr(self, "ip_address", None))
+
+    def refresh(self):
+        return DBObject.refresh(self).addCallback(lambda _: self.afterInit())
+
+    def toHash(self, cols, includeBlank=False, exclude=None, base=None):
+        h = DBObject.toHash(self, cols, includeBlank, exclude, base)
+        if h.get("ip_address") is not None:
+            h["ip_address"] = database.ip_param(h["ip_address"])
+        return h
+
+class Cracker(_PackedIPAddress, DBObject):
     HASMANY=['reports']
-    column_names=['ip_address','first_time', 'latest_time', 'resiliency', 'total_reports', 'current_reports']
+    column_names=['ip_address','first_time', 'latest_time', 'resiliency', 'total_reports', 'current_reports', 'country_code']
+
+    def beforeCreate(self):
+        if getattr(self, "country_code", None) is None:
+            self.country_code = geo.country_code(self.ip_address)
 
     def __str__(self):
         return "Cracker({},{},{},{},{},{})".format(self.id,self.ip_address,self.first_time,self.latest_time,self.resiliency,self.total_reports,self.current_reports)
 
-class Report(DBObject):
+class Report(_PackedIPAddress, DBObject):
     BELONGSTO=['cracker']
     column_names=['ip_address','first_report_time', 'latest_report_time']
 
     def __str__(self):
         return "Report({},{},{},{})".format(self.id,self.ip_address,self.first_report_time,self.latest_report_time)
 
-class Legacy(DBObject):
+class Legacy(_PackedIPAddress, DBObject):
     TABLENAME="legacy"
-    pass
 
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -15,15 +15,18 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import print_function
+import collections
 import logging
 import json
 import os.path
 import sys
+import time
 import xmlrpclib
 from xmlrpclib import ServerProxy
+import zlib
 
+from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.threads  import deferToThread
 
 import libnacl.public
 import libnacl.utils
@@ -33,28 +36,174 @@ import config
 import controllers
 import database
 from models import Cracker, Report
+import summary
 import utils
 
 _own_key = None
+_peer_boxes = {}
+
+# Version of the peering protocol implemented by this server, reported by
+# list_peers. Version 2 adds update_batch; peers that do not report a
+# version only know update. Version 3 adds dump_chunk.
+peering_version = 3
+
+# Updates for peers are queued and delivered in the background, so a slow
+# or unreachable peer does not delay the clients. Per peer, queued updates
+# are sent in batches of at most update_batch_size updates, in order; peers
+# are served concurrently.
+# peer url -> deque of update dicts
+_update_queues = {}
+# peer url -> Deferred of the running delivery loop
+_delivering = {}
+# peer url -> DelayedCall to start delivery after update_batch_delay, or
+# after failing to get the peering version of the peer
+_delivery_calls = {}
+# peer url -> peering protocol version of the peer
+_peer_versions = {}
+# peer url -> number of consecutive failures to get the peering version
+_version_failures = {}
+# Delay (in seconds) before the first retry of a failed update, doubled
+# for every next retry
+_retry_delay = 1.0
+# Maximum delay (in seconds) before asking a peer for its version again
+_max_version_retry_delay = 300.0
+_updates_dropped = 0
 
-@inlineCallbacks
 def send_update(client_ip, timestamp, hosts):
+    """ Queue an update for all peers """
+    update = {
+        "client_ip": client_ip,
+        "timestamp": timestamp,
+        "hosts": hosts
+    }
     for peer in config.peers:
-        logging.debug("Sending update to peer {}".format(peer))
-        data = {
-            "client_ip": client_ip,
-            "timestamp": timestamp,
-            "hosts": hosts
-        }
-        data_json = json.dumps(data)
-        crypted = _peer_boxes[peer].encrypt(data_json)
-        base64 = crypted.encode('base64')
+        _queue_update(peer, update)
+
+def _queue_update(peer, update):
+    global _updates_dropped
+    queue = _update_queues.setdefault(peer, collections.deque())
+    queue.append(update)
+    if len(queue) > config.update_queue_size:
+        queue.popleft()
+        _updates_dropped += 1
+        logging.warning("Update queue for peer {} full, dropping oldest update".format(peer))
+
+    if peer in _delivering:
+        # Will be sent in the next batch
+        return
+    if _version_failures.get(peer, 0) > 0:
+        # Will be sent when the peer is asked for its version again
+        return
+    if len(queue) >= config.update_batch_size or config.update_batch_delay <= 0:
+        _start_delivery(peer)
+    elif peer not in _delivery_calls:
+        _delivery_calls[peer] = reactor.callLater(config.update_batch_delay,
+            _start_delivery, peer)
+
+def _start_delivery(peer):
+    call = _delivery_calls.pop(peer, None)
+    if call is not None and call.active():
+        call.cancel()
+    if peer in _delivering:
+        return
+    d = _deliver_updates(peer)
+    if not d.called:
+        _delivering[peer] = d
+
+def _encrypt(peer, data):
+    return _peer_boxes[peer].encrypt(data).encode('base64')
+
+@inlineCallbacks
+def _get_peer_version(peer):
+    """ Returns the peering protocol version of the peer, or None if it
+    could not be asked """
+    if peer not in _peer_versions:
+        try:
+            response = yield utils.xmlrpc_call(peer, "peering.list_peers",
+                _own_key.pk.encode('hex'), _encrypt(peer, "please"),
+                timeout=config.update_timeout)
+            _peer_versions[peer] = response.get("peering_version", 1)
+            _version_failures.pop(peer, None)
+            logging.info("Peer {} uses peering version {}".format(peer, _peer_versions[peer]))
+        except Exception, e:
+            failures = _version_failures.get(peer, 0) + 1
+            _version_failures[peer] = failures
+            delay = min(_retry_delay * 2**(failures - 1), _max_version_retry_delay)
+            logging.warning("Unable to get peering version of peer {}, trying again in {} seconds: {}".format(
+                peer, delay, e))
+            _delivery_calls[peer] = reactor.callLater(delay, _start_delivery, peer)
+            returnValue(None)
+    returnValue(_peer_versions[peer])
 
+@inlineCallbacks
+def _call_with_retries(peer, method, *args):
+    """ Returns whether the call succeeded """
+    attempt = 0
+    while True:
         try:
-            server = yield deferToThread(ServerProxy, peer)
-            yield deferToThread(server.peering.update, _own_key.pk.encode('hex'), base64)
-        except:
-            logging.warning("Unable to send update to peer {}".format(peer))
+            yield utils.xmlrpc_call(peer, method, *args, timeout=config.update_timeout)
+            returnValue(True)
+        except Exception, e:
+            if attempt >= config.update_retries:
+                logging.warning("Unable to send update to peer {}: {}".format(peer, e))
+                returnValue(False)
+            logging.debug("Error sending update to peer {}, retrying: {}".format(peer, e))
+            yield task.deferLater(reactor, _retry_delay * 2**attempt, lambda: None)
+            attempt += 1
+
+@inlineCallbacks
+def _deliver_updates(peer):
+    global _updates_dropped
+    queue = _update_queues[peer]
+    own_key = _own_key.pk.encode('hex')
+    try:
+        while len(queue) > 0:
+            version = yield _get_peer_version(peer)
+            if version is None:
+                # Keep the updates queued until the next delivery
+                break
+            batch = [queue.popleft() for i in range(min(len(queue), config.update_batch_size))]
+            logging.debug("Sending {} updates to peer {}".format(len(batch), peer))
+            if version >= 2:
+                data = json.dumps({ "updates": batch })
+                success = yield _call_with_retries(peer, "peering.update_batch",
+                    own_key, _encrypt(peer, data))
+                if not success:
+                    _updates_dropped += len(batch)
+            else:
+                for update in batch:
+                    success = yield _call_with_retries(peer, "peering.update",
+                        own_key, _encrypt(peer, json.dumps(update)))
+                    if not success:
+                        _updates_dropped += 1
+    finally:
+        _delivering.pop(peer, None)
+
+def get_update_queue_stats():
+    return {
+        "queued": { peer: len(queue) for peer, queue in _update_queues.iteritems() },
+        "dropped": _updates_dropped,
+    }
+
+@inlineCallbacks
+def flush_updates(timeout):
+    """ Wait until all queued updates have been sent, for at most timeout
+    seconds. Then stop delivering and close the connections to the peers.
+    Updates still queued are sent when the next update is queued """
+    deadline = time.time() + timeout
+    for peer, queue in _update_queues.items():
+        if len(queue) > 0:
+            _start_delivery(peer)
+    while len(_delivering) > 0 and time.time() < deadline:
+        logging.debug("Waiting for updates to peers, {} queued".format(
+            sum(len(queue) for queue in _update_queues.itervalues())))
+        yield task.deferLater(reactor, 0.1, lambda: None)
+    for call in _delivery_calls.values():
+        if call.active():
+            call.cancel()
+    _delivery_calls.clear()
+    _version_failures.clear()
+    yield utils.close_http_connections()
 
 def decrypt_message(peer_key, message):
     peer = None
@@ -81,6 +230,26 @@ def handle_update(peer_key, update):
 
     yield controllers.handle_report_from_client(client_ip, timestamp, hosts)
 
+@inlineCallbacks
+def handle_update_batch(peer_key, update_batch):
+    json_data = decrypt_message(peer_key, update_batch)
+    data = json.loads(json_data)
+
+    records = []
+    for update in data["updates"]:
+        hosts, invalid = utils.split_valid_ip_addresses(update["hosts"])
+        for host in invalid:
+            logging.warning("Illegal host ip address {} in update from peer".format(host))
+        try:
+            client_ip = controllers.check_report_source(update["client_ip"], update["timestamp"])
+        except ValueError, e:
+            logging.warning("Skipping illegal update from peer: {}".format(e))
+            continue
+        records.append((client_ip, update["timestamp"], hosts))
+
+    logging.debug("Storing batch of {} updates from peer".format(len(records)))
+    yield controllers.queue_reports(records)
+
 @inlineCallbacks
 def handle_schema_version(peer_key, please):
     data = decrypt_message(peer_key, please)
@@ -143,6 +312,30 @@ def handle_dump_table(peer_key, table):
 
     returnValue(rows)
 
+# Maximum number of rows returned by dump_chunk
+_dump_chunk_limit = 10000
+# Number of rows requested per dump_chunk call when bootstrapping
+_bootstrap_chunk_size = 5000
+
+@inlineCallbacks
+def handle_dump_chunk(peer_key, request):
+    request = json.loads(decrypt_message(peer_key, request))
+
+    table = request["table"]
+    if table not in dict(database.bootstrap_tables):
+        logging.warning("Illegal table for dump_chunk: {}".format(table))
+        raise Exception("Illegal request {}".format(table))
+    limit = min(int(request["limit"]), _dump_chunk_limit)
+
+    rows, cursor = yield database.dump_chunk(table, int(request["cursor"]), limit)
+    logging.debug("Sending {} rows of table {} to peer".format(len(rows), table))
+
+    returnValue({
+        "count": len(rows),
+        "cursor": cursor,
+        "rows": xmlrpclib.Binary(zlib.compress(json.dumps(rows))),
+    })
+
 def list_peers(peer_key, please):
     data = decrypt_message(peer_key, please)
 
@@ -152,6 +345,7 @@ def list_peers(peer_key, please):
 
     return {
             "server_version": __init__.version,
+            "peering_version": peering_version,
             "peers": {
                 peer: config.peers[peer].encode('hex') 
                 for peer in config.peers
@@ -159,15 +353,47 @@ def list_peers(peer_key, please):
     }
 
 @inlineCallbacks
-def bootstrap_from(peer_url):
-    crypted = _peer_boxes[peer_url].encrypt("please")
-    please_base64 = crypted.encode('base64')
+def _bootstrap_table(peer_url, table, resume):
+    if resume:
+        cursor = yield database.get_bootstrap_cursor(table)
+    else:
+        cursor = 0
+
+    print("Copying {} table from peer".format(table), end="")
+    sys.stdout.flush()
+    count = 0
+    while True:
+        request = json.dumps({
+            "table": table,
+            "cursor": cursor,
+            "limit": _bootstrap_chunk_size
+        })
+        response = yield utils.xmlrpc_call(peer_url, "peering.dump_chunk",
+            _own_key.pk.encode('hex'), _encrypt(peer_url, request), timeout=600)
+        if response["count"] == 0:
+            break
+        rows = json.loads(zlib.decompress(response["rows"].data))
+        count += yield database.bootstrap_rows(table, rows)
+        cursor = response["cursor"]
+        logging.debug("Copied {} rows of table {}".format(count, table))
+        print(".", end="")
+        sys.stdout.flush()
+    print(" {} rows".format(count))
+
+@inlineCallbacks
+def bootstrap_from(peer_url, resume=False):
+    own_key = _own_key.pk.encode('hex')
+    response = yield utils.xmlrpc_call(peer_url, "peering.list_peers",
+        own_key, _encrypt(peer_url, "please"))
+    if response.get("peering_version", 1) < 3:
+        raise Exception("Unable to bootstrap from {}: peer runs denyhosts-server version {}, please upgrade it first".format(peer_url, response["server_version"]))
 
-    server = yield deferToThread(ServerProxy, peer_url)
-    remote_schema = yield server.peering.schema_version(_own_key.pk.encode('hex'), please_base64)
+    remote_schema = yield utils.xmlrpc_call(peer_url, "peering.schema_version",
+        own_key, _encrypt(peer_url, "please"))
 
-    print("Initializing database...")
-    yield database.clean_database()
+    if not resume:
+        print("Initializing database...")
+        yield database.clean_database()
 
     local_schema = yield database.get_schema_version()
 
@@ -176,37 +402,15 @@ def bootstrap_from(peer_url):
 
     logging.debug("Remote database schema: {}; local schema: {}".format(remote_schema, local_schema))
 
-    hosts = yield deferToThread(server.peering.all_hosts, _own_key.pk.encode('hex'), please_base64)
-
-    #logging.debug("Hosts from peer: {}".format(hosts))
-    print("Copying data of {} hosts from peer".format(len(hosts)), end="")
-
-    count = 0
-    for host in hosts:
-        if count%100 == 0:
-            print(".", end="")
-            sys.stdout.flush()
-        count += 1
-        yield database.bootstrap_cracker(host)
-
-        host_ip = host[1]
-
-        crypted = _peer_boxes[peer_url].encrypt(host_ip)
-        base64 = crypted.encode('base64')
-        response = yield deferToThread(server.peering.all_reports_for_host, _own_key.pk.encode('hex'), base64)
-        #logging.debug("All reports response: {}".format(response))
-
-        for r in response:
-            database.bootstrap_report(r)
-    print(" Done")
-
-    for table in [ "info", "legacy", "history", "country_history" ]:
-        print("Copying {} table from peer...".format(table))
-        crypted = _peer_boxes[peer_url].encrypt(table)
-        base64 = crypted.encode('base64')
-        rows = yield deferToThread(server.peering.dump_table, _own_key.pk.encode('hex'), base64)
-        for row in rows:
-            database.bootstrap_table(table, row)
+    try:
+        for table, order in database.bootstrap_tables:
+            yield _bootstrap_table(peer_url, table, resume)
+        yield summary.recount()
+    except:
+        print("\nBootstrap failed. Use --bootstrap-from-peer with --resume-bootstrap to continue where it stopped.")
+        raise
+    finally:
+        yield utils.close_http_connections()
 
 def load_keys():
     global _own_key
@@ -54,6 +54,21 @@ class PeeringServer(xmlrpc.XMLRPC):
             raise xmlrpc.Fault(105, "Error in update({},{})".format(key, update))
         returnValue(0)
 
+    @withRequest
+    @inlineCallbacks
+    def xmlrpc_update_batch(self, request, key, update_batch):
+        try:
+            logging.info("update_batch({}, {} bytes)".format(key, len(update_batch)))
+            key = key.decode('hex')
+            update_batch = update_batch.decode('base64')
+            yield peering.handle_update_batch(key, update_batch)
+        except xmlrpc.Fault, e:
+            raise e
+        except Exception, e:
+            log.err(_why="Exception in update_batch")
+            raise xmlrpc.Fault(105, "Error in update_batch({})".format(key.encode('hex')))
+        returnValue(0)
+
     @withRequest
     @inlineCallbacks
     def xmlrpc_schema_version(self, request, key, please):
@@ -114,6 +129,21 @@ class PeeringServer(xmlrpc.XMLRPC):
             log.err(_why="Exception in dump_table")
             raise xmlrpc.Fault(106, "Error in dump_table({},{})".format(key, host))
 
+    @withRequest
+    @inlineCallbacks
+    def xmlrpc_dump_chunk(self, request, key, dump_request):
+        try:
+            logging.info("dump_chunk({}, {})".format(key, dump_request))
+            key = key.decode('hex')
+            dump_request = dump_request.decode('base64')
+            result = yield peering.handle_dump_chunk(key, dump_request)
+            returnValue(result)
+        except xmlrpc.Fault, e:
+            raise e
+        except Exception, e:
+            log.err(_why="Exception in dump_chunk")
+            raise xmlrpc.Fault(106, "Error in dump_chunk({},{})".format(key, dump_request))
+
     @withRequest
     @inlineCallbacks
     def xmlrpc_list_peers(self, request, key, please):
@@ -0,0 +1,125 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Non-blocking reverse DNS lookups for the statistics page. Lookups run
+# concurrently in the reactor thread, each with a timeout. Both hostnames
+# and failed lookups are cached, so hosts that stay in the top lists are
+# not looked up again on every statistics update.
+
+import logging
+import socket
+
+from twisted.internet import defer, reactor
+from twisted.names import client, dns
+from twisted.python import failure
+
+import cache
+import config
+
+_resolver = None
+_cache = cache.LRUCache(0)
+# ip address -> list of Deferreds waiting for a lookup in progress
+_pending = {}
+
+def configure():
+    """ Set up the cache of lookup results. Keeps cached results, unless
+    the cache size changed """
+    global _cache
+    if _cache.max_size != config.resolve_cache_size:
+        _cache = cache.LRUCache(config.resolve_cache_size)
+
+def _get_resolver():
+    global _resolver
+    if _resolver is None:
+        # Results are cached here, so no need for the caching resolver chain
+        # of client.createResolver()
+        _resolver = client.Resolver(resolv="/etc/resolv.conf")
+    return _resolver
+
+def close():
+    """ Stop the resolver from checking resolv.conf for changes """
+    global _resolver
+    if _resolver is not None:
+        parse_call = getattr(_resolver, "_parseCall", None)
+        if parse_call is not None and parse_call.active():
+            parse_call.cancel()
+        _resolver = None
+
+def reverse_name(ip_address):
+    """ The in-addr.arpa or ip6.arpa name of ip_address """
+    if ":" in ip_address:
+        packed = socket.inet_pton(socket.AF_INET6, ip_address)
+        nibbles = "".join("{:02x}".format(ord(c)) for c in packed)
+        return ".".join(reversed(nibbles)) + ".ip6.arpa"
+    return ".".join(reversed(ip_address.split("."))) + ".in-addr.arpa"
+
+def _hostname_from_answers(result):
+    answers, authority, additional = result
+    for record in answers:
+        if record.type == dns.PTR:
+            return str(record.payload.name)
+    return None
+
+def _lookup(ip_address):
+    d = _get_resolver().lookupPointer(reverse_name(ip_address),
+        timeout=(config.resolve_timeout,))
+    d.addTimeout(config.resolve_timeout, reactor)
+    d.addCallback(_hostname_from_answers)
+    return d
+
+def _lookup_done(result, ip_address):
+    if isinstance(result, failure.Failure):
+        logging.debug("Reverse DNS lookup of {} failed: {}".format(
+            ip_address, result.getErrorMessage()))
+        result = None
+    if result is None:
+        _cache.put(ip_address, result, ttl=config.resolve_negative_cache_ttl)
+    else:
+        _cache.put(ip_address, result, ttl=config.resolve_cache_ttl)
+
+    for d in _pending.pop(ip_address, []):
+        d.callback(result)
+
+def resolve(ip_address):
+    """ Returns a Deferred firing with the hostname of ip_address, or None
+    if it has none or the lookup failed. Never errbacks """
+    # Cache stores None for failed lookups, so test membership with a marker
+    hostname = _cache.get(ip_address, _pending)
+    if hostname is not _pending:
+        return defer.succeed(hostname)
+
+    d = defer.Deferred()
+    if ip_address in _pending:
+        _pending[ip_address].append(d)
+    else:
+        _pending[ip_address] = [d]
+        defer.maybeDeferred(_lookup, ip_address).addBoth(_lookup_done, ip_address)
+    return d
+
+@defer.inlineCallbacks
+def resolve_all(ip_addresses):
+    """ Look up the hostnames of all addresses concurrently. Returns a
+    Deferred firing with a dict of ip address -> hostname or None """
+    ip_addresses = list(set(ip_addresses))
+    hostnames = yield defer.gatherResults([resolve(ip) for ip in ip_addresses])
+    defer.returnValue(dict(zip(ip_addresses, hostnames)))
+
+def get_cache_stats():
+    result = _cache.stats()
+    result["pending"] = len(_pending)
+    return result
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
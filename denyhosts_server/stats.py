@@ -19,29 +19,27 @@
 
 import config
 import datetime
+import gzip
+import hashlib
 import logging
 import os.path
-import socket
 import time
+from cStringIO import StringIO
 
-from twisted.internet import reactor, threads, task
+from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.python import log
 from twistar.registry import Registry
 
 from jinja2 import Template, Environment, FileSystemLoader
 
-import GeoIP
-
-import matplotlib
-# Prevent errors from matplotlib instantiating a Tk window
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import numpy
-
 import models
 import database
+import geo
+import graphs
+import metrics
+import resolver
+import summary
 import __init__
 
 def format_datetime(value, format='medium'):
@@ -66,99 +64,56 @@ def insert_zeroes(rows, max = None):
             result.append((value,0))
     return result
 
-def humanize_number(number, pos):
-    """Return a humanized string representation of a number."""
-    abbrevs = (
-        (1E15, 'P'),
-        (1E12, 'T'),
-        (1E9, 'G'),
-        (1E6, 'M'),
-        (1E3, 'k'),
-        (1, '')
-    )
-    if number < 1000:
-        return str(number)
-    for factor, suffix in abbrevs:
-        if number >= factor:
-            break
-    return '%.*f%s' % (0, number / factor, suffix)
-
-# Functions containing blocking io, call from thread!
+@inlineCallbacks
 def fixup_crackers(hosts):
-    gi = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
+    """ Add the country and hostname to the crackers in hosts """
     for host in hosts:
-        try:
-            host.country = gi.country_name_by_addr(host.ip_address)
-        except Exception, e:
-            logging.debug("Exception looking up country for {}: {}".format(host.ip_address, e))
+        country_code, host.country = geo.lookup(host.ip_address)
+        if country_code == geo.unknown_country[0]:
             host.country = ''
-        try:
-            if config.stats_resolve_hostnames:
-                hostinfo = socket.gethostbyaddr(host.ip_address)
-                host.hostname = hostinfo[0]
-            else:
-                host.hostname = host.ip_address
-        except Exception, e:
-            logging.debug("Exception looking up reverse DNS for {}: {}".format(host.ip_address, e))
-            host.hostname = "-"
 
-def make_daily_graph(txn):
+    if config.stats_resolve_hostnames:
+        hostnames = yield resolver.resolve_all([host.ip_address for host in hosts])
+        for host in hosts:
+            host.hostname = hostnames[host.ip_address] or "-"
+    else:
+        for host in hosts:
+            host.hostname = host.ip_address
+
+# Functions fetching the data for the graphs, see the graphs module for
+# the rendering. Run within a database interaction
+def fetch_hourly_data(txn):
     # Calculate start of daily period: yesterday on the beginning of the
     # current hour
     now = time.time()
     dt_now = datetime.datetime.fromtimestamp(now)
-    start_hour = dt_now.hour
     dt_onthehour = dt_now.replace(minute=0, second=0, microsecond=0)
     dt_start = dt_onthehour - datetime.timedelta(days=1)
     yesterday = int(dt_start.strftime('%s'))
 
+    hour = database.hours_since("first_report_time")
     txn.execute(database.translate_query("""
-        SELECT CAST((first_report_time-?)/3600 AS UNSIGNED INTEGER), count(*)
+        SELECT {0}, count(*)
         FROM reports
         WHERE first_report_time > ?
-        GROUP BY CAST((first_report_time-?)/3600 AS UNSIGNED INTEGER)
-        ORDER BY first_report_time ASC
-        """), (yesterday, yesterday, yesterday))
+        GROUP BY {0}
+        ORDER BY {0} ASC
+        """.format(hour)), (yesterday, yesterday, yesterday, yesterday))
     rows = txn.fetchall()
     no_data = False
     if not rows:
         logging.debug("No data for past 24 hours")
         no_data = True
         rows = [(0,0)]
-    #logging.debug("Daily: {}".format(rows))
     rows = insert_zeroes(rows, 24)
-    #logging.debug("Daily: {}".format(rows))
 
-    x = [dt_start + datetime.timedelta(hours=row[0]) for row in rows]
-    y = [row[1] for row in rows]
+    return {
+        "x": [dt_start + datetime.timedelta(hours=row[0]) for row in rows],
+        "y": [row[1] for row in rows],
+        "no_data": no_data,
+    }
 
-    # calc the trendline
-    x_num = mdates.date2num(x)
-    
-    z = numpy.polyfit(x_num, y, 1)
-    p = numpy.poly1d(z)
-    
-    xx = numpy.linspace(x_num.min(), x_num.max(), 100)
-    dd = mdates.num2date(xx)
-    
-    fig = plt.figure()
-    ax = fig.gca()
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%H:%M'))
-    ax.xaxis.set_major_locator(mdates.HourLocator(interval=4))
-    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
-    ax.set_title("Reports per hour")
-    ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
-    ax.plot(dd, p(xx), "b--")
-    ax.set_ybound(lower=0)
-    fig.autofmt_xdate()
-    if no_data:
-        fig.text(0.5, 0.5, "Not enough data", size="x-large", 
-        ha="center", va="center")
-    fig.savefig(os.path.join(config.graph_dir, 'hourly.svg'))
-    fig.clf()
-    plt.close(fig)
-    
-def make_monthly_graph(txn):
+def fetch_monthly_data(txn):
     # Calculate start of monthly period: last month on the beginning of the
     # current day
     today = datetime.date.today()
@@ -179,35 +134,10 @@ def make_monthly_graph(txn):
     else:
         (x,y) = zip(*rows)
 
-    # calc the trendline
-    x_num = mdates.date2num(x)
-   
-    if not no_data:
-        z = numpy.polyfit(x_num, y, 1)
-        p = numpy.poly1d(z)
-        xx = numpy.linspace(x_num.min(), x_num.max(), 100)
-        dd = mdates.num2date(xx)
-    
-    fig = plt.figure()
-    ax = fig.gca()
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d %b'))
-    ax.xaxis.set_major_locator(mdates.DayLocator(interval=4))
-    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
-    ax.set_title("Reports per day")
-    ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
-    if not no_data:
-        ax.plot(dd, p(xx),"b--")
-    ax.set_ybound(lower=0)
-    fig.autofmt_xdate()
-    if no_data:
-        fig.text(0.5, 0.5, "Not enough data", size="x-large", 
-        ha="center", va="center")
-    fig.savefig(os.path.join(config.graph_dir, 'monthly.svg'))
-    fig.clf()
-    plt.close(fig)
-
-def make_history_graph(txn):
-    # Graph since first record
+    return { "x": list(x), "y": list(y), "no_data": no_data }
+
+def _fetch_daily_series(txn, column):
+    # Series since first record
     txn.execute(database.translate_query("""
         SELECT date FROM history 
         ORDER BY date ASC
@@ -219,101 +149,27 @@ def make_history_graph(txn):
     else:
         dt_first= datetime.date.today()
     num_days = ( datetime.date.today() - dt_first ).days
-    #logging.debug("First day in data set: {}".format(dt_first))
-    #logging.debug("Number of days in data set: {}".format(num_days))
-    no_data = False
     if num_days == 0:
-        no_data = True
         x = [ dt_first, ]
         y = [ 0, ]
     else:
         txn.execute(database.translate_query("""
-            SELECT date, num_reports
+            SELECT date, {}
             FROM history
             ORDER BY date ASC
-            """))
+            """.format(column)))
         rows = txn.fetchall()
         (x,y) = zip(*rows)
 
-    # calc the trendline
-    x_num = mdates.date2num(x)
-   
-    if not no_data:
-        z = numpy.polyfit(x_num, y, 1)
-        p = numpy.poly1d(z)
-        
-        xx = numpy.linspace(x_num.min(), x_num.max(), 100)
-        dd = mdates.num2date(xx)
-    
-    fig = plt.figure()
-    ax = fig.gca()
-
-    locator = mdates.AutoDateLocator(interval_multiples=False)
-    ax.xaxis.set_major_locator(locator)
-    ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
-    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
-    ax.set_title("Reports per day")
-    if (num_days<100):
-        ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
-    else:
-        ax.plot(x,y, linestyle='solid', marker='')
-    if not no_data:
-        ax.plot(dd, p(xx),"b--")
-    ax.set_ybound(lower=0)
-    fig.autofmt_xdate()
+    return { "x": list(x), "y": list(y), "num_days": num_days }
 
-    if num_days == 0:
-        fig.text(0.50, 0.50, "Not enough data", size="x-large", ha="center", va="center")
-
-    fig.savefig(os.path.join(config.graph_dir, 'history.svg'))
-    fig.clf()
-    plt.close(fig)
-
-def make_contrib_graph(txn):
-    # Number of reporters over days
-    txn.execute(database.translate_query("""
-        SELECT date FROM history 
-        ORDER BY date ASC
-        LIMIT 1
-        """))
-    first_time = txn.fetchall()
-    if first_time is not None and len(first_time)>0 and first_time[0][0] is not None:
-        dt_first = first_time[0][0]
-    else:
-        dt_first = datetime.date.today()
-    num_days = ( datetime.date.today() - dt_first ).days
-    if num_days == 0:
-        x = [dt_first, ]
-        y = [0, ]
-    else:
-        txn.execute(database.translate_query("""
-            SELECT date, num_contributors
-            FROM history
-            ORDER BY date ASC
-            """))
-        rows = txn.fetchall()
-        (x,y) = zip(*rows)
+def fetch_history_data(txn):
+    return _fetch_daily_series(txn, "num_reports")
 
-    fig = plt.figure()
-    ax = fig.gca()
-    locator = mdates.AutoDateLocator(interval_multiples=False)
-    ax.xaxis.set_major_locator(locator)
-    ax.xaxis.set_major_formatter(mdates.AutoDateFormatter(locator))
-    ax.yaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
-    ax.set_title("Number of contributors")
-    if (num_days<100):
-        ax.plot(x,y, linestyle='solid', marker='o', markerfacecolor='blue')
-    else:
-        ax.plot(x,y, linestyle='solid', marker='')
-    ax.set_ybound(lower=0)
-    fig.autofmt_xdate()
-    if num_days == 0:
-        fig.text(0.50, 0.50, "Not enough data", size="x-large", ha="center", va="center")
-    fig.savefig(os.path.join(config.graph_dir, 'contrib.svg'))
-    fig.clf()
-    plt.close(fig)
+def fetch_contrib_data(txn):
+    return _fetch_daily_series(txn, "num_contributors")
 
-def make_country_piegraph(txn):
+def fetch_country_pie_data(txn):
     # Total reports per country
     limit = 10 # Fixme configurable
     txn.execute(database.translate_query("""
@@ -325,22 +181,12 @@ def make_country_piegraph(txn):
 
     rows = txn.fetchall()
     if rows is None or len(rows)==0:
-        return
+        return None
 
     (labels,sizes) = zip(*rows)
+    return { "labels": list(labels), "sizes": list(sizes) }
 
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-    ax.pie(sizes, labels=labels,
-            autopct='%1.1f%%', shadow=True, startangle=90)
-# Set aspect ratio to be equal so that pie is drawn as a circle.
-    ax.axis('equal')
-
-    fig.savefig(os.path.join(config.graph_dir, 'country_pie.svg'))
-    fig.clf()
-    plt.close(fig)
-
-def make_country_bargraph(txn):
+def fetch_country_bar_data(txn):
     # Total reports per country
     limit = 10 # Fixme configurable
 
@@ -356,7 +202,6 @@ def make_country_bargraph(txn):
         total_reports = 1
         countries = ["Unknown",]
         counts = [1,]
-        max_count = 1
     else:
         total_reports = int(rows[0][0])
         
@@ -369,39 +214,35 @@ def make_country_bargraph(txn):
 
         rows = txn.fetchall()
         if rows is None or len(rows)==0:
-            return
+            return None
 
         (countries,counts) = zip(*reversed(rows))
-        max_count = max(counts)
-
-    fig = plt.figure()
-    ax = fig.add_subplot(111)
-
-    y_pos = numpy.arange(len(countries))
-    bars = ax.barh(y_pos, counts, align='center', alpha=0.6)
-    count = 0
-    for bar in bars:
-        height = bar.get_height()
-        ax.text(max_count / 20., bar.get_y() + height / 2., 
-            "{}% {}".format(round(counts[count]*1.0/total_reports*100), countries[count] ),
-            ha='left', va='center')
-        count += 1
-    ax.set_yticks(y_pos)
-    ax.set_yticklabels([])
-    ax.set_title('Number of attacks per country of origin (top {})'.format(limit))
-    ax.xaxis.set_major_formatter(matplotlib.ticker.FuncFormatter(humanize_number))
-    ax.set_ylim(ymin=-1)
-    fig.tight_layout()
-    if no_data:
-        fig.text(0.50, 0.50, "Not enough data", size="x-large", ha="center", va="center")
-
-    fig.savefig(os.path.join(config.graph_dir, 'country_bar.svg'))
-    fig.clf()
-    plt.close(fig)
+
+    return {
+        "countries": list(countries),
+        "counts": list(counts),
+        "total_reports": total_reports,
+        "limit": limit,
+        "no_data": no_data,
+    }
+
+# graph filename -> function fetching its data
+graph_fetchers = {
+    "hourly.svg": fetch_hourly_data,
+    "monthly.svg": fetch_monthly_data,
+    "contrib.svg": fetch_contrib_data,
+    "history.svg": fetch_history_data,
+    "country_bar.svg": fetch_country_bar_data,
+}
+
+def fetch_graph_data_txn(txn):
+    return { filename: fetch(txn) for filename, fetch in graph_fetchers.iteritems() }
 
 _cache = None
 _stats_busy = False
+_template_env = None
 
+@metrics.timed_job("stats")
 @inlineCallbacks
 def update_stats_cache():
     global _stats_busy
@@ -410,117 +251,227 @@ def update_stats_cache():
         logging.debug("Already updating statistics cache, exiting")
         returnValue(None)
     _stats_busy = True
+    try:
+        logging.debug("Updating statistics cache...")
+
+        # Fill history table for yesterday, when necessary
+        yield update_recent_history()
+        yield update_country_history()
+
+        now = time.time()
+        stats = {}
+        stats["last_updated"] = now
+        stats["has_hostnames"] = config.stats_resolve_hostnames
+        # Note paths configured in main.py by the Resource objects
+        stats["static_base"] = "../static"
+        stats["graph_base"] = "../static/graphs"
+        stats["server_version"] = __init__.version
+        try:
+            yesterday = now - 24*3600
+            summary_data = yield summary.get_summary(yesterday)
+            for key in ["num_hosts", "num_reports", "num_clients", "daily_reports", "daily_new_hosts"]:
+                stats[key] = summary_data[key]
 
-    logging.debug("Updating statistics cache...")
+            for key in ["recent_hosts", "most_reported_hosts"]:
+                hosts = [models.Cracker(**host) for host in summary_data[key]]
+                yield fixup_crackers(hosts)
+                stats[key] = hosts
 
-    # Fill history table for yesterday, when necessary
-    yield update_recent_history()
-    yield update_country_history()
+            logging.info("Stats: {} reports for {} hosts from {} reporters".format(
+                stats["num_reports"], stats["num_hosts"], stats["num_clients"]))
 
-    now = time.time()
-    stats = {}
-    stats["last_updated"] = now
-    stats["has_hostnames"] = config.stats_resolve_hostnames
-    # Note paths configured in main.py by the Resource objects
-    stats["static_base"] = "../static"
-    stats["graph_base"] = "../static/graphs"
-    stats["server_version"] = __init__.version
-    try:
-        #rows = yield database.run_query("SELECT num_hosts,num_reports, num_clients, new_hosts FROM stats ORDER BY time DESC LIMIT 1")
-        stats["num_hosts"] = yield models.Cracker.count()
-        stats["num_reports"] = yield models.Report.count()
+            graph_data = yield database.run_read_interaction(fetch_graph_data_txn)
+            rendered = yield graphs.render_changed(graph_data)
+            metrics.job_items.inc(len(rendered), job="stats", item="graphs")
 
-        rows = yield database.run_query("SELECT count(DISTINCT ip_address) FROM reports") 
-        if len(rows)>0:
-            stats["num_clients"] = rows[0][0]
-        else:
-            stats["num_clients"] = 0
-
-        yesterday = now - 24*3600
-        stats["daily_reports"] = yield models.Report.count(where=["first_report_time>?", yesterday])
-        stats["daily_new_hosts"] = yield models.Cracker.count(where=["first_time>?", yesterday])
-
-        recent_hosts = yield models.Cracker.find(orderby="latest_time DESC", limit=10)
-        yield threads.deferToThread(fixup_crackers, recent_hosts)
-        stats["recent_hosts"] = recent_hosts
-
-        most_reported_hosts = yield models.Cracker.find(orderby="total_reports DESC", limit=10)
-        yield threads.deferToThread(fixup_crackers, most_reported_hosts)
-        stats["most_reported_hosts"] = most_reported_hosts
-
-        logging.info("Stats: {} reports for {} hosts from {} reporters".format(
-            stats["num_reports"], stats["num_hosts"], stats["num_clients"]))
-
-        yield Registry.DBPOOL.runInteraction(make_daily_graph)
-        yield Registry.DBPOOL.runInteraction(make_monthly_graph)
-        yield Registry.DBPOOL.runInteraction(make_contrib_graph)
-        yield Registry.DBPOOL.runInteraction(make_history_graph)
-        yield Registry.DBPOOL.runInteraction(make_country_bargraph)
-
-        if _cache is None:
-            _cache = {}
-        _cache["stats"] = stats
-        _cache["time"] = time.time()
-        logging.debug("Finished updating statistics cache...")
-    except Exception, e:
-        log.err(_why="Error updating statistics: {}".format(e))
-        logging.warning("Error updating statistics: {}".format(e))
-
-    _stats_busy = False
+            try:
+                logging.info("Rendering statistics page...")
+                page = _render_page(stats)
+            except Exception, e:
+                log.err(_why="Error rendering statistics page: {}".format(e))
+                logging.warning("Error creating statistics page: {}".format(e))
+                page = _cache.get("page") if _cache is not None else None
+
+            if _cache is None:
+                _cache = {}
+            _cache["stats"] = stats
+            _cache["page"] = page
+            _cache["time"] = time.time()
+            logging.debug("Finished updating statistics cache...")
+        except Exception, e:
+            log.err(_why="Error updating statistics: {}".format(e))
+            logging.warning("Error updating statistics: {}".format(e))
+    finally:
+        _stats_busy = False
+
+def _get_template():
+    """ The statistics page template. The Jinja2 environment is kept, so the
+    template is only compiled again when the file changes """
+    global _template_env
+    if _template_env is None or _template_env.loader.searchpath != [config.template_dir]:
+        _template_env = Environment(loader=FileSystemLoader(config.template_dir))
+        _template_env.filters['datetime'] = format_datetime
+    return _template_env.get_template('stats.html')
+
+def _render_page(stats):
+    """ Render the statistics page. Returns a dict with the page as utf-8
+    encoded html, the gzip compressed html, their entity tags and the
+    modification time """
+    html = _get_template().render(stats).encode('utf-8')
+
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', mtime=0)
+    gz.write(html)
+    gz.close()
+
+    digest = hashlib.sha1(html).hexdigest()
+    return {
+        "html": html,
+        "gzip": buf.getvalue(),
+        "etag": '"{}"'.format(digest),
+        "gzip_etag": '"{}-gzip"'.format(digest),
+        "last_modified": int(stats["last_updated"]),
+    }
 
 @inlineCallbacks
-def render_stats():
-    global _cache
-    logging.info("Rendering statistics page...")
+def get_stats_page():
+    """ The statistics page as rendered by the last update_stats_cache(),
+    see _render_page(). None if rendering failed """
     if _cache is None:
         while _cache is None:
             logging.debug("No statistics cached yet, waiting for cache generation to finish...")
             yield task.deferLater(reactor, 1, lambda _:0, 0)
+    returnValue(_cache.get("page"))
 
-    now = time.time()
-    try:
-        env = Environment(loader=FileSystemLoader(config.template_dir))
-        env.filters['datetime'] = format_datetime
-        template = env.get_template('stats.html')
-        html = template.render(_cache["stats"])
+@inlineCallbacks
+def render_stats():
+    page = yield get_stats_page()
+    if page is None:
+        returnValue(None)
+    returnValue(page["html"].decode('utf-8'))
+
+# Number of days before today for which the reporters and crackers seen
+# per day are kept, to count the distinct ones for reports that arrive late
+daily_activity_days = 2
+
+def _parse_date(value):
+    if isinstance(value, basestring):
+        return datetime.datetime.strptime(value, "%Y-%m-%d").date()
+    return value
+
+def _report_days_query():
+    """ Subquery with the (local) days on which reports were active: the days
+    of their first and latest report times, since a timestamp given twice as
+    parameter """
+    return """
+        SELECT id, cracker_id, ip_address, {} AS day
+        FROM reports WHERE first_report_time>=?
+        UNION
+        SELECT id, cracker_id, ip_address, {} AS day
+        FROM reports WHERE latest_report_time>=?
+        """.format(database.local_date("first_report_time"),
+            database.local_date("latest_report_time"))
+
+def _grouped_history_txn(txn, since=0):
+    """ The history counters for all days with report activity since the
+    given timestamp, calculated in a single grouped pass over the reports
+    table. Returns a dict of date -> (num_reports, num_contributors,
+    num_reported_hosts) """
+    txn.execute(database.translate_query("""
+        SELECT day, COUNT(*), COUNT(DISTINCT ip_address), COUNT(DISTINCT cracker_id)
+        FROM ({}) report_days
+        GROUP BY day
+        """.format(_report_days_query())), (since, since))
+    return { _parse_date(row[0]): tuple(row[1:]) for row in txn.fetchall() }
 
-        logging.info("Done rendering statistics page...")
-        returnValue(html)
-    except Exception, e:
-        log.err(_why="Error rendering statistics page: {}".format(e))
-        logging.warning("Error creating statistics page: {}".format(e))
+_counter_columns = ["`date`", "num_reports", "num_contributors", "num_reported_hosts"]
+
+def _daily_activity_since():
+    first_date = datetime.date.today() - datetime.timedelta(days=daily_activity_days)
+    return time.mktime(first_date.timetuple())
+
+def fill_daily_reporters_txn(txn):
+    """ Fill the daily_reporters table from the reports table """
+    since = _daily_activity_since()
+    txn.execute(database.translate_query("""
+        {} (date, ip_address)
+        SELECT DISTINCT day, ip_address FROM ({}) report_days
+        """.format(database.insert_ignore("daily_reporters"), _report_days_query())),
+        (since, since))
+
+def rebuild_daily_counters_txn(txn):
+    """ Recalculate the daily counters from the reports table """
+    txn.execute("DELETE FROM daily_counters")
+    txn.execute("DELETE FROM daily_reporters")
+    txn.execute("DELETE FROM daily_crackers")
+
+    counters = _grouped_history_txn(txn)
+    database.bulk_insert(txn, "daily_counters", _counter_columns,
+        [(date,) + counts for date, counts in counters.iteritems()])
+
+    fill_daily_reporters_txn(txn)
+    since = _daily_activity_since()
+    txn.execute(database.translate_query("""
+        {} (date, cracker_id)
+        SELECT DISTINCT day, cracker_id FROM ({}) report_days
+        """.format(database.insert_ignore("daily_crackers"), _report_days_query())),
+        (since, since))
+
+database.register_query("daily_activity.insert_reporters",
+    lambda: database.insert_ignore("daily_reporters") + " (date, ip_address) VALUES (?,?)")
+database.register_query("daily_activity.insert_crackers",
+    lambda: database.insert_ignore("daily_crackers") + " (date, cracker_id) VALUES (?,?)")
+
+def add_daily_activity_txn(txn, activity):
+    """ Update the daily counters. activity is a list of (date, cracker_id,
+    reporter ip address, new_report) tuples, one for every report that was
+    added or updated. new_report should be True if the report was not
+    active on that date before """
+    by_date = {}
+    for (date, cracker_id, ip_address, new_report) in activity:
+        counts = by_date.setdefault(date, [0, set(), set()])
+        if new_report:
+            counts[0] += 1
+        counts[1].add(ip_address)
+        counts[2].add(cracker_id)
+
+    changes = []
+    for date, (num_reports, reporters, crackers) in by_date.iteritems():
+        database.executemany(txn, "daily_activity.insert_reporters",
+            [(date, database.ip_param(ip_address)) for ip_address in reporters])
+        num_contributors = txn.rowcount
+        database.executemany(txn, "daily_activity.insert_crackers",
+            [(date, cracker_id) for cracker_id in crackers])
+        num_reported_hosts = txn.rowcount
+
+        changes.append((date, num_reports, num_contributors, num_reported_hosts))
+    database.add_to_rows(txn, "daily_counters", _counter_columns, changes)
+
+def prune_daily_activity_txn(txn):
+    first_date = datetime.date.today() - datetime.timedelta(days=daily_activity_days)
+    txn.execute(database.translate_query("DELETE FROM daily_reporters WHERE date<?"), (first_date,))
+    txn.execute(database.translate_query("DELETE FROM daily_crackers WHERE date<?"), (first_date,))
 
 def update_history_txn(txn, date):
     try:
         logging.info("Updating history table for {}".format(date))
-        start = time.mktime(date.timetuple())
-        end = start + 24*60*60
-        #logging.debug("Date start, end: {}, {}".format(start, end))
 
         txn.execute(database.translate_query("""
-                SELECT  COUNT(*), 
-                        COUNT(DISTINCT cracker_id),
-                        COUNT(DISTINCT ip_address) 
-                FROM reports 
-                WHERE (first_report_time>=? AND first_report_time<?) OR
-                      (latest_report_time>=? AND latest_report_time<?)
-                """), (start, end, start, end))
+                SELECT num_reports, num_contributors, num_reported_hosts
+                FROM daily_counters
+                WHERE date=?
+                """), (date,))
         rows = txn.fetchall()
         if rows is None or len(rows)==0:
-            return
-
-        num_reports = rows[0][0]
-        num_hosts = rows[0][1]
-        num_reporters = rows[0][2]
+            num_reports, num_reporters, num_hosts = 0, 0, 0
+        else:
+            num_reports, num_reporters, num_hosts = rows[0]
         logging.debug("Number of reporters: {}".format(num_reporters))
         logging.debug("Number of reports: {}".format(num_reports))
         logging.debug("Number of reported hosts: {}".format(num_hosts))
 
-        txn.execute(database.translate_query("""
-            REPLACE INTO history
-                (date, num_reports, num_contributors, num_reported_hosts)
-                VALUES (?,?,?,?)
-            """), (date, num_reports, num_reporters, num_hosts))
+        database.execute(txn, database.replace_into("history", _counter_columns),
+            (date, num_reports, num_reporters, num_hosts))
     except Exception, e:
         log.err(_why="Error updating history: {}".format(e))
         logging.warning("Error updating history: {}".format(e))
@@ -557,28 +508,32 @@ def update_recent_history_txn(txn, last_date=None):
 
     
 def fixup_history_txn(txn):
+    """ Fill the history for all days for which it is missing, from the
+    reports table """
     try:
-        txn.execute("SELECT MIN(first_report_time) FROM reports")
-        first_time = txn.fetchall()
-        if first_time is not None and len(first_time)>0 and first_time[0][0] is not None:
-            first_date = datetime.date.fromtimestamp(first_time[0][0])
-        else:
+        counters = _grouped_history_txn(txn)
+        if len(counters) == 0:
             # No data, nothing to do
             return
 
+        first_date = min(counters)
         last_date = datetime.date.today() - datetime.timedelta(days = 1)
 
         # Find any dates for which the history has not been filled
         txn.execute("SELECT date FROM history ORDER BY date ASC") 
         rows = txn.fetchall()
-        dates = set([row[0] for row in rows])
+        dates = set([_parse_date(row[0]) for row in rows])
 
+        missing = []
         date = first_date
         while date <= last_date:
             if date not in dates:
-                update_history_txn(txn, date)
+                missing.append((date,) + counters.get(date, (0, 0, 0)))
             date = date + datetime.timedelta(days = 1)
 
+        logging.info("Filling history table for {} days".format(len(missing)))
+        database.bulk_insert(txn, "history", _counter_columns, missing, replace=True)
+
     except Exception as e:
         log.err(_why="Error fixing up history: {}".format(e))
         logging.warning("Error fixing up history: {}".format(e))
@@ -588,54 +543,55 @@ def update_recent_history(date=None):
     return Registry.DBPOOL.runInteraction(update_recent_history_txn, date)
 
 def update_country_history_txn(txn, date=None, include_history = False):
+    """ Add the reports first seen up to and including date to the
+    per-country totals. The last date added is kept in the info table, so
+    every day is counted once, also when this is called more than once a day
+    or after a few days of downtime. With include_history, the totals are
+    recalculated from scratch """
     if date is None:
         date = datetime.date.today() - datetime.timedelta(days = 1)
 
     if include_history:
+        txn.execute("DELETE FROM country_history")
         start_time = 0
     else:
-        start_time = (date - datetime.date(1970, 1, 1)).total_seconds()
+        database.execute(txn, "SELECT `value` FROM info WHERE `key`='last_country_history_update'")
+        row = txn.fetchone()
+        last_date = _parse_date(row[0]) if row is not None else datetime.date(1970, 1, 1)
+        if last_date >= date:
+            logging.debug("Country history already up to date for {}".format(date))
+            return
+        start_time = max(0, (last_date + datetime.timedelta(days=1) - datetime.date(1970, 1, 1)).total_seconds())
     end_time = (date + datetime.timedelta(days=1) - datetime.date(1970, 1, 1)).total_seconds()
 
-    txn.execute("SELECT country_code,country,num_reports FROM country_history")
+    # One IP address per country, to look up the name of the country
+    txn.execute(database.translate_query(
+        """SELECT COALESCE(crackers.country_code, ?), {}, COUNT(*)
+        FROM reports JOIN crackers ON reports.cracker_id = crackers.id
+        WHERE reports.first_report_time >= ? AND reports.first_report_time < ?
+        GROUP BY COALESCE(crackers.country_code, ?)
+        """.format(database.any_value("crackers.ip_address"))), (geo.unknown_country[0], start_time, end_time, geo.unknown_country[0]))
     rows = txn.fetchall()
-    result = {row[0]:(row[1],row[2]) for row in rows}
 
-    gi = GeoIP.new(GeoIP.GEOIP_MEMORY_CACHE)
+    if len(rows) > 0:
+        country_names = {}
+        for (country_code, ip_address, count) in rows:
+            found_code, country = geo.lookup(database.ip_value(ip_address))
+            if found_code != country_code:
+                country = geo.country_name(country_code)
+            country_names[country_code] = country
+        txn.executemany(database.translate_query(
+            database.insert_ignore("country_history") +
+            " (country_code, country, num_reports) VALUES (?,?,0)"),
+            country_names.items())
+        txn.executemany(database.translate_query(
+            """UPDATE country_history SET num_reports=num_reports+?
+            WHERE country_code=?"""),
+            [(count, country_code) for (country_code, ip_address, count) in rows])
 
     txn.execute(database.translate_query(
-        """SELECT crackers.ip_address,COUNT(*) as count
-        FROM crackers LEFT JOIN reports ON reports.cracker_id = crackers.id
-        WHERE reports.first_report_time >= ? AND reports.first_report_time < ?
-        GROUP BY crackers.id
-        """), (start_time, end_time))
-
-    while True:
-        rows = txn.fetchmany(size=100)
-        if len(rows) == 0:
-            break
-        for row in rows:
-            ip = row[0]
-            count = row[1]
-            try:
-                country_code = gi.country_code_by_addr(ip)
-                country = gi.country_name_by_addr(ip)
-                if country_code is None:
-                    country_code = "ZZ"
-                if country is None:
-                    country = "(Unknown)"
-                if country_code in result:
-                    count += result[country_code][1]
-                result[country_code] = (country,count)
-            except Exception, e:
-                logging.debug("Exception looking up country for {}: {}".format(ip, e))
-     
-    for country_code in result:
-        country,count = result[country_code]
-        txn.execute(database.translate_query(
-            """REPLACE INTO country_history (country_code,country,num_reports)
-            VALUES (?,?,?)"""),
-            (country_code,country,count))
+        "UPDATE info SET `value`=? WHERE `key`='last_country_history_update'"),
+        (date.isoformat(),))
 
 def update_country_history(date=None, include_history=False):
     "date should be a datetime.date or None, indicating yesterday"
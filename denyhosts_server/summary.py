@@ -0,0 +1,153 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Summary counters for the statistics page: the number of crackers,
+# reports and reporting clients. They are kept in the counters table and
+# updated in the same transaction that adds or removes crackers and
+# reports, so the statistics do not need to count the large tables. The
+# reporters table holds the number of reports per client, to know when a
+# client is added or removed.
+#
+# Changes made outside the functions that keep the counters up to date
+# (for instance through the ORM models) are corrected by recount(), which
+# the maintenance job runs periodically.
+
+import logging
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twistar.registry import Registry
+
+import config
+import database
+
+counter_names = ("num_hosts", "num_reports", "num_clients")
+
+# Time of the last recount
+_last_recount = 0
+
+database.register_query("summary.insert_reporters",
+    lambda: database.insert_ignore("reporters") + " (ip_address, num_reports) VALUES (?,0)")
+database.register_query("summary.update_reporters",
+    "UPDATE reporters SET num_reports=num_reports+? WHERE ip_address=?")
+database.register_query("summary.delete_reporters",
+    "DELETE FROM reporters WHERE ip_address IN ({}) AND num_reports<=0")
+database.register_query("summary.update_counters",
+    "UPDATE counters SET `value`=`value`+? WHERE name=?")
+
+def update_txn(txn, num_hosts=0, num_reports=0, reporters=None):
+    """ Apply changes to the counters. reporters is a dict of client ip
+    address -> change in the number of reports by that client """
+    num_clients = 0
+    if reporters:
+        changes = [(change, database.ip_param(ip))
+            for ip, change in reporters.iteritems() if change != 0]
+        if len(changes) > 0:
+            database.executemany(txn, "summary.insert_reporters",
+                [(ip,) for (change, ip) in changes])
+            num_clients += txn.rowcount
+            database.executemany(txn, "summary.update_reporters", changes)
+            for chunk in database.chunks([ip for (change, ip) in changes], database.max_in_params):
+                database.execute(txn, *database.expand_in("summary.delete_reporters", chunk))
+                num_clients -= txn.rowcount
+
+    changes = [(change, name) for (name, change) in
+        zip(counter_names, (num_hosts, num_reports, num_clients)) if change != 0]
+    if len(changes) > 0:
+        database.executemany(txn, "summary.update_counters", changes)
+
+def get_counters_txn(txn):
+    database.execute(txn, "SELECT name, `value` FROM counters")
+    counters = { name: 0 for name in counter_names }
+    counters.update((row[0], int(row[1])) for row in txn.fetchall())
+    return counters
+
+def recount_txn(txn):
+    """ Recalculate the counters from the crackers and reports tables.
+    Returns a dict of counter name -> difference between the real value and
+    the stored one, for the counters that were off """
+    stored = get_counters_txn(txn)
+
+    txn.execute("DELETE FROM reporters")
+    txn.execute("""
+        INSERT INTO reporters (ip_address, num_reports)
+        SELECT ip_address, COUNT(*) FROM reports GROUP BY ip_address""")
+
+    actual = {}
+    for name, query in [
+            ("num_hosts", "SELECT COUNT(*) FROM crackers"),
+            ("num_reports", "SELECT COUNT(*) FROM reports"),
+            ("num_clients", "SELECT COUNT(*) FROM reporters")]:
+        txn.execute(query)
+        actual[name] = int(txn.fetchone()[0])
+
+    txn.executemany(database.translate_query(
+        database.insert_ignore("counters") + " (name, `value`) VALUES (?,0)"),
+        [(name,) for name in counter_names])
+    txn.executemany(database.translate_query(
+        "UPDATE counters SET `value`=? WHERE name=?"),
+        [(actual[name], name) for name in counter_names])
+
+    return { name: actual[name] - stored[name]
+        for name in counter_names if actual[name] != stored[name] }
+
+@inlineCallbacks
+def recount():
+    global _last_recount
+    _last_recount = time.time()
+    drift = yield Registry.DBPOOL.runInteraction(recount_txn)
+    if len(drift) > 0:
+        logging.warning("Summary counters were off, corrected: {}".format(
+            ", ".join("{} by {}".format(name, drift[name]) for name in sorted(drift))))
+    returnValue(drift)
+
+def recount_due():
+    return (config.counter_check_interval > 0 and
+        time.time() - _last_recount >= config.counter_check_interval)
+
+_host_columns = ["id", "ip_address", "first_time", "latest_time", "resiliency",
+    "total_reports", "current_reports", "country_code"]
+
+def _select_hosts_txn(txn, orderby, limit):
+    txn.execute(database.translate_query("""
+        SELECT {} FROM crackers
+        ORDER BY {}
+        LIMIT ?""".format(",".join(_host_columns), orderby)), (limit,))
+    hosts = [dict(zip(_host_columns, row)) for row in txn.fetchall()]
+    for host in hosts:
+        host["ip_address"] = database.ip_value(host["ip_address"])
+    return hosts
+
+def get_summary_txn(txn, since, limit=10):
+    """ The counters, the number of reports and new crackers since the given
+    time, and the most recent and most reported crackers, as dicts """
+    summary = get_counters_txn(txn)
+
+    txn.execute(database.translate_query(
+        "SELECT COUNT(*) FROM reports WHERE first_report_time>?"), (since,))
+    summary["daily_reports"] = int(txn.fetchone()[0])
+    txn.execute(database.translate_query(
+        "SELECT COUNT(*) FROM crackers WHERE first_time>?"), (since,))
+    summary["daily_new_hosts"] = int(txn.fetchone()[0])
+
+    summary["recent_hosts"] = _select_hosts_txn(txn, "latest_time DESC", limit)
+    summary["most_reported_hosts"] = _select_hosts_txn(txn, "total_reports DESC", limit)
+    return summary
+
+def get_summary(since, limit=10):
+    return database.run_read_interaction(get_summary_txn, since, limit)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
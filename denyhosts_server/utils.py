@@ -14,40 +14,139 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import bisect
+import collections
 import logging
+import socket
+import struct
+import time
+import urlparse
+import xmlrpclib
+from StringIO import StringIO
 import ipaddr
 
+from twisted.internet import defer, reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet import reactor, task
+from twisted.web.client import Agent, HTTPConnectionPool, FileBodyProducer, readBody
+from twisted.web.http_headers import Headers
 
-_hosts_busy = set()
+import metrics
+
+# Per-host locks. A host is locked as long as it is present in _host_locks.
+# The value is the FIFO queue of (Deferred, start_time) tuples of the callers
+# waiting for the lock. Unlocking a host hands the lock directly to the first
+# waiter, so waiters are woken up immediately and in order.
+_host_locks = {}
+
+# Contention statistics. The upper bounds (in seconds) of the lock wait time
+# histogram buckets; the last bucket counts all longer waits
+lock_wait_buckets = (0.001, 0.01, 0.1, 1.0, 10.0)
+_lock_wait_counts = [0] * (len(lock_wait_buckets) + 1)
+_lock_wait_total = 0.0
+_lock_acquisitions = 0
+_lock_contentions = 0
+
+def _record_lock_wait(wait_time):
+    global _lock_wait_total
+    _lock_wait_counts[bisect.bisect_left(lock_wait_buckets, wait_time)] += 1
+    _lock_wait_total += wait_time
 
-@inlineCallbacks
 def wait_and_lock_host(host):
-    try:
-        while host in _hosts_busy:
-            logging.debug("waiting to update host {}, {} blocked now".format(host, len(_hosts_busy)))
-            yield task.deferLater(reactor, 0.01, lambda _:0, 0)
-        _hosts_busy.add(host)
-    except:
-        logging.debug("Exception in locking {}".format(host), exc_info=True)
+    """ Lock host. Returns a Deferred that fires as soon as the lock has been
+    acquired """
+    global _lock_acquisitions, _lock_contentions
+    _lock_acquisitions += 1
+    waiters = _host_locks.get(host)
+    if waiters is None:
+        _host_locks[host] = collections.deque()
+        _record_lock_wait(0.0)
+        return defer.succeed(0)
 
-    returnValue(0)
+    _lock_contentions += 1
+    logging.debug("waiting to update host {}, {} blocked now".format(host, len(_host_locks)))
+    d = defer.Deferred()
+    waiters.append((d, time.time()))
+    return d
 
 def unlock_host(host):
+    waiters = _host_locks.get(host)
+    if waiters is None:
+        logging.debug("Unlocking host {} which is not locked".format(host))
+        return
+
+    if len(waiters) == 0:
+        del _host_locks[host]
+        #logging.debug("host {} unlocked, {} blocked now".format(host, len(_host_locks)))
+        return
+
+    # Hand the lock over to the next waiter
+    d, start_time = waiters.popleft()
+    _record_lock_wait(time.time() - start_time)
     try:
-        _hosts_busy.remove(host)
-        #logging.debug("host {} unlocked, {} blocked now".format(host, len(_hosts_busy)))
+        d.callback(0)
     except:
-        logging.debug("Exception in unlocking {}".format(host), exc_info=True)
+        logging.debug("Exception in waking up waiter for {}".format(host), exc_info=True)
 
 def none_waiting():
-    return len(_hosts_busy) == 0
+    return len(_host_locks) == 0
 
 def count_waiting():
-    return len(_hosts_busy)
+    return len(_host_locks)
 
-def is_valid_ip_address(ip_address):
+def get_lock_stats():
+    """ Return a dict with the current lock contention statistics """
+    return {
+        "locked_hosts": len(_host_locks),
+        "waiters": sum(len(waiters) for waiters in _host_locks.itervalues()),
+        "acquisitions": _lock_acquisitions,
+        "contentions": _lock_contentions,
+        "wait_buckets": lock_wait_buckets,
+        "wait_counts": list(_lock_wait_counts),
+        "wait_time_total": _lock_wait_total,
+    }
+
+def _lock_metrics():
+    stats = get_lock_stats()
+    lines = metrics.exposition_lines("denyhosts_lock_wait_seconds", "histogram",
+        "Time spent waiting for host locks",
+        metrics.histogram_samples(stats["wait_buckets"],
+            [((), stats["wait_counts"], stats["wait_time_total"])]))
+    for name, kind, key, help in [
+            ("denyhosts_lock_acquisitions_total", "counter", "acquisitions",
+                "Number of host lock acquisitions"),
+            ("denyhosts_lock_contentions_total", "counter", "contentions",
+                "Number of host lock acquisitions that had to wait"),
+            ("denyhosts_locked_hosts", "gauge", "locked_hosts",
+                "Number of hosts currently locked"),
+            ("denyhosts_lock_waiters", "gauge", "waiters",
+                "Number of requests waiting for a host lock")]:
+        lines += metrics.exposition_lines(name, kind, help, [("", (), (), stats[key])])
+    return lines
+
+metrics.add_collector(_lock_metrics)
+
+# IPv4 addresses that are not accepted from clients, as sorted, disjoint
+# (first, last) ranges of integers: unspecified, private, loopback, link
+# local, multicast and reserved. These are the addresses ipaddr reports as
+# such; IPv6 addresses are still checked with ipaddr.
+_ipv4_invalid_networks = [
+    ("0.0.0.0", 32),
+    ("10.0.0.0", 8),
+    ("127.0.0.0", 8),
+    ("169.254.0.0", 16),
+    ("172.16.0.0", 12),
+    ("192.168.0.0", 16),
+    ("224.0.0.0", 3),       # multicast 224.0.0.0/4 and reserved 240.0.0.0/4
+]
+
+def _ipv4_int(ip_address):
+    return struct.unpack("!I", socket.inet_pton(socket.AF_INET, ip_address))[0]
+
+_ipv4_invalid_starts = [_ipv4_int(network) for network, prefixlen in _ipv4_invalid_networks]
+_ipv4_invalid_ends = [_ipv4_int(network) + (1 << (32 - prefixlen)) - 1
+    for network, prefixlen in _ipv4_invalid_networks]
+
+def _is_valid_ipaddr(ip_address):
     try:
         ip = ipaddr.IPAddress(ip_address)
     except:
@@ -58,4 +157,127 @@ def is_valid_ip_address(ip_address):
         return False
     return True
 
+def is_valid_ip_address(ip_address):
+    """ Whether ip_address is a public IPv4 or IPv6 address """
+    if not isinstance(ip_address, basestring) or ":" in ip_address:
+        return _is_valid_ipaddr(ip_address)
+    try:
+        n = _ipv4_int(ip_address)
+    except (socket.error, TypeError, UnicodeError):
+        return False
+    i = bisect.bisect_right(_ipv4_invalid_starts, n) - 1
+    return i < 0 or n > _ipv4_invalid_ends[i]
+
+def split_valid_ip_addresses(ip_addresses):
+    """ Check a list of addresses with is_valid_ip_address(). Returns the
+    list of valid and the list of invalid addresses, in their original
+    order """
+    valid = []
+    invalid = []
+    inet_pton = socket.inet_pton
+    unpack = struct.unpack
+    bisect_right = bisect.bisect_right
+    starts = _ipv4_invalid_starts
+    ends = _ipv4_invalid_ends
+    for ip_address in ip_addresses:
+        if not isinstance(ip_address, basestring) or ":" in ip_address:
+            ok = _is_valid_ipaddr(ip_address)
+        else:
+            try:
+                n = unpack("!I", inet_pton(socket.AF_INET, ip_address))[0]
+            except (socket.error, TypeError, UnicodeError):
+                ok = False
+            else:
+                i = bisect_right(starts, n) - 1
+                ok = i < 0 or n > ends[i]
+        if ok:
+            valid.append(ip_address)
+        else:
+            invalid.append(ip_address)
+    return valid, invalid
+
+# IP addresses are stored in the database as 16 bytes: IPv6 addresses as
+# they are, IPv4 addresses mapped into IPv6 (::ffff:a.b.c.d). All
+# addresses have the same width, and addresses within a prefix are a
+# contiguous range.
+_ipv4_mapped_prefix = "\0" * 10 + "\xff\xff"
+
+def pack_ip(ip_address):
+    """ The 16 byte binary form of ip_address. Raises ValueError for
+    strings that are not an IP address """
+    try:
+        if ":" in ip_address:
+            return socket.inet_pton(socket.AF_INET6, ip_address)
+        return _ipv4_mapped_prefix + socket.inet_pton(socket.AF_INET, ip_address)
+    except (socket.error, TypeError, UnicodeError):
+        raise ValueError("Illegal IP address {!r}".format(ip_address))
+
+def unpack_ip(packed):
+    """ The IP address string of the binary form from pack_ip() """
+    if packed.startswith(_ipv4_mapped_prefix):
+        return socket.inet_ntop(socket.AF_INET, packed[12:])
+    return socket.inet_ntop(socket.AF_INET6, packed)
+
+def normalize_ip(ip_address):
+    """ The canonical form of ip_address, as it is read from the database """
+    return unpack_ip(pack_ip(ip_address))
+
+# Asynchronous XML-RPC client. Unlike twisted.web.xmlrpc.Proxy, which opens
+# a new connection for every call, this keeps connections to the servers
+# open between calls.
+_http_pool = None
+_http_agent = None
+# Maximum number of idle connections kept open per server
+max_persistent_connections = 4
+
+def _get_http_agent():
+    global _http_pool, _http_agent
+    if _http_agent is None:
+        _http_pool = HTTPConnectionPool(reactor, persistent=True)
+        _http_pool.maxPersistentPerHost = max_persistent_connections
+        _http_agent = Agent(reactor, connectTimeout=30, pool=_http_pool)
+    return _http_agent
+
+def close_http_connections():
+    """ Close all idle persistent connections. Returns a Deferred """
+    global _http_pool, _http_agent
+    pool = _http_pool
+    _http_pool = None
+    _http_agent = None
+    if pool is None:
+        return defer.succeed(None)
+    return pool.closeCachedConnections()
+
+@inlineCallbacks
+def xmlrpc_call(url, method, *args, **kwargs):
+    """ Call an XML-RPC method. Like xmlrpclib.ServerProxy, /RPC2 is used if
+    the url has no path. Returns a Deferred that fires with the result, or
+    fails with an xmlrpclib.Fault or other exception. Keyword arguments:
+    timeout, in seconds (default 60), and headers, a dict of extra HTTP
+    headers """
+    timeout = kwargs.get("timeout", 60)
+    headers = Headers({"Content-Type": ["text/xml"]})
+    for name, value in kwargs.get("headers", {}).iteritems():
+        headers.setRawHeaders(name, [value])
+    parts = urlparse.urlsplit(url)
+    if parts.path in ("", "/"):
+        url = urlparse.urlunsplit((parts.scheme, parts.netloc, "/RPC2", parts.query, parts.fragment))
+    body = xmlrpclib.dumps(args, method, allow_none=True)
+
+    # The Deferred to cancel when the call takes too long
+    pending = [_get_http_agent().request("POST", url, headers,
+        FileBodyProducer(StringIO(body)))]
+    timeout_call = reactor.callLater(timeout, lambda: pending[0].cancel())
+    try:
+        response = yield pending[0]
+        pending[0] = readBody(response)
+        data = yield pending[0]
+    finally:
+        if timeout_call.active():
+            timeout_call.cancel()
+    if response.code != 200:
+        raise Exception("HTTP error {} {} from {}".format(response.code, response.phrase, url))
+    result = xmlrpclib.loads(data)[0]
+    returnValue(result[0])
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -18,7 +18,7 @@ import time
 import logging
 import random
 
-from twisted.web import server, xmlrpc, error
+from twisted.web import http, server, xmlrpc, error
 from twisted.web.resource import Resource
 from twisted.web.xmlrpc import withRequest
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -32,12 +32,18 @@ import controllers
 import utils
 import stats
 import peering
+import metrics
 
 class Server(xmlrpc.XMLRPC):
     """
     An example object to be published.
     """
 
+    def lookupProcedure(self, procedurePath):
+        # Also called for the methods of the sub handlers, with the full path
+        return metrics.timed_procedure(procedurePath,
+            xmlrpc.XMLRPC.lookupProcedure(self, procedurePath))
+
     @withRequest
     @inlineCallbacks
     def xmlrpc_add_hosts(self, request, hosts):
@@ -49,11 +55,9 @@ class Server(xmlrpc.XMLRPC):
             logging.info("add_hosts({}) from {}".format(hosts, remote_ip))
             yield controllers.handle_report_from_client(remote_ip, now, hosts)
             try:
-                yield peering.send_update(remote_ip, now, hosts)
-            except xmlrpc.Fault, e:
-                raise e
+                peering.send_update(remote_ip, now, hosts)
             except Exception, e:
-                logging.warning("Error sending update to peers")
+                logging.warning("Error queueing update for peers")
         except xmlrpc.Fault, e:
             raise e
         except Exception, e:
@@ -85,10 +89,10 @@ class Server(xmlrpc.XMLRPC):
                 logging.warning("Illegal timestamp to get_new_hosts from client {}".format(remote_ip))
                 raise xmlrpc.Fault(103, "Illegal timestamp.")
 
-            for host in hosts_added:
-                if not utils.is_valid_ip_address(host):
-                    logging.warning("Illegal host ip address {}".format(host))
-                    raise xmlrpc.Fault(101, "Illegal IP address \"{}\".".format(host))
+            invalid = utils.split_valid_ip_addresses(hosts_added)[1]
+            if len(invalid) > 0:
+                logging.warning("Illegal host ip address {}".format(invalid[0]))
+                raise xmlrpc.Fault(101, "Illegal IP address \"{}\".".format(invalid[0]))
 
             # TODO: maybe refuse timestamp from far past because it will 
             # cause much work? OTOH, denyhosts will use timestamp=0 for 
@@ -96,10 +100,11 @@ class Server(xmlrpc.XMLRPC):
             # TODO: check if client IP is a known cracker
 
             result = {}
-            result['timestamp'] = str(long(time.time()))
-            result['hosts'] = yield controllers.get_qualifying_crackers(
+            new_timestamp, hosts = yield controllers.get_new_hosts(
                     threshold, resiliency, timestamp, 
                     config.max_reported_crackers, set(hosts_added))
+            result['timestamp'] = str(new_timestamp)
+            result['hosts'] = hosts
             logging.debug("returning: {}".format(result))
         except xmlrpc.Fault, e:
             raise e
@@ -119,15 +124,44 @@ class WebResource(Resource):
     def render_GET(self, request):
         logging.debug("GET({})".format(request))
         request.setHeader("Content-Type", "text/html; charset=utf-8")
-        def done(result):
-            if result is None:
+        request.setHeader("Vary", "Accept-Encoding")
+        def done(page):
+            if page is None:
                 request.write("<h1>An error has occurred</h1>")
+                request.finish()
+                return
+            if _accepts_gzip(request):
+                etag, body = page["gzip_etag"], page["gzip"]
+                request.setHeader("Content-Encoding", "gzip")
+            else:
+                etag, body = page["etag"], page["html"]
+            # If-None-Match takes precedence over If-Modified-Since
+            if request.getHeader("If-None-Match") is not None:
+                request.setHeader("Last-Modified", http.datetimeToString(page["last_modified"]))
+                cached = request.setETag(etag)
             else:
-                request.write(result.encode('utf-8'))
+                request.setETag(etag)
+                cached = request.setLastModified(page["last_modified"])
+            if cached != http.CACHED:
+                request.setHeader("Content-Length", str(len(body)))
+                request.write(body)
             request.finish()
         def fail(err):
             request.processingFailed(err)
-        stats.render_stats().addCallbacks(done, fail)
+        stats.get_stats_page().addCallbacks(done, fail)
         return server.NOT_DONE_YET
 
+def _accepts_gzip(request):
+    accept = request.getHeader("Accept-Encoding")
+    if accept is None:
+        return False
+    for coding in accept.split(","):
+        params = [p.strip() for p in coding.split(";")]
+        if params[0].lower() in ("gzip", "x-gzip"):
+            for param in params[1:]:
+                if param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000"):
+                    return False
+            return True
+    return False
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
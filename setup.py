@@ -14,7 +14,7 @@ setup(name='denyhosts-server',
       url='https://github.com/janpascal/denyhosts_sync',
       packages=['denyhosts_server'],
       install_requires=["Twisted", "twistar", "ipaddr", "jinja2", "numpy", "matplotlib", "GeoIP", "minify", "libnacl"],
-      scripts=['scripts/denyhosts-server'],
+      scripts=['scripts/denyhosts-server', 'scripts/denyhosts-loadgen'],
       data_files=[
         ('static/js', glob('static/js/*.min.js')),
         ('static/css', glob('static/css/*.min.css')),
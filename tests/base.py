@@ -9,14 +9,19 @@ from denyhosts_server import main
 from denyhosts_server import database
 
 from twisted.trial import unittest
-from twisted.enterprise import adbapi
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from twistar.registry import Registry
 
+# Configuration file in this directory used by the tests, for instance
+# test-postgresql.conf to run them on PostgreSQL
+default_config = os.environ.get("DENYHOSTS_TEST_CONFIG", "test.conf")
+
 class TestBase(unittest.TestCase):
     @inlineCallbacks
-    def setUp(self, config_basename="test.conf"):
+    def setUp(self, config_basename=None):
+        if config_basename is None:
+            config_basename = default_config
         configfile = os.path.join(
             os.path.dirname(inspect.getsourcefile(TestBase)),
             config_basename
@@ -24,7 +29,7 @@ class TestBase(unittest.TestCase):
 
         config.read_config(configfile)
 
-        Registry.DBPOOL = adbapi.ConnectionPool(config.dbtype, **config.dbparams)
+        database.connect()
         Registry.register(models.Cracker, models.Report, models.Legacy)
 
         yield database.clean_database(quiet=True)
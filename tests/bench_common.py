@@ -0,0 +1,124 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Helper functions for the benchmark scripts in this directory. These are
+# not unit tests; run the bench_*.py scripts from the project root directory,
+# e.g. PYTHONPATH=. python tests/bench_get_new_hosts.py
+
+import argparse
+import inspect
+import os.path
+import random
+import time
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from twistar.registry import Registry
+
+from denyhosts_server import config
+from denyhosts_server import database
+from denyhosts_server import models
+
+def argument_parser(description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("-c", "--config",
+        default=os.path.join(os.path.dirname(inspect.getsourcefile(argument_parser)), "test.conf"),
+        help="Configuration file (default: tests/test.conf)")
+    parser.add_argument("-n", "--reports", type=int, default=1000000,
+        help="Number of reports in the generated database (default: 1000000)")
+    parser.add_argument("--reuse", action="store_true",
+        help="Do not regenerate the database, reuse the existing one")
+    parser.add_argument("--seed", type=int, default=1,
+        help="Random seed used to generate the database")
+    return parser
+
+def connect(configfile):
+    config.read_config(configfile)
+    database.connect()
+    Registry.register(models.Cracker, models.Report, models.Legacy)
+
+def _random_ip(rng):
+    return ".".join(str(rng.randint(1, 254)) for _ in range(4))
+
+def _cracker_ip(cracker_id):
+    # Unique, public address for every cracker id, starting at 11.0.0.1
+    n = 0x0b000000 + cracker_id
+    return "{}.{}.{}.{}".format(n >> 24, (n >> 16) & 255, (n >> 8) & 255, n & 255)
+
+def _fill_txn(txn, num_reports, seed, now):
+    rng = random.Random(seed)
+    num_reporters = max(num_reports // 200, 10)
+    reporters = [_random_ip(rng) for _ in xrange(num_reporters)]
+
+    crackers = []
+    reports = []
+    cracker_id = 0
+    report_id = 0
+    while report_id < num_reports:
+        cracker_id += 1
+        # Most crackers get reported only a few times, some very often
+        count = min(int(rng.paretovariate(1.2)), 200, num_reporters,
+            num_reports - report_id)
+        first_time = now - rng.random()*30*24*3600
+        latest_time = first_time
+        total_reports = 0
+        for reporter in rng.sample(reporters, count):
+            report_id += 1
+            first_report_time = first_time + rng.random()*(now - first_time)
+            latest_report_time = first_report_time + rng.random()*(now - first_report_time)
+            reports.append((report_id, cracker_id, database.ip_param(reporter),
+                int(first_report_time), int(latest_report_time)))
+            latest_time = max(latest_time, latest_report_time)
+            total_reports += rng.randint(1, 5)
+        crackers.append((cracker_id, database.ip_param(_cracker_ip(cracker_id)),
+            int(first_time), int(latest_time),
+            total_reports, count, int(latest_time) - int(first_time)))
+
+        if len(reports) >= 10000:
+            txn.executemany(database.translate_query("""
+                INSERT INTO reports (id, cracker_id, ip_address, first_report_time, latest_report_time)
+                VALUES (?,?,?,?,?)"""), reports)
+            reports = []
+    txn.executemany(database.translate_query("""
+        INSERT INTO reports (id, cracker_id, ip_address, first_report_time, latest_report_time)
+        VALUES (?,?,?,?,?)"""), reports)
+    txn.executemany(database.translate_query("""
+        INSERT INTO crackers (id, ip_address, first_time, latest_time,
+            total_reports, current_reports, resiliency)
+        VALUES (?,?,?,?,?,?,?)"""), crackers)
+    return cracker_id
+
+@inlineCallbacks
+def fill_database(num_reports, seed=1, now=None):
+    """ Wipe the database and fill it with num_reports random reports """
+    if now is None:
+        now = time.time()
+    yield database.clean_database(quiet=True)
+    print("Generating database with {} reports...".format(num_reports))
+    start = time.time()
+    num_crackers = yield Registry.DBPOOL.runInteraction(_fill_txn, num_reports, seed, now)
+    print("Generated {} reports for {} crackers in {:.1f} seconds".format(
+        num_reports, num_crackers, time.time() - start))
+
+@inlineCallbacks
+def timed(func, *args, **kwargs):
+    """ Call func, which should return a Deferred, and return a tuple with
+    the elapsed time and the result """
+    start = time.time()
+    result = yield func(*args, **kwargs)
+    returnValue((time.time() - start, result))
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
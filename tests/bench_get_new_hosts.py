@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of controllers.get_qualifying_crackers against the previous,
+# per-cracker ORM implementation. Run from the project root directory:
+#   PYTHONPATH=. python tests/bench_get_new_hosts.py -n 1000000
+
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from denyhosts_server import controllers
+from denyhosts_server.models import Cracker, Legacy
+from denyhosts_server import database
+
+import bench_common
+
+# Previous implementation, one Cracker.find() and one reports query per
+# candidate cracker. Kept here as a reference for timing and correctness.
+@inlineCallbacks
+def get_qualifying_crackers_orm(min_reports, min_resilience, previous_timestamp,
+        max_crackers, latest_added_hosts):
+    cracker_ids = yield database.run_query("""
+            SELECT DISTINCT c.id, c.ip_address
+            FROM crackers c
+            WHERE (c.current_reports >= ?)
+                AND (c.resiliency >= ?)
+                AND (c.latest_time >= ?)
+            ORDER BY c.first_time DESC
+            """, min_reports, min_resilience, previous_timestamp)
+    if cracker_ids is None:
+        returnValue([])
+
+    result = []
+    for c in cracker_ids:
+        cracker_id = c[0]
+        if database.ip_value(c[1]) in latest_added_hosts:
+            continue
+        cracker = yield Cracker.find(cracker_id)
+        if cracker is None:
+            continue
+        reports = yield cracker.reports.get(orderby="first_report_time ASC")
+        if (len(reports)>=min_reports and
+            reports[min_reports-1].first_report_time >= previous_timestamp):
+            result.append(cracker.ip_address)
+        else:
+            satisfied = False
+            for report in reports:
+                if (not satisfied and
+                    report.latest_report_time>=previous_timestamp and
+                    report.latest_report_time-cracker.first_time>=min_resilience):
+                    satisfied = True
+                if (report.latest_report_time<=previous_timestamp and
+                    report.latest_report_time-cracker.first_time>=min_resilience):
+                    satisfied = False
+                    break
+            if satisfied:
+                result.append(cracker.ip_address)
+        if len(result)>=max_crackers:
+            break
+
+    if len(result) < max_crackers:
+        extras = yield Legacy.find(where=["retrieved_time>?", previous_timestamp],
+            orderby="retrieved_time DESC", limit=max_crackers-len(result))
+        result = result + [extra.ip_address for extra in extras]
+
+    returnValue(result)
+
+@inlineCallbacks
+def run_benchmark(reactor, args):
+    bench_common.connect(args.config)
+    now = time.time()
+    if not args.reuse:
+        yield bench_common.fill_database(args.reports, args.seed, now)
+
+    # (description, threshold, resiliency, timestamp)
+    scenarios = [
+        ("first sync", 3, 3*3600, 0),
+        ("sync after 1 day", 3, 3*3600, now - 24*3600),
+        ("sync after 10 minutes", 3, 3*3600, now - 600),
+        ("sync after 1 hour, high threshold", 10, 24*3600, now - 3600),
+    ]
+
+    for description, threshold, resiliency, timestamp in scenarios:
+        old_time, old_result = yield bench_common.timed(get_qualifying_crackers_orm,
+            threshold, resiliency, timestamp, 50, set())
+        new_time, new_result = yield bench_common.timed(controllers.get_qualifying_crackers,
+            threshold, resiliency, timestamp, 50, set())
+        print("{}: {} hosts; old {:.3f}s, new {:.3f}s, speedup {:.1f}x{}".format(
+            description, len(new_result), old_time, new_time,
+            old_time / max(new_time, 1e-6),
+            "" if old_result == new_result else " RESULTS DIFFER!"))
+
+if __name__ == '__main__':
+    parser = bench_common.argument_parser("Benchmark get_new_hosts query")
+    task.react(run_benchmark, [parser.parse_args()])
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
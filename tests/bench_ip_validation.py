@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# Benchmark of the IP address validation: the previous check of every
+# address with ipaddr, against utils.is_valid_ip_address and the batch
+# check utils.split_valid_ip_addresses. Does not need a database. Run from
+# the project root directory:
+#   PYTHONPATH=. python tests/bench_ip_validation.py -n 100000
+
+import argparse
+import random
+import time
+
+from denyhosts_server import utils
+
+def random_hosts(rng, count):
+    # Mostly public IPv4 addresses, some invalid ones and some IPv6
+    hosts = []
+    for i in xrange(count):
+        r = rng.random()
+        if r < 0.9:
+            hosts.append(".".join(str(rng.randint(0, 255)) for _ in range(4)))
+        elif r < 0.95:
+            hosts.append("2001:db8::{:x}".format(rng.randint(1, 0xffff)))
+        else:
+            hosts.append(rng.choice(["localhost", "1.2.3", "256.1.1.1", "01.2.3.4", ""]))
+    return hosts
+
+def timed(f, *args):
+    start = time.time()
+    result = f(*args)
+    return time.time() - start, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark IP address validation")
+    parser.add_argument("-n", "--hosts", type=int, default=100000,
+        help="Number of addresses to validate (default: 100000)")
+    parser.add_argument("--seed", type=int, default=1,
+        help="Random seed used to generate the addresses")
+    args = parser.parse_args()
+
+    hosts = random_hosts(random.Random(args.seed), args.hosts)
+    results = []
+    for description, check in [
+            ("ipaddr", lambda hosts: [h for h in hosts if utils._is_valid_ipaddr(h)]),
+            ("per address", lambda hosts: [h for h in hosts if utils.is_valid_ip_address(h)]),
+            ("batch", lambda hosts: utils.split_valid_ip_addresses(hosts)[0])]:
+        elapsed, valid = timed(check, hosts)
+        print("{}: validated {} addresses in {:.3f}s, {} valid".format(
+            description, len(hosts), elapsed, len(valid)))
+        results.append((elapsed, valid))
+
+    print("Speedup {:.1f}x per address, {:.1f}x batch{}".format(
+        results[0][0] / max(results[1][0], 1e-6), results[0][0] / max(results[2][0], 1e-6),
+        "" if results[0][1] == results[1][1] == results[2][1] else ", RESULTS DIFFER!"))
+
+if __name__ == '__main__':
+    main()
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+# Benchmark of the report expiry in controllers.perform_maintenance against
+# the previous, per-report ORM implementation. Both run on a freshly
+# generated database. Run from the project root directory:
+#   PYTHONPATH=. python tests/bench_maintenance.py -n 100000
+
+import time
+
+from twisted.internet import task
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+from denyhosts_server import controllers
+from denyhosts_server import database
+from denyhosts_server import utils
+from denyhosts_server.models import Report
+
+import bench_common
+
+# Previous implementation of the report expiry, one report at a time. Kept
+# here as a reference for timing and correctness.
+@inlineCallbacks
+def expire_reports_orm(limit):
+    reports_deleted = 0
+    crackers_deleted = 0
+    while True:
+        old_reports = yield Report.find(where=["latest_report_time<?", limit], limit=1000)
+        if len(old_reports) == 0:
+            break
+        for report in old_reports:
+            cracker = yield report.cracker.get()
+            yield utils.wait_and_lock_host(cracker.ip_address)
+            try:
+                yield report.cracker.clear()
+                yield report.delete()
+                reports_deleted += 1
+
+                current_reports = yield cracker.reports.get(group='ip_address')
+                cracker.current_reports = len(current_reports)
+                yield cracker.save()
+
+                if cracker.current_reports == 0:
+                    yield cracker.delete()
+                    crackers_deleted += 1
+            finally:
+                utils.unlock_host(cracker.ip_address)
+    returnValue((reports_deleted, crackers_deleted))
+
+@inlineCallbacks
+def expire_reports_bulk(limit):
+    # Expire the legacy list far in the past, so only reports are expired
+    yield controllers.perform_maintenance(limit=limit, legacy_limit=0)
+
+@inlineCallbacks
+def database_state():
+    rows = yield database.run_query("""
+        SELECT COUNT(*), SUM(current_reports), SUM(total_reports) FROM crackers""")
+    crackers = rows[0]
+    rows = yield database.run_query("SELECT COUNT(*) FROM reports")
+    returnValue((crackers[0], crackers[1], crackers[2], rows[0][0]))
+
+@inlineCallbacks
+def run_benchmark(reactor, args):
+    bench_common.connect(args.config)
+    now = time.time()
+    limit = now - 15*24*3600
+
+    results = []
+    for description, expire in [("old", expire_reports_orm), ("new", expire_reports_bulk)]:
+        yield bench_common.fill_database(args.reports, args.seed, now)
+        elapsed, _ = yield bench_common.timed(expire, limit)
+        state = yield database_state()
+        print("{}: expired reports older than 15 days in {:.3f}s; {} crackers, {} reports left".format(
+            description, elapsed, state[0], state[3]))
+        results.append((elapsed, state))
+
+    print("Speedup {:.1f}x{}".format(results[0][0] / max(results[1][0], 1e-6),
+        "" if results[0][1] == results[1][1] else ", RESULTING DATABASES DIFFER!"))
+
+if __name__ == '__main__':
+    parser = bench_common.argument_parser("Benchmark maintenance job")
+    task.react(run_benchmark, [parser.parse_args()])
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,120 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from denyhosts_server import cache
+from denyhosts_server import config
+from denyhosts_server import controllers
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+
+import base
+
+class LRUCacheTest(unittest.TestCase):
+
+    def test_lru(self):
+        c = cache.LRUCache(2)
+        c.put("a", 1)
+        c.put("b", 2)
+        self.assertEqual(c.get("a"), 1, "Cached value should be returned")
+        c.put("c", 3)
+        self.assertEqual(c.get("b"), None, "Least recently used entry should be evicted")
+        self.assertEqual(c.get("a"), 1, "Recently used entry should be kept")
+        self.assertEqual(c.get("c"), 3, "New entry should be kept")
+        self.assertEqual((c.hits, c.misses), (3, 1), "Hits and misses should be counted")
+
+    def test_expiry(self):
+        c = cache.LRUCache(10, ttl=60)
+        c.put("a", 1)
+        c.put("b", 2, ttl=0)
+        self.assertEqual(c.get("a"), 1, "Entry within ttl should be returned")
+        self.assertEqual(c.get("b"), None, "Expired entry should not be returned")
+        c.expire_within(0)
+        self.assertEqual(c.get("a"), None, "Aged entry should expire")
+
+    def test_disabled(self):
+        c = cache.LRUCache(0)
+        c.put("a", 1)
+        self.assertEqual(len(c), 0, "Cache with size 0 should not store anything")
+
+class BloomFilterTest(unittest.TestCase):
+
+    def test_bloom_filter(self):
+        bloom = cache.BloomFilter(1000, error_rate=0.01)
+        for i in range(1000):
+            bloom.add("10.0.{}.{}".format(i // 256, i % 256))
+        self.assertEqual(bloom.count, 1000)
+        for i in range(1000):
+            self.assertTrue("10.0.{}.{}".format(i // 256, i % 256) in bloom,
+                "Added items should always be found")
+        false_positives = sum(1 for i in range(10000)
+            if "192.168.{}.{}".format(i // 256, i % 256) in bloom)
+        self.assertTrue(false_positives < 300,
+            "False positive rate should be close to the error rate, got {} in 10000".format(false_positives))
+
+class NewHostsCacheTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        config.new_hosts_cache_size = 10
+        controllers.configure_new_hosts_cache()
+        self.addCleanup(controllers.configure_new_hosts_cache)
+        self.addCleanup(setattr, config, "new_hosts_cache_size", 0)
+
+    @inlineCallbacks
+    def test_new_hosts_cache(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now - 100, ["10.0.0.1", "10.0.0.2", "10.0.0.3"])])
+
+        timestamp = long(now) - 3600
+        timestamp -= timestamp % config.new_hosts_cache_granularity
+        first_timestamp, hosts = yield controllers.get_new_hosts(1, 0, timestamp, 50, set())
+        self.assertEqual(sorted(hosts), ["10.0.0.1", "10.0.0.2", "10.0.0.3"], "All hosts should be returned")
+
+        # Same timestamp bucket, answered from the cache
+        new_timestamp, hosts = yield controllers.get_new_hosts(1, 0, timestamp + 1, 50, set(["10.0.0.1"]))
+        self.assertEqual(sorted(hosts), ["10.0.0.2", "10.0.0.3"], "Hosts added by client should be filtered out")
+        self.assertEqual(new_timestamp, first_timestamp, "Timestamp of cached result should be returned")
+        stats = controllers.get_new_hosts_cache_stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1), "Second request should be a cache hit")
+
+        # Too many hosts filtered out for the cached list
+        self.patch(controllers, "_new_hosts_cache_margin", 0)
+        new_timestamp, hosts = yield controllers.get_new_hosts(1, 0, timestamp, 1, set(["10.0.0.1", "10.0.0.2"]))
+        self.assertEqual(hosts, ["10.0.0.3"], "Request should fall back to the database")
+
+        # New reports age the cached results
+        self.patch(controllers, "_new_hosts_cache_write_ttl", 0)
+        yield controllers.queue_reports([("127.0.0.1", now, ["10.0.0.4"])])
+        new_timestamp, hosts = yield controllers.get_new_hosts(1, 0, timestamp, 50, set())
+        self.assertEqual(len(hosts), 4, "New report should be visible after aging the cache")
+
+    @inlineCallbacks
+    def test_concurrent_requests(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now - 100, ["10.0.0.1"])])
+
+        results = yield defer.gatherResults([
+            controllers.get_new_hosts(1, 0, long(now) - 3600, 50, set()) for i in range(5)])
+        self.assertEqual(set(tuple(hosts) for (timestamp, hosts) in results), set([("10.0.0.1",)]),
+            "All concurrent requests should get the same result")
+        self.assertEqual(controllers._new_hosts_pending, {}, "No computations should be pending")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
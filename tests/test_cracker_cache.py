@@ -0,0 +1,113 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from denyhosts_server import config
+from denyhosts_server import controllers
+from denyhosts_server import cracker_cache
+from denyhosts_server import database
+from denyhosts_server import metrics
+from denyhosts_server import summary
+from denyhosts_server.models import Cracker
+
+from twisted.internet.defer import inlineCallbacks
+
+import base
+
+class CrackerCacheTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        self.patch(config, "cracker_cache_size", 100)
+        self.patch(metrics.cracker_cache_lookups, "_values", {})
+        self.patch(metrics.cracker_cache_stale, "_values", {})
+        self.addCleanup(cracker_cache.clear)
+        yield cracker_cache.configure()
+
+    def lookups(self, result):
+        return metrics.cracker_cache_lookups._values.get((result,), 0)
+
+    @inlineCallbacks
+    def assert_counts(self, host, total_reports, current_reports):
+        cracker = yield controllers.get_cracker(host)
+        self.assertEqual((cracker.total_reports, cracker.current_reports),
+            (total_reports, current_reports), "Counters of {} should be correct".format(host))
+
+    @inlineCallbacks
+    def test_cached_reports(self):
+        now = time.time()
+        yield controllers.queue_reports([
+            ("127.0.0.1", now - 100, ["10.0.0.1", "10.0.0.2"])])
+        self.assertEqual(self.lookups("new"), 2, "Unknown addresses should be found new by the filter")
+
+        yield controllers.queue_reports([
+            ("127.0.0.2", now - 50, ["10.0.0.1", "10.0.0.3"]),
+            ("127.0.0.1", now, ["10.0.0.1"])])
+        self.assertEqual(self.lookups("hit"), 1, "Stored crackers should be cached")
+        self.assertEqual(self.lookups("new"), 3)
+
+        yield self.assert_counts("10.0.0.1", 3, 2)
+        yield self.assert_counts("10.0.0.2", 1, 1)
+        yield self.assert_counts("10.0.0.3", 1, 1)
+        counters = yield database.run_read_interaction(summary.get_counters_txn)
+        self.assertEqual((counters["num_hosts"], counters["num_reports"]), (3, 4))
+        self.assertEqual(cracker_cache.stats()["filter_size"], 3)
+
+    @inlineCallbacks
+    def test_stale_entries(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now - 100, ["10.0.0.1"])])
+
+        # Changed and inserted behind the back of the cache
+        yield database.run_operation(
+            "UPDATE crackers SET total_reports=total_reports+1 WHERE ip_address=?",
+            database.ip_param("10.0.0.1"))
+        yield Cracker(ip_address="10.0.0.2", first_time=now - 100, latest_time=now - 100,
+            resiliency=0, total_reports=0, current_reports=0).save()
+
+        yield controllers.queue_reports([("127.0.0.2", now, ["10.0.0.1"])])
+        self.assertEqual(metrics.cracker_cache_stale._values.get((), 0), 1,
+            "Out of date cache entry should be detected")
+        yield self.assert_counts("10.0.0.1", 3, 2)
+
+        yield controllers.queue_reports([("127.0.0.2", now, ["10.0.0.2"])])
+        self.assertEqual(metrics.cracker_cache_stale._values.get((), 0), 2,
+            "Cracker missing from the filter should be detected")
+        yield self.assert_counts("10.0.0.2", 1, 1)
+        rows = yield database.run_query("SELECT COUNT(*) FROM crackers WHERE ip_address=?",
+            database.ip_param("10.0.0.2"))
+        self.assertEqual(rows[0][0], 1, "Cracker should not be inserted twice")
+
+        # Changes through the controllers invalidate the cache
+        cracker = yield controllers.get_cracker("10.0.0.1")
+        yield controllers.add_report_to_cracker(cracker, "127.0.0.3", when=now)
+        yield controllers.queue_reports([("127.0.0.4", now, ["10.0.0.1"])])
+        self.assertEqual(metrics.cracker_cache_stale._values.get((), 0), 2)
+        yield self.assert_counts("10.0.0.1", 5, 4)
+
+    @inlineCallbacks
+    def test_purge(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now, ["10.0.0.1"])])
+        yield controllers.purge_ip("10.0.0.1")
+        yield controllers.queue_reports([("127.0.0.1", now, ["10.0.0.1"])])
+        self.assertEqual(metrics.cracker_cache_stale._values.get((), 0), 0,
+            "Purged crackers should be removed from the cache")
+        yield self.assert_counts("10.0.0.1", 1, 1)
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,123 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import time
+
+from denyhosts_server import config
+from denyhosts_server import controllers
+from denyhosts_server import cracker_index
+from denyhosts_server.models import Cracker
+
+from twistar.registry import Registry
+from twisted.internet.defer import inlineCallbacks, returnValue
+
+import base
+
+class CrackerIndexTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        config.cracker_index_hours = 48
+        self.addCleanup(cracker_index.clear)
+
+    def random_reports(self, rng, now, count):
+        records = []
+        for i in range(count):
+            records.append((
+                "127.0.0.{}".format(rng.randint(1, 6)),
+                now - rng.randint(0, 40*3600),
+                ["10.0.0.{}".format(rng.randint(1, 30))]
+            ))
+        return records
+
+    @inlineCallbacks
+    def assert_same_results(self, now):
+        total = 0
+        for threshold, resiliency, age in [(1, 0, 3600), (2, 3600, 6*3600), (3, 3600, 24*3600), (2, 0, 600)]:
+            timestamp = now - age
+            self.assertTrue(cracker_index.covers(timestamp), "Index should cover timestamp")
+            expected = yield controllers._qualifying_from_database(threshold, resiliency, timestamp, 50, set())
+            hosts = controllers._qualifying_from_index(threshold, resiliency, timestamp, 50, set())
+            self.assertEqual(hosts, expected, "Index should give the same result as the database")
+            total += len(hosts)
+        self.assertTrue(total > 0, "Some hosts should qualify")
+
+    @inlineCallbacks
+    def test_index(self):
+        rng = random.Random(1)
+        now = time.time()
+
+        yield controllers.queue_reports(self.random_reports(rng, now, 100))
+        yield cracker_index.configure()
+        self.assertTrue(cracker_index.is_loaded(), "Index should be loaded")
+        yield self.assert_same_results(now)
+
+        # Index is kept up to date by new reports
+        yield controllers.queue_reports(self.random_reports(rng, now, 100))
+        differences = yield cracker_index.check_consistency()
+        self.assertEqual(differences, [], "Index should be consistent after adding reports")
+        yield self.assert_same_results(now)
+
+        # and by maintenance
+        yield controllers.perform_maintenance(limit=now - 20*3600)
+        differences = yield cracker_index.check_consistency()
+        self.assertEqual(differences, [], "Index should be consistent after maintenance")
+        yield self.assert_same_results(now)
+
+        yield controllers.purge_ip("10.0.0.1")
+        differences = yield cracker_index.check_consistency()
+        self.assertEqual(differences, [], "Index should be consistent after purging an address")
+
+    @inlineCallbacks
+    def test_old_timestamp_uses_database(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now - 72*3600, ["10.0.0.1"])])
+        yield cracker_index.configure()
+
+        self.assertFalse(cracker_index.covers(now - 72*3600), "Index should not cover old timestamp")
+        hosts = yield controllers.get_qualifying_crackers(1, 0, now - 73*3600, 50, set())
+        self.assertEqual(hosts, ["10.0.0.1"], "Old timestamp should be answered from the database")
+
+    @inlineCallbacks
+    def test_update_while_loading(self):
+        now = time.time()
+        yield controllers.queue_reports([("127.0.0.1", now - 3600, ["10.0.0.1", "10.0.0.2"])])
+        crackers = yield Cracker.all()
+        cracker_ids = [cracker.id for cracker in crackers]
+
+        # State of the crackers as committed by a transaction...
+        yield cracker_index.configure()
+        fetched = yield Registry.DBPOOL.runInteraction(cracker_index.fetch_txn, cracker_ids)
+        self.assertNotEqual(fetched, None, "Loaded index should fetch updates")
+        cracker_index.clear()
+
+        # ...that the load did not see, and that finished while loading
+        fetch_since_txn = cracker_index._fetch_since_txn
+        cracker_index._fetch_since_txn = lambda txn, since: ([], [])
+        try:
+            d = cracker_index.configure()
+        finally:
+            cracker_index._fetch_since_txn = fetch_since_txn
+        self.assertFalse(cracker_index.is_loaded(), "Index should still be loading")
+        cracker_index.update(fetched)
+        yield d
+
+        differences = yield cracker_index.check_consistency()
+        self.assertEqual(differences, [], "Update made while loading should reach the index")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
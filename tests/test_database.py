@@ -0,0 +1,247 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import datetime
+import sqlite3
+import threading
+
+from denyhosts_server import config
+from denyhosts_server import controllers
+from denyhosts_server import database
+
+from twisted.internet import threads
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twistar.registry import Registry
+
+import base
+
+class DatabaseTest(base.TestBase):
+
+    def test_translate(self):
+        self.assertEqual(database._translate(
+                "SELECT * FROM t WHERE a=? AND b='why?' AND `c?`=? AND d LIKE 'x%'", "MySQLdb"),
+            "SELECT * FROM t WHERE a=%s AND b='why?' AND `c?`=%s AND d LIKE 'x%%'",
+            "Only placeholders outside quotes should be translated, and % escaped")
+        self.assertEqual(database._translate("SELECT 'it\\'s?', ?", "MySQLdb"),
+            "SELECT 'it\\'s?', %s", "Escaped quotes should not end a string")
+        self.assertEqual(database._translate("SELECT ? WHERE a='?'", "sqlite3"),
+            "SELECT ? WHERE a='?'", "sqlite uses ? placeholders")
+
+    def test_translate_postgresql(self):
+        self.assertEqual(database._translate(
+                "SELECT `key`, `value` FROM info WHERE `key`=? AND a LIKE 'x%'", "psycopg2"),
+            "SELECT \"key\", \"value\" FROM info WHERE \"key\"=%s AND a LIKE 'x%%'",
+            "Backticks should become double quotes")
+        self.assertEqual(database._translate(
+                "INSERT IGNORE INTO reporters (ip_address, num_reports) VALUES (?,0)", "psycopg2"),
+            "INSERT INTO reporters (ip_address, num_reports) VALUES (%s,0) ON CONFLICT DO NOTHING")
+        self.assertEqual(database._translate(
+                "CREATE TABLE t (ip_address CHAR(15), c INTEGER)", "psycopg2"),
+            "CREATE TABLE t (ip_address VARCHAR(15), c INTEGER)",
+            "CHAR columns should be created as VARCHAR")
+        self.assertEqual(database._translate("SELECT 'it\\'", "psycopg2"), "SELECT 'it\\'",
+            "Backslashes are not escapes in standard strings")
+
+    def test_registered_query(self):
+        self.patch(database, "_queries", {})
+        self.patch(database, "_translated", {})
+        database.register_query("test.select", "SELECT id FROM t WHERE a=?")
+        database.register_query("test.dialect", lambda: database.insert_ignore("t") + " VALUES (?)")
+
+        self.patch(config, "dbtype", "sqlite3")
+        self.assertEqual(database.translate_query("test.select"), "SELECT id FROM t WHERE a=?")
+        self.patch(config, "dbtype", "MySQLdb")
+        self.assertEqual(database.translate_query("test.select"), "SELECT id FROM t WHERE a=%s",
+            "Registered queries should be translated per database type")
+        self.assertEqual(database.translate_query("test.dialect"), "INSERT IGNORE INTO t VALUES (%s)")
+        self.assertEqual(database.translate_query("SELECT ?"), "SELECT %s",
+            "Query text should still be accepted")
+
+    def test_in_list(self):
+        self.assertEqual(database.in_list([1]), ("?", (1,)))
+        self.assertEqual(database.in_list([1, 2, 3]), ("?,?,?,?", (1, 2, 3, 3)),
+            "IN lists should be padded to a power of two")
+        placeholders, values = database.in_list(range(300))
+        self.assertEqual(len(values), database.max_in_params,
+            "IN lists should not be padded beyond max_in_params")
+        self.assertEqual(database.expand_in("SELECT x FROM t WHERE id IN ({})", [5, 6, 7]),
+            ("SELECT x FROM t WHERE id IN (?,?,?,?)", (5, 6, 7, 7)))
+
+    @inlineCallbacks
+    def test_run_many_and_select_in(self):
+        yield database.run_many("INSERT INTO legacy (ip_address, retrieved_time) VALUES (?,?)",
+            [(database.ip_param("192.0.2.{}".format(i)), i) for i in range(1, 8)])
+        rows = yield Registry.DBPOOL.runInteraction(database.select_in,
+            "SELECT ip_address FROM legacy WHERE retrieved_time IN ({})", [2, 3, 5])
+        self.assertEqual(sorted(database.ip_value(row[0]) for row in rows),
+            ["192.0.2.2", "192.0.2.3", "192.0.2.5"],
+            "Padding the IN list should not duplicate rows")
+
+    @inlineCallbacks
+    def test_add_to_rows_and_bulk_insert(self):
+        date = datetime.date
+        def txn(txn):
+            database.add_to_rows(txn, "daily_counters", ["`date`", "num_reports"],
+                [(date(2017, 1, 1), 2), (date(2017, 1, 2), 3)])
+            database.add_to_rows(txn, "daily_counters", ["`date`", "num_reports"],
+                [(date(2017, 1, 1), 5)])
+            database.bulk_insert(txn, "history", ["`date`", "num_reports"],
+                [(date(2017, 1, 1), 1), (date(2017, 1, 2), 1)])
+            database.bulk_insert(txn, "history", ["`date`", "num_reports"],
+                [(date(2017, 1, 2), 7)], replace=True)
+            database.execute(txn, "SELECT `date`, num_reports FROM daily_counters ORDER BY `date`")
+            counters = txn.fetchall()
+            database.execute(txn, "SELECT `date`, num_reports FROM history ORDER BY `date`")
+            return counters, txn.fetchall()
+        counters, history = yield Registry.DBPOOL.runInteraction(txn)
+        self.assertEqual([tuple(row) for row in counters], [(date(2017, 1, 1), 7), (date(2017, 1, 2), 3)],
+            "Values should be added to existing rows")
+        self.assertEqual([tuple(row) for row in history], [(date(2017, 1, 1), 1), (date(2017, 1, 2), 7)],
+            "Rows with the same key should be replaced")
+
+    def test_set_rows_upsert(self):
+        class FakeCursor(object):
+            def __init__(self):
+                self.statements = []
+            def execute(self, query, args):
+                self.statements.append((query, args))
+        self.patch(database, "_translated", {})
+        for dbtype, conflict in [
+                ("MySQLdb", " ON DUPLICATE KEY UPDATE retrieved_time=VALUES(retrieved_time)"),
+                ("psycopg2", " ON CONFLICT (ip_address) DO UPDATE SET retrieved_time=EXCLUDED.retrieved_time")]:
+            self.patch(config, "dbtype", dbtype)
+            txn = FakeCursor()
+            database.set_rows(txn, "legacy", ["ip_address", "retrieved_time"],
+                [("a", 1), ("b", 2)], keys=["ip_address"])
+            self.assertEqual(txn.statements, [(
+                "INSERT INTO legacy (ip_address,retrieved_time) VALUES (%s,%s),(%s,%s)" + conflict,
+                ("a", 1, "b", 2))], "Rows should be upserted in a single statement")
+
+    @inlineCallbacks
+    def test_evolve_binary_ip(self):
+        self.patch(database, "_schema_version", 11)
+        yield database.clean_database(quiet=True)
+        def fill_txn(txn):
+            database.executemany(txn, """INSERT INTO crackers (id, ip_address, first_time, latest_time,
+                    total_reports, current_reports) VALUES (?,?,0,0,1,1)""",
+                [(1, "192.0.2.1"), (2, "2001:db8::1"), (3, "garbage")])
+            database.executemany(txn, """INSERT INTO reports (cracker_id, ip_address, first_report_time,
+                    latest_report_time) VALUES (?,?,0,0)""",
+                [(1, "198.51.100.1"), (2, "198.51.100.1"), (3, "198.51.100.2")])
+            txn.execute("INSERT INTO reporters (ip_address, num_reports) VALUES ('198.51.100.1', 2)")
+        yield Registry.DBPOOL.runInteraction(fill_txn)
+
+        database._schema_version = 12
+        yield database.evolve_database()
+        version = yield database.get_schema_version()
+        self.assertEqual(version, 12)
+
+        rows = yield database.run_query("SELECT id, ip_address FROM crackers ORDER BY id")
+        self.assertEqual([(row[0], database.ip_value(row[1])) for row in rows],
+            [(1, "192.0.2.1"), (2, "2001:db8::1")], "Addresses should be converted")
+        rows = yield database.run_query("SELECT cracker_id, ip_address FROM reports ORDER BY cracker_id")
+        self.assertEqual([(row[0], database.ip_value(row[1])) for row in rows],
+            [(1, "198.51.100.1"), (2, "198.51.100.1")],
+            "Reports of crackers with an invalid address should be removed")
+        rows = yield database.run_query("SELECT ip_address FROM reporters")
+        self.assertEqual([len(str(row[0])) for row in rows], [16])
+        cracker = yield controllers.get_cracker("2001:db8::1")
+        self.assertEqual(cracker.id, 2, "Indexes should be usable after converting")
+        if config.dbtype == "sqlite3":
+            rows = yield database.run_query("SELECT sql FROM sqlite_master WHERE name='reports'")
+            self.assertTrue("ip_address BLOB" in rows[0][0], "Column type should be changed")
+
+    @inlineCallbacks
+    def test_evolve_binary_ip_duplicates(self):
+        self.patch(database, "_schema_version", 11)
+        yield database.clean_database(quiet=True)
+        today = datetime.date.today().isoformat()
+        def fill_txn(txn):
+            database.executemany(txn, """INSERT INTO crackers (id, ip_address, first_time, latest_time,
+                    total_reports, current_reports, resiliency) VALUES (?,?,?,?,?,?,0)""",
+                [(1, "1.2.3.4", 100, 200, 3, 2), (2, "::ffff:1.2.3.4", 50, 150, 2, 1),
+                 (3, "2001:DB8::1", 0, 0, 1, 1), (4, "2001:db8:0:0::1", 0, 0, 1, 1),
+                 (5, "192.0.2.5", 0, 0, 5, 2), (6, "192.0.2.6", 0, 0, 1, 1)])
+            database.executemany(txn, """INSERT INTO reports (cracker_id, ip_address, first_report_time,
+                    latest_report_time) VALUES (?,?,0,0)""",
+                [(1, "1.1.1.1"), (1, "1.1.1.2"), (2, "::ffff:1.1.1.1"),
+                 (3, "1.1.1.1"), (4, "1.1.1.3"),
+                 (5, "unknown"), (5, "1.1.1.1"), (6, "1.2.3.4,5.6.7.8")])
+            database.executemany(txn, "INSERT INTO legacy (ip_address, retrieved_time) VALUES (?,?)",
+                [("1.2.3.4", 10), ("::ffff:1.2.3.4", 20)])
+            database.executemany(txn, "INSERT INTO reporters (ip_address, num_reports) VALUES (?,1)",
+                [("1.1.1.1",), ("::ffff:1.1.1.1",)])
+            database.executemany(txn, "INSERT INTO daily_reporters (`date`, ip_address) VALUES (?,?)",
+                [(today, "1.1.1.1"), (today, "::ffff:1.1.1.1")])
+            database.executemany(txn, "INSERT INTO daily_crackers (`date`, cracker_id) VALUES (?,?)",
+                [(today, 1), (today, 2)])
+        yield Registry.DBPOOL.runInteraction(fill_txn)
+
+        database._schema_version = 12
+        yield database.evolve_database()
+        version = yield database.get_schema_version()
+        self.assertEqual(version, 12)
+
+        rows = yield database.run_query("""SELECT id, ip_address, first_time, latest_time,
+            resiliency, total_reports, current_reports FROM crackers ORDER BY id""")
+        self.assertEqual([(row[0], database.ip_value(row[1])) + tuple(row[2:]) for row in rows],
+            [(1, "1.2.3.4", 50, 200, 150, 5, 2), (3, "2001:db8::1", 0, 0, 0, 2, 2),
+             (5, "192.0.2.5", 0, 0, 0, 4, 1)],
+            "Spellings of the same address should be merged, counters should match the reports")
+        rows = yield database.run_query("SELECT cracker_id, COUNT(*) FROM reports GROUP BY cracker_id ORDER BY cracker_id")
+        self.assertEqual([tuple(row) for row in rows], [(1, 3), (3, 2), (5, 1)],
+            "Reports should be moved to the merged cracker")
+        rows = yield database.run_query("SELECT ip_address, retrieved_time FROM legacy")
+        self.assertEqual([(database.ip_value(row[0]), row[1]) for row in rows], [("1.2.3.4", 20)],
+            "Legacy hosts should be merged, keeping the latest retrieval time")
+        rows = yield database.run_query("SELECT ip_address, num_reports FROM reporters")
+        self.assertEqual(sorted((database.ip_value(row[0]), row[1]) for row in rows),
+            [("1.1.1.1", 4), ("1.1.1.2", 1), ("1.1.1.3", 1)],
+            "Reporters should be counted again")
+        rows = yield database.run_query("SELECT cracker_id FROM daily_crackers")
+        self.assertEqual([row[0] for row in rows], [1], "Daily activity should be merged")
+        rows = yield database.run_query("SELECT `value` FROM counters WHERE name='num_hosts'")
+        self.assertEqual(rows[0][0], 3)
+
+    @inlineCallbacks
+    def test_sqlite_read_pool(self):
+        if config.dbtype != "sqlite3":
+            raise unittest.SkipTest("Only sqlite has a read pool")
+        self.assertNotEqual(database._read_pool, None, "sqlite should have a read pool")
+        rows = yield database.run_read_query("PRAGMA journal_mode")
+        self.assertEqual(rows[0][0], "wal", "Write-ahead logging should be enabled")
+
+        d = database.run_read_query("DELETE FROM legacy")
+        yield self.assertFailure(d, sqlite3.OperationalError)
+
+        # Reads should not wait for a write transaction in progress
+        writing = threading.Event()
+        release = threading.Event()
+        def write_txn(txn):
+            txn.execute("INSERT INTO legacy (ip_address, retrieved_time) VALUES ('192.0.2.1', 1)")
+            writing.set()
+            release.wait(10)
+        write = Registry.DBPOOL.runInteraction(write_txn)
+        yield threads.deferToThread(writing.wait, 10)
+        rows = yield database.run_read_query("SELECT COUNT(*) FROM legacy")
+        self.assertEqual(rows[0][0], 0, "Uncommitted writes should not be visible")
+        release.set()
+        yield write
+        rows = yield database.run_read_query("SELECT COUNT(*) FROM legacy")
+        self.assertEqual(rows[0][0], 1, "Committed writes should be visible")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
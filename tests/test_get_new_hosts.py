@@ -75,5 +75,35 @@ class GetNewHostsTest(base.TestBase):
         hosts = yield controllers.get_qualifying_crackers(2, 24*3600+1, now+3601, 50, [])
         self.assertEqual(len(hosts), 1, "Condition (d1)")
 
+    @inlineCallbacks
+    def test_get_qualifying_crackers_batched(self):
+        now = int(time.time())
+        controllers._qualifying_batch_size = 2
+        self.addCleanup(setattr, controllers, "_qualifying_batch_size", 200)
+
+        crackers = []
+        for i in range(5):
+            c = yield Cracker(ip_address="192.168.2.{}".format(i), first_time=now+i,
+                latest_time=now+i, total_reports=0, current_reports=0).save()
+            yield controllers.add_report_to_cracker(c, "1.1.1.1", when=now+i)
+            yield controllers.add_report_to_cracker(c, "1.1.1.2", when=now+i+3600)
+            crackers.append(c)
+
+        # Newest crackers first, limited to max_crackers
+        hosts = yield controllers.get_qualifying_crackers(2, 3500, now-1, 3, [])
+        self.assertEqual(hosts, ["192.168.2.4", "192.168.2.3", "192.168.2.2"],
+            "Hosts should be returned newest first, spanning multiple batches")
+
+        hosts = yield controllers.get_qualifying_crackers(2, 3500, now-1, 50,
+            ["192.168.2.3", "192.168.2.0"])
+        self.assertEqual(hosts, ["192.168.2.4", "192.168.2.2", "192.168.2.1"],
+            "Hosts reported by client should be skipped")
+
+        # Cracker with reports on both sides of the timestamp, condition (d2)
+        yield controllers.add_report_to_cracker(crackers[1], "1.1.1.3", when=now+7200)
+        hosts = yield controllers.get_qualifying_crackers(2, 3500, now+3602, 50, [])
+        self.assertEqual(hosts, ["192.168.2.4", "192.168.2.3", "192.168.2.2"],
+            "Condition (d2) should exclude host with report before timestamp")
+
         
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -0,0 +1,122 @@
+# denyhosts sync server
+# Copyright (C) 2015 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import time
+
+from denyhosts_server import config
+from denyhosts_server import controllers
+from denyhosts_server import database
+from denyhosts_server import utils
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web import server, xmlrpc
+
+import base
+
+class FakeLegacyServer(xmlrpc.XMLRPC):
+
+    def __init__(self):
+        xmlrpc.XMLRPC.__init__(self)
+        self.timestamp = 1000
+        self.hosts = []
+        self.requests = []
+
+    def xmlrpc_get_new_hosts(self, timestamp, threshold, hosts_added, resiliency):
+        self.requests.append(timestamp)
+        return {"timestamp": str(self.timestamp), "hosts": self.hosts}
+
+class LegacyTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        self.legacy_server = FakeLegacyServer()
+        port = reactor.listenTCP(0, server.Site(self.legacy_server), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.addCleanup(utils.close_http_connections)
+        config.legacy_server = "http://127.0.0.1:{}".format(port.getHost().port)
+
+    @inlineCallbacks
+    def legacy_hosts(self):
+        rows = yield database.run_query("SELECT ip_address, retrieved_time FROM legacy")
+        rows = sorted((database.ip_value(row[0]), row[1]) for row in rows)
+        self.assertEqual(len(set(ip for ip, retrieved_time in rows)), len(rows),
+            "Every host should be stored once")
+        returnValue(rows)
+
+    @inlineCallbacks
+    def test_legacy_sync(self):
+        self.legacy_server.hosts = ["8.8.8.8", "2001:DB8::1", "10.0.0.1", "8.8.8.8"]
+        yield controllers.download_from_legacy_server()
+        rows = yield self.legacy_hosts()
+        self.assertEqual([ip for ip, retrieved_time in rows], ["2001:db8::1", "8.8.8.8"],
+            "Valid hosts should be stored once, in normalized form")
+        rows = yield database.run_query("SELECT `value` FROM info WHERE `key`='last_legacy_sync'")
+        self.assertEqual(int(rows[0][0]), 1000, "Sync time should be stored")
+
+        # Known hosts are updated
+        yield database.run_operation("UPDATE legacy SET retrieved_time=0")
+        self.legacy_server.timestamp = 2000
+        self.legacy_server.hosts = ["8.8.8.8", "8.8.4.4"]
+        yield controllers.download_from_legacy_server()
+        self.assertEqual(self.legacy_server.requests, [0, 1000],
+            "Legacy server should be asked for hosts since the last sync")
+        rows = yield self.legacy_hosts()
+        now = time.time()
+        self.assertEqual([ip for ip, retrieved_time in rows], ["2001:db8::1", "8.8.4.4", "8.8.8.8"])
+        self.assertEqual([retrieved_time > now - 60 for ip, retrieved_time in rows],
+            [False, True, True], "Retrieved time of hosts should be set")
+
+        # Old hosts are expired by maintenance
+        yield controllers.perform_maintenance(legacy_limit=now - 60)
+        rows = yield self.legacy_hosts()
+        self.assertEqual([ip for ip, retrieved_time in rows], ["8.8.4.4", "8.8.8.8"],
+            "Maintenance should remove old legacy hosts")
+
+    @inlineCallbacks
+    def test_legacy_snapshot(self):
+        self.addCleanup(controllers.clear_legacy_snapshot)
+        now = int(time.time())
+        yield database.run_many("INSERT INTO legacy (ip_address, retrieved_time) VALUES (?,?)",
+            [(database.ip_param("8.8.{}.{}".format(i // 10, i)), now - 100 + i // 3) for i in range(30)])
+
+        queries = [(timestamp, max_hosts) for timestamp in (0, now - 100, now - 95, now - 80, now)
+            for max_hosts in (1, 5, 50)]
+        expected = []
+        for timestamp, max_hosts in queries:
+            hosts = yield controllers.get_qualifying_crackers(1, 0, timestamp, max_hosts, set())
+            expected.append(hosts)
+
+        count = yield controllers.load_legacy_snapshot()
+        self.assertEqual(count, 30)
+        for (timestamp, max_hosts), hosts in zip(queries, expected):
+            result = yield controllers.get_qualifying_crackers(1, 0, timestamp, max_hosts, set())
+            self.assertEqual([controllers._legacy_times[controllers._legacy_hosts.index(h)] for h in result],
+                [controllers._legacy_times[controllers._legacy_hosts.index(h)] for h in hosts],
+                "Snapshot should give hosts retrieved at the same times as the database")
+            self.assertEqual(len(set(result)), len(result))
+
+        # Kept up to date by the legacy sync and maintenance
+        self.legacy_server.hosts = ["1.1.1.1"]
+        yield controllers.download_from_legacy_server()
+        # Retrieval times may be rounded to whole seconds by the database
+        hosts = yield controllers.get_qualifying_crackers(1, 0, now - 1, 5, set())
+        self.assertEqual(hosts, ["1.1.1.1"], "Downloaded hosts should be in the snapshot")
+        yield controllers.perform_maintenance(legacy_limit=now)
+        self.assertEqual(controllers._legacy_hosts, ["1.1.1.1"], "Expired hosts should be removed")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
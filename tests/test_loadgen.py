@@ -0,0 +1,114 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import inspect
+import os.path
+import random
+
+from denyhosts_server import config
+from denyhosts_server import database
+from denyhosts_server import loadgen
+from denyhosts_server import peering
+from denyhosts_server import peering_views
+from denyhosts_server import views
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import server
+
+import libnacl.utils
+
+import base
+
+tests_dir = os.path.dirname(inspect.getsourcefile(base.TestBase))
+
+class WorkloadTest(unittest.TestCase):
+
+    def test_parse_mix(self):
+        self.assertEqual(loadgen.parse_mix("add_hosts=3, get_new_hosts=1,update_batch=0"),
+            [("add_hosts", 3.0), ("get_new_hosts", 1.0)])
+        self.assertEqual(loadgen.parse_mix("get_new_hosts"), [("get_new_hosts", 1.0)])
+        self.assertRaises(ValueError, loadgen.parse_mix, "add_hosts=1,list_peers=1")
+        self.assertRaises(ValueError, loadgen.parse_mix, "add_hosts=0")
+
+    def test_percentile(self):
+        values = range(1, 101)
+        self.assertEqual([loadgen.percentile(values, p) for p in (50, 95, 99, 100)], [50, 95, 99, 100])
+        self.assertEqual(loadgen.percentile([7], 99), 7)
+        self.assertEqual(loadgen.percentile([], 50), None)
+
+    def test_workload(self):
+        def sample(seed):
+            workload = loadgen.Workload(random.Random(seed), num_clients=50, num_crackers=200)
+            return [(workload.client(), workload.hosts()) for i in range(500)]
+        self.assertEqual(sample(1), sample(1), "Workload should be reproducible from the seed")
+        self.assertNotEqual(sample(1), sample(2))
+
+        reports = sample(1)
+        clients = [client for client, hosts in reports]
+        top_client = max(set(clients), key=clients.count)
+        self.assertTrue(clients.count(top_client) > 500 / 50 * 3,
+            "Some clients should be much more active than others")
+        self.assertTrue(all(1 <= len(hosts) <= 10 for client, hosts in reports))
+
+class LoadGeneratorTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        handler = views.Server()
+        handler.putSubHandler("peering", peering_views.PeeringServer(handler))
+        port = reactor.listenTCP(0, server.Site(handler), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        self.url = "http://127.0.0.1:{}".format(port.getHost().port)
+
+    def arguments(self, *args):
+        return loadgen.argument_parser().parse_args(["--url", self.url, "--rate", "40",
+            "--duration", "0.5", "--clients", "20", "--crackers", "50"] + list(args))
+
+    @inlineCallbacks
+    def test_run(self):
+        report = yield loadgen.LoadGenerator(self.arguments()).run()
+        self.assertTrue(report["sent"] > 0, "Requests should be sent")
+        self.assertEqual((report["completed"], report["failed"]), (report["sent"], 0),
+            "All requests should succeed: {}".format(report))
+        for method in ("add_hosts", "get_new_hosts"):
+            latency = report["methods"][method]["latency"]
+            self.assertTrue(0 < latency["p50"] <= latency["p95"] <= latency["p99"] <= latency["max"])
+        rows = yield database.run_query("SELECT COUNT(DISTINCT ip_address) FROM reports")
+        self.assertTrue(rows[0][0] > 1, "Reports should come from the simulated clients")
+
+    @inlineCallbacks
+    def test_update_batch(self):
+        server_key_file = os.path.join(tests_dir, "peer0.key")
+        peer_key_file = os.path.join(tests_dir, "peer1.key")
+        self.patch(config, "key_file", server_key_file)
+        self.patch(config, "peers", {"http://127.0.0.1:1": libnacl.utils.load_key(peer_key_file).pk})
+        self.patch(peering, "_own_key", None)
+        self.patch(peering, "_peer_boxes", {})
+        peering.load_keys()
+
+        args = self.arguments("--mix", "update_batch", "--batch-size", "3",
+            "--peer-key", peer_key_file,
+            "--server-key", libnacl.utils.load_key(server_key_file).pk.encode("hex"))
+        report = yield loadgen.LoadGenerator(args).run()
+        self.assertEqual(report["methods"]["update_batch"]["errors"], {})
+        rows = yield database.run_query("SELECT SUM(total_reports) FROM crackers")
+        self.assertTrue(report["completed"] > 0 and rows[0][0] >= report["completed"] * 3,
+            "Every update should be stored")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
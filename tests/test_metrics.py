@@ -0,0 +1,82 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from denyhosts_server import metrics
+from denyhosts_server import views
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.web import server, xmlrpc
+
+import base
+
+class MetricsTest(base.TestBase):
+
+    def test_exposition(self):
+        self.patch(metrics, "_metrics", [])
+        self.patch(metrics, "_collectors", [])
+        counter = metrics.Counter("test_requests_total", "Requests", ["method"])
+        counter.inc(method="a")
+        counter.inc(2, method='b"c')
+        histogram = metrics.Histogram("test_seconds", "Durations", buckets=(0.1, 1.0))
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+        metrics.Gauge("test_answer", "Answer", function=lambda: 42)
+
+        self.assertEqual(metrics.expose().splitlines(), [
+            "# HELP test_requests_total Requests",
+            "# TYPE test_requests_total counter",
+            'test_requests_total{method="a"} 1',
+            'test_requests_total{method="b\\"c"} 2',
+            "# HELP test_seconds Durations",
+            "# TYPE test_seconds histogram",
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1.0"} 3',
+            'test_seconds_bucket{le="+Inf"} 4',
+            "test_seconds_sum 3.65",
+            "test_seconds_count 4",
+            "# HELP test_answer Answer",
+            "# TYPE test_answer gauge",
+            "test_answer 42",
+        ])
+
+    @inlineCallbacks
+    def test_xmlrpc_metrics(self):
+        self.patch(metrics.xmlrpc_duration, "_values", {})
+        self.patch(metrics.xmlrpc_errors, "_values", {})
+        port = reactor.listenTCP(0, server.Site(views.Server()), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        proxy = xmlrpc.Proxy("http://127.0.0.1:{}/".format(port.getHost().port))
+
+        yield proxy.callRemote("get_new_hosts", 0, 3, [], 3)
+        try:
+            yield proxy.callRemote("add_hosts", ["not an address"])
+        except xmlrpc.Fault:
+            pass
+        self.flushLoggedErrors()
+
+        text = metrics.expose()
+        self.assertTrue('denyhosts_xmlrpc_request_duration_seconds_count{method="get_new_hosts"} 1' in text,
+            "Request durations should be recorded per method")
+        self.assertTrue('denyhosts_xmlrpc_errors_total{method="add_hosts"} 1' in text,
+            "Faults should be counted")
+        self.assertFalse('denyhosts_xmlrpc_errors_total{method="get_new_hosts"}' in text)
+        self.assertTrue("denyhosts_db_query_duration_seconds_count" in text,
+            "Database queries should be timed")
+        self.assertTrue("denyhosts_lock_wait_seconds_count" in text,
+            "Lock statistics should be exposed")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
@@ -14,10 +14,13 @@
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import random
 import time
 
+from denyhosts_server import config
 from denyhosts_server import models
 from denyhosts_server import controllers 
+from denyhosts_server import database
 from denyhosts_server.models import Cracker, Report
 
 from twisted.internet.defer import inlineCallbacks, returnValue
@@ -29,7 +32,7 @@ class ModelsTest(base.TestBase):
     @inlineCallbacks
     def test_add_cracker(self):
         cracker_ip = "127.0.0.1"
-        now = time.time()
+        now = int(time.time())
         cracker = Cracker(ip_address=cracker_ip, first_time=now, latest_time=now, total_reports=0, current_reports=0, resiliency=0)
         cracker = yield cracker.save()
 
@@ -51,46 +54,46 @@ class ModelsTest(base.TestBase):
         yield self.assertIsNotNone(c)
         yield controllers.add_report_to_cracker(c, "127.0.0.1")
 
-        r = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"], limit=1)
+        r = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")], limit=1)
         returnValue(self.assertIsNotNone(r, "Added report is in database"))
         
     @inlineCallbacks
     def test_add_multiple_reports(self):
-        now = time.time()
+        now = int(time.time())
 
         yield Cracker(ip_address="192.168.1.1", first_time=now, latest_time=now, total_reports=0, current_reports=0).save()
         c = yield controllers.get_cracker("192.168.1.1")
         yield self.assertIsNotNone(c)
         yield controllers.add_report_to_cracker(c, "127.0.0.1", now)
 
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 1, "First added report is in database")
 
         # Add second report shortly after first
         yield controllers.add_report_to_cracker(c, "127.0.0.1", now+1)
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 1, "Second added report should be ignored")
 
         # Add second report after 24 hours
         yield controllers.add_report_to_cracker(c, "127.0.0.1", now+24*3600+1)
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 2, "Second report should be added after 24 hours ")
 
         # Add third report shortly after second, should be ignored
         yield controllers.add_report_to_cracker(c, "127.0.0.1", now+24*3600+10)
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 2, "Third report shortly after second should be ignored")
 
         # Add third report after again 24 hours
         yield controllers.add_report_to_cracker(c, "127.0.0.1", now+2*24*3600+20)
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 3, "Third report after again 24 hours, should be added")
 
         # Add fourth report 
         time_added = now + 2*24*3600 + 30
         yield controllers.add_report_to_cracker(c, "127.0.0.1", time_added)
         reports = yield Report.find(
-            where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"], 
+            where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")], 
             orderby='latest_report_time asc')
         self.assertEqual(len(reports), 3, "Fourth report, should be merged")
         self.assertEqual(reports[-1].latest_report_time, time_added, "Latest report time should be updated")
@@ -100,23 +103,109 @@ class ModelsTest(base.TestBase):
 
         # Perform maintenance, expire original report
         yield controllers.perform_maintenance(limit = now+1) 
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 2, "Maintenance should remove oldest report")
         yield c.refresh()
         self.assertEqual(c.current_reports, 1, "Maintenance should still leave one unique reporter")
 
         # Perform maintenance, expire second report
         yield controllers.perform_maintenance(limit = now+24*3600+11) 
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 1, "Maintenance should remove one more report")
         yield c.refresh()
         self.assertEqual(c.current_reports, 1, "Maintenance should still leave one unique reporter")
 
         # Perform maintenance again, expire last report and cracker
         yield controllers.perform_maintenance(limit = now+2*24*3600+31) 
-        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,"127.0.0.1"])
+        reports = yield Report.find(where=["cracker_id=? and ip_address=?",c.id,database.ip_param("127.0.0.1")])
         self.assertEqual(len(reports), 0, "Maintenance should remove last report")
         cracker = yield controllers.get_cracker("192.168.1.1")
         self.assertIsNone(cracker, "Maintenance should remove cracker")
 
+    @inlineCallbacks
+    def test_report_batches(self):
+        now = time.time()
+        rng = random.Random(1)
+        events = []
+        offset = 0
+        for i in range(80):
+            offset += rng.choice([10, 600, 3600, 25*3600])
+            events.append((
+                "127.0.0.{}".format(rng.randint(1, 4)),
+                now + offset,
+                rng.randint(1, 3)
+            ))
+
+        # Reference: add reports one by one
+        for client_ip, when, n in events:
+            host = "192.168.10.{}".format(n)
+            cracker = yield controllers.get_cracker(host)
+            if cracker is None:
+                cracker = yield Cracker(ip_address=host, first_time=when, latest_time=when,
+                    resiliency=0, total_reports=0, current_reports=0).save()
+            yield controllers.add_report_to_cracker(cracker, client_ip, when=when)
+
+        # Same reports in two batches, the second one for existing crackers
+        records = [(client_ip, when, ["192.168.11.{}".format(n)]) for client_ip, when, n in events]
+        yield controllers.queue_reports(records[:40])
+        yield controllers.queue_reports(records[40:])
+
+        for n in range(1, 4):
+            expected = yield controllers.get_cracker("192.168.10.{}".format(n))
+            cracker = yield controllers.get_cracker("192.168.11.{}".format(n))
+            for attr in ["first_time", "latest_time", "resiliency", "total_reports", "current_reports"]:
+                self.assertEqual(getattr(cracker, attr), getattr(expected, attr),
+                    "Batched reports should give the same {} as single reports".format(attr))
+            expected_reports = yield expected.reports.get()
+            reports = yield cracker.reports.get()
+            self.assertEqual(
+                sorted((r.ip_address, r.first_report_time, r.latest_report_time) for r in reports),
+                sorted((r.ip_address, r.first_report_time, r.latest_report_time) for r in expected_reports),
+                "Batched reports should be merged the same way as single reports")
+
+    @inlineCallbacks
+    def test_ipv6_reports(self):
+        now = time.time()
+        yield controllers.queue_reports([
+            ("2001:DB8::10", now, ["2001:db8:0:0::1", "192.0.2.1"]),
+            ("192.0.2.20", now, ["2001:db8::1"]),
+        ])
+
+        cracker = yield controllers.get_cracker("2001:db8::1")
+        self.assertIsNotNone(cracker, "IPv6 crackers should be stored")
+        self.assertEqual(cracker.ip_address, "2001:db8::1", "Addresses should be read back normalized")
+        self.assertEqual(cracker.total_reports, 2, "Both spellings are the same cracker")
+        reports = yield cracker.reports.get()
+        self.assertEqual(sorted(r.ip_address for r in reports), ["192.0.2.20", "2001:db8::10"],
+            "IPv6 reporters should be stored")
+
+        hosts = yield controllers.get_qualifying_crackers(1, 0, now - 10, 50, [])
+        self.assertEqual(sorted(hosts), ["192.0.2.1", "2001:db8::1"])
+
+    @inlineCallbacks
+    def test_illegal_report_source(self):
+        now = time.time()
+        # Collect all reports in a single batch
+        config.ingest_batch_size = 1000
+        config.ingest_batch_delay = 60
+        good = controllers.handle_report_from_client("127.0.0.1", now, ["1.1.1.1"])
+        bad = [
+            controllers.handle_report_from_client(None, now, ["1.1.1.1"]),
+            controllers.handle_report_from_client("unknown", now, ["1.1.1.1"]),
+            controllers.handle_report_from_client("1.2.3.4, 5.6.7.8", now, ["1.1.1.1"]),
+            controllers.handle_report_from_client("127.0.0.2", "yesterday", ["1.1.1.1"]),
+        ]
+        also_good = controllers.handle_report_from_client("::FFFF:127.0.0.3", now, ["1.1.1.1"])
+        yield controllers.flush_reports()
+
+        for d in bad:
+            yield self.assertFailure(d, Exception)
+        yield good
+        yield also_good
+        cracker = yield controllers.get_cracker("1.1.1.1")
+        self.assertEqual(cracker.current_reports, 2, "Only the legal reports should be stored")
+        reports = yield cracker.reports.get()
+        self.assertEqual(sorted(r.ip_address for r in reports), ["127.0.0.1", "127.0.0.3"],
+            "Client addresses should be stored normalized")
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
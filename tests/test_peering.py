@@ -22,6 +22,7 @@ import time
 import subprocess
 import xmlrpclib
 from xmlrpclib import ServerProxy
+import zlib
 
 from denyhosts_server import config
 from denyhosts_server import models
@@ -30,10 +31,12 @@ from denyhosts_server import database
 from denyhosts_server import version as server_version
 from denyhosts_server.models import Cracker, Report
 from denyhosts_server import peering
+from denyhosts_server import peering_views
 
 from twisted.internet import reactor, task
 from twisted.internet.defer import inlineCallbacks, returnValue
 from  twisted.python import log
+from twisted.web import server, xmlrpc
 
 import libnacl.public
 import libnacl.utils
@@ -89,8 +92,8 @@ class TestPeering(base.TestBase):
 
     @inlineCallbacks
     def test_send_update_to_peers(self):
-        yield peering.send_update("11.11.11.11", time.time(), ["1.1.1.1"])
-        yield task.deferLater(reactor, 1.0, lambda _:0, 0)
+        peering.send_update("11.11.11.11", time.time(), ["1.1.1.1"])
+        yield peering.flush_updates(10)
         for peer_url in config.peers:
             server = ServerProxy(peer_url)
             response = server.get_new_hosts(time.time() - 15, 1, [], 0)
@@ -140,6 +143,7 @@ class TestPeering(base.TestBase):
         peer_list = response["peers"]
         self.assertEqual(len(peer_list), len(config.peers), "Peer list not correct length")
         self.assertEqual(response["server_version"], server_version, "Incorrect server version in response")
+        self.assertEqual(response["peering_version"], peering.peering_version, "Incorrect peering version in response")
         for peer_url in config.peers:
             self.assertIn(peer_url, peer_list, "Peer missing from received list")
             self.assertEqual(config.peers[peer_url].encode('hex'), peer_list[peer_url], "Wrong key in received peer list")
@@ -172,5 +176,254 @@ class TestPeering(base.TestBase):
 
         result = peering.check_peers()
         self.assertEqual(result, False, "Check peers should fail if peers do not know me")
-        
+
+class FakePeer(xmlrpc.XMLRPC):
+    """ Records updates, after failing the first few calls """
+
+    def __init__(self, box, version, failures):
+        xmlrpc.XMLRPC.__init__(self)
+        self.box = box
+        self.version = version
+        self.failures = failures
+        self.list_peers_failures = 0
+        self.list_peers_calls = 0
+        self.calls = 0
+        self.updates = []
+
+    def xmlrpc_list_peers(self, key, please):
+        self.list_peers_calls += 1
+        if self.list_peers_failures > 0:
+            self.list_peers_failures -= 1
+            raise xmlrpc.Fault(105, "Temporary failure")
+        response = { "server_version": "test", "peers": {} }
+        if self.version >= 2:
+            response["peering_version"] = self.version
+        return response
+
+    def _decrypt(self, message):
+        if self.failures > 0:
+            self.failures -= 1
+            raise xmlrpc.Fault(105, "Temporary failure")
+        self.calls += 1
+        return json.loads(self.box.decrypt(message.decode('base64')))
+
+    def xmlrpc_update(self, key, update):
+        self.updates.append(self._decrypt(update))
+        return 0
+
+    def xmlrpc_update_batch(self, key, update_batch):
+        if self.version < 2:
+            raise xmlrpc.Fault(8001, "Method update_batch not found")
+        self.updates.extend(self._decrypt(update_batch)["updates"])
+        return 0
+
+class TestUpdateQueue(base.TestBase):
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        self.own_key = libnacl.public.SecretKey()
+        self.peer_key = libnacl.public.SecretKey()
+
+        self.fake_peer = FakePeer(libnacl.public.Box(self.peer_key.sk, self.own_key.pk), 2, 0)
+        root = xmlrpc.XMLRPC()
+        root.putSubHandler('peering', self.fake_peer)
+        self.port = reactor.listenTCP(0, server.Site(root), interface="127.0.0.1")
+        self.peer_url = "http://127.0.0.1:{}".format(self.port.getHost().port)
+
+        config.peers = { self.peer_url: self.peer_key.pk }
+        self.patch(peering, "_own_key", self.own_key)
+        self.patch(peering, "_peer_boxes",
+            { self.peer_url: libnacl.public.Box(self.own_key.sk, self.peer_key.pk) })
+        self.patch(peering, "_peer_versions", {})
+        self.patch(peering, "_version_failures", {})
+        self.patch(peering, "_retry_delay", 0.01)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield peering.flush_updates(5)
+        yield self.port.stopListening()
+
+    @inlineCallbacks
+    def test_update_queue(self):
+        self.fake_peer.failures = 2
+        peering.send_update("11.11.11.11", 1000, ["1.1.1.1"])
+        peering.send_update("11.11.11.12", 1001, ["1.1.1.2"])
+        self.assertEqual(self.fake_peer.updates, [], "Updates should be sent in the background")
+
+        yield peering.flush_updates(5)
+        self.assertEqual([update["client_ip"] for update in self.fake_peer.updates],
+            ["11.11.11.11", "11.11.11.12"], "Updates should be delivered in order, after retrying")
+        self.assertEqual(self.fake_peer.calls, 1, "Updates should be sent in one batch")
+        self.assertEqual(peering.get_update_queue_stats()["queued"][self.peer_url], 0,
+            "Update queue should be empty")
+
+    @inlineCallbacks
+    def test_update_old_peer(self):
+        self.fake_peer.version = 1
+        peering.send_update("11.11.11.11", 1000, ["1.1.1.1"])
+        peering.send_update("11.11.11.12", 1001, ["1.1.1.2"])
+        yield peering.flush_updates(5)
+        self.assertEqual([update["client_ip"] for update in self.fake_peer.updates],
+            ["11.11.11.11", "11.11.11.12"], "Updates should be delivered in order")
+        self.assertEqual(self.fake_peer.calls, 2, "Old peer should get separate updates")
+
+    @inlineCallbacks
+    def test_update_version_unknown(self):
+        self.fake_peer.list_peers_failures = 1
+        peering.send_update("11.11.11.11", 1000, ["1.1.1.1"])
+        peering.send_update("11.11.11.12", 1001, ["1.1.1.2"])
+        for i in range(100):
+            if len(self.fake_peer.updates) == 2:
+                break
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual([update["client_ip"] for update in self.fake_peer.updates],
+            ["11.11.11.11", "11.11.11.12"], "Updates should be delivered in order")
+        self.assertEqual(self.fake_peer.calls, 1,
+            "Updates should be sent in one batch after asking for the version again")
+        self.assertEqual(self.fake_peer.list_peers_calls, 2)
+
+    @inlineCallbacks
+    def test_update_peer_down(self):
+        # Every update starts a delivery
+        config.update_batch_size = 1
+        self.patch(peering, "_retry_delay", 0.1)
+        self.fake_peer.list_peers_failures = 3
+        peering.send_update("11.11.11.11", 1000, ["1.1.1.0"])
+        for i in range(100):
+            if peering._version_failures.get(self.peer_url) == 1:
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        for i in range(1, 5):
+            peering.send_update("11.11.11.11", 1000 + i, ["1.1.1.{}".format(i)])
+        self.assertEqual(self.fake_peer.list_peers_calls, 1,
+            "Peer should not be asked again before the delay has passed")
+
+        # Delivered once the peer answers again, without queueing more updates
+        for i in range(100):
+            if len(self.fake_peer.updates) == 5:
+                break
+            yield task.deferLater(reactor, 0.05, lambda: None)
+        self.assertEqual([update["timestamp"] for update in self.fake_peer.updates],
+            range(1000, 1005), "Updates should be delivered in order when the peer is back")
+        self.assertEqual(self.fake_peer.list_peers_calls, 4,
+            "Peer should be asked for its version once per retry")
+
+    @inlineCallbacks
+    def test_update_queue_full(self):
+        config.update_queue_size = 2
+        config.update_retries = 0
+        self.fake_peer.failures = 100
+        dropped = peering.get_update_queue_stats()["dropped"]
+        for i in range(5):
+            peering.send_update("11.11.11.11", 1000 + i, ["1.1.1.{}".format(i)])
+        yield peering.flush_updates(5)
+        self.assertEqual(peering.get_update_queue_stats()["dropped"] - dropped, 5,
+            "All updates should be dropped, from the full queue or after failing")
+
+    @inlineCallbacks
+    def test_handle_update_batch(self):
+        box = libnacl.public.Box(self.peer_key.sk, self.own_key.pk)
+        now = time.time()
+        data = json.dumps({ "updates": [
+            { "client_ip": "11.11.11.11", "timestamp": now, "hosts": ["1.1.1.1", "192.168.1.1"] },
+            { "client_ip": "11.11.11.12", "timestamp": now, "hosts": ["1.1.1.1", "1.1.1.2"] },
+        ]})
+        yield peering.handle_update_batch(self.peer_key.pk, box.encrypt(data))
+
+        cracker = yield controllers.get_cracker("1.1.1.1")
+        self.assertEqual(cracker.current_reports, 2, "Reports from both updates should be stored")
+        cracker = yield controllers.get_cracker("192.168.1.1")
+        self.assertIsNone(cracker, "Illegal address should be skipped")
+
+    @inlineCallbacks
+    def test_handle_update_batch_illegal_client(self):
+        box = libnacl.public.Box(self.peer_key.sk, self.own_key.pk)
+        now = time.time()
+        data = json.dumps({ "updates": [
+            { "client_ip": "11.11.11.11", "timestamp": now, "hosts": ["1.1.1.1"] },
+            { "client_ip": "unknown", "timestamp": now, "hosts": ["1.1.1.1"] },
+            { "client_ip": None, "timestamp": now, "hosts": ["1.1.1.1"] },
+            { "client_ip": "11.11.11.13", "timestamp": "now", "hosts": ["1.1.1.1"] },
+            { "client_ip": "11.11.11.12", "timestamp": now, "hosts": ["1.1.1.1"] },
+        ]})
+        yield peering.handle_update_batch(self.peer_key.pk, box.encrypt(data))
+
+        cracker = yield controllers.get_cracker("1.1.1.1")
+        self.assertEqual(cracker.current_reports, 2, "Only the legal updates should be stored")
+
+class TestBootstrap(base.TestBase):
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        own_key = libnacl.public.SecretKey()
+        self.peer_key = libnacl.public.SecretKey()
+        config.peers = { "http://test.peer:9911": self.peer_key.pk }
+        self.patch(peering, "_own_key", own_key)
+        self.patch(peering, "_peer_boxes",
+            { "http://test.peer:9911": libnacl.public.Box(own_key.sk, self.peer_key.pk) })
+        self.box = libnacl.public.Box(self.peer_key.sk, own_key.pk)
+
+    @inlineCallbacks
+    def dump_chunks(self, table, cursor=0):
+        """ All chunks of table, as a peer would receive them """
+        chunks = []
+        while True:
+            request = self.box.encrypt(json.dumps({ "table": table, "cursor": cursor, "limit": 2 }))
+            response = yield peering.handle_dump_chunk(self.peer_key.pk, request)
+            if response["count"] == 0:
+                break
+            chunks.append(json.loads(zlib.decompress(response["rows"].data)))
+            cursor = response["cursor"]
+        returnValue(chunks)
+
+    @inlineCallbacks
+    def test_dump_and_bootstrap(self):
+        now = time.time()
+        yield controllers.queue_reports([
+            ("11.11.11.11", now - 3600, ["1.1.1.1", "1.1.1.2", "1.1.1.3"]),
+            ("11.11.11.12", now, ["1.1.1.1", "1.1.1.4"]),
+        ])
+        yield database.run_operation("INSERT INTO legacy (ip_address, retrieved_time) VALUES (?, ?)",
+            database.ip_param("2.2.2.2"), now)
+
+        dumps = {}
+        for table, order in database.bootstrap_tables:
+            dumps[table] = yield self.dump_chunks(table)
+        self.assertEqual(len(dumps["crackers"]), 2, "Crackers should be dumped in chunks")
+
+        yield database.clean_database(quiet=True)
+        for table, order in database.bootstrap_tables:
+            for rows in dumps[table]:
+                yield database.bootstrap_rows(table, rows)
+            copy = yield self.dump_chunks(table)
+            self.assertEqual(copy, dumps[table], "Table {} should be copied".format(table))
+
+        cursor = yield database.get_bootstrap_cursor("reports")
+        self.assertEqual(cursor, dumps["reports"][-1][-1][0], "Resume should start after last report")
+        remaining = yield self.dump_chunks("reports", cursor)
+        self.assertEqual(remaining, [], "Nothing left to copy after last report")
+
+    @inlineCallbacks
+    def test_resume_bootstrap(self):
+        # Serve the peering methods from this process, using our own key
+        # for the peer, and resume bootstrapping from a complete copy
+        root = xmlrpc.XMLRPC()
+        root.putSubHandler('peering', peering_views.PeeringServer(root))
+        port = reactor.listenTCP(0, server.Site(root), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        peer_url = "http://127.0.0.1:{}".format(port.getHost().port)
+        config.peers = { peer_url: peering._own_key.pk }
+        peering._peer_boxes[peer_url] = libnacl.public.Box(peering._own_key.sk, peering._own_key.pk)
+
+        yield controllers.queue_reports([("11.11.11.11", time.time(), ["1.1.1.1", "1.1.1.2"])])
+        before = yield database.dump_chunk("reports", 0, 100)
+        yield peering.bootstrap_from(peer_url, resume=True)
+        after = yield database.dump_chunk("reports", 0, 100)
+        self.assertEqual(after, before, "Nothing should be copied again when resuming")
+
+    @inlineCallbacks
+    def test_dump_illegal_table(self):
+        request = self.box.encrypt(json.dumps({ "table": "sqlite_master", "cursor": 0, "limit": 2 }))
+        yield self.assertFailure(peering.handle_dump_chunk(self.peer_key.pk, request), Exception)
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
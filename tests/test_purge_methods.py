@@ -74,7 +74,7 @@ class PurgingTest(base.TestBase):
         legacy = yield Legacy.all()
         self.assertEqual(len(legacy), 0, "Should no legacy reports after purging legacy")
 
-        rows = yield database.run_query('SELECT `value` FROM info WHERE `key`="last_legacy_sync"')
+        rows = yield database.run_query("SELECT `value` FROM info WHERE `key`='last_legacy_sync'")
         self.assertEqual(rows[0][0], '0', "Purging legacy should reset last legacy sync time")
         
     @inlineCallbacks
@@ -0,0 +1,93 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from denyhosts_server import cache
+from denyhosts_server import config
+from denyhosts_server import resolver
+
+from twisted.internet import defer
+from twisted.internet.defer import inlineCallbacks
+from twisted.names import dns, error
+
+import base
+
+class FakeResolver(object):
+    """ Answers PTR lookups from a dict of reverse name -> hostname. Names
+    not in the dict do not exist; lookups of names in hang never finish """
+
+    def __init__(self, names, hang=()):
+        self.names = names
+        self.hang = hang
+        self.lookups = []
+        self.waiting = []
+
+    def lookupPointer(self, name, timeout=None):
+        self.lookups.append(name)
+        if name in self.hang:
+            return defer.Deferred()
+        d = defer.Deferred()
+        self.waiting.append((d, name))
+        return d
+
+    def answer(self):
+        waiting, self.waiting = self.waiting, []
+        for d, name in waiting:
+            if name in self.names:
+                record = dns.RRHeader(name, dns.PTR, payload=dns.Record_PTR(self.names[name]))
+                d.callback(([record], [], []))
+            else:
+                d.errback(error.DNSNameError(name))
+
+class ResolverTest(base.TestBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield base.TestBase.setUp(self)
+        self.patch(resolver, "_cache", cache.LRUCache(100))
+        self.patch(resolver, "_pending", {})
+
+    def test_reverse_name(self):
+        self.assertEqual(resolver.reverse_name("192.0.2.10"), "10.2.0.192.in-addr.arpa")
+        self.assertEqual(resolver.reverse_name("2001:db8::1"),
+            "1.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.0.8.b.d.0.1.0.0.2.ip6.arpa")
+
+    @inlineCallbacks
+    def test_concurrent_and_cached(self):
+        fake = FakeResolver({"1.2.0.192.in-addr.arpa": "host1.example.com"})
+        self.patch(resolver, "_resolver", fake)
+
+        d = resolver.resolve_all(["192.0.2.1", "192.0.2.2", "192.0.2.1"])
+        self.assertEqual(len(fake.lookups), 2, "All addresses should be looked up at once, once each")
+        fake.answer()
+        hostnames = yield d
+        self.assertEqual(hostnames, {"192.0.2.1": "host1.example.com", "192.0.2.2": None},
+            "Hostnames should be returned, None for failed lookups")
+
+        hostnames = yield resolver.resolve_all(["192.0.2.1", "192.0.2.2"])
+        self.assertEqual(len(fake.lookups), 2, "Hostnames and failures should be cached")
+        self.assertEqual(hostnames["192.0.2.1"], "host1.example.com")
+
+    @inlineCallbacks
+    def test_timeout(self):
+        fake = FakeResolver({}, hang=["1.2.0.192.in-addr.arpa"])
+        self.patch(resolver, "_resolver", fake)
+        self.patch(config, "resolve_timeout", 0.1)
+
+        hostname = yield resolver.resolve("192.0.2.1")
+        self.assertEqual(hostname, None, "Lookup should time out")
+        self.assertEqual(resolver._pending, {}, "No lookups should be pending")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
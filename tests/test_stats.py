@@ -15,23 +15,46 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import datetime
+import gzip
 import inspect
 import os
 import os.path
+import random
 import time
 import traceback
+from cStringIO import StringIO
 
 from denyhosts_server.models import Cracker, Report, Legacy
 from denyhosts_server import config
+from denyhosts_server import cache
 from denyhosts_server import controllers
+from denyhosts_server import database
+from denyhosts_server import geo
+from denyhosts_server import graphs
+from denyhosts_server import resolver
 from denyhosts_server import stats
+from denyhosts_server import summary
+from denyhosts_server import views
 
+from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.web import client, server
+from twisted.web.http_headers import Headers
 
 from twistar.registry import Registry
 
 import base
 
+class FakeGeoIP(object):
+    def country_code_by_addr(self, ip):
+        return "NL" if ip.startswith("10.") else None
+
+    def country_name_by_addr(self, ip):
+        return "Netherlands" if ip.startswith("10.") else None
+
+def hanging_renderer(data):
+    time.sleep(60)
+
 class StatsTest(base.TestBase):
 
     @inlineCallbacks
@@ -42,7 +65,8 @@ class StatsTest(base.TestBase):
 
         hosts = [c1, c2]
         config.stats_resolve_hostnames = True
-        stats.fixup_crackers(hosts)
+        self.addCleanup(resolver.close)
+        yield stats.fixup_crackers(hosts)
 
         self.assertEqual(c1.hostname, "www.xs4all.nl", "Reverse DNS of www.xs4all.nl")
         self.assertEqual(c1.country, "Netherlands", "Testing geoip of www.xs4all.nl")
@@ -61,6 +85,8 @@ class StatsTest(base.TestBase):
         except OSError:
             pass
         config.stats_resolve_hostnames = False
+        self.patch(graphs, "_rendered", {})
+        self.addCleanup(graphs.close)
 
 
     @inlineCallbacks
@@ -80,6 +106,8 @@ class StatsTest(base.TestBase):
         yield Registry.DBPOOL.runInteraction(stats.fixup_history_txn)
         yesterday = datetime.date.today() - datetime.timedelta(days=1)
         yield Registry.DBPOOL.runInteraction(stats.update_country_history_txn, yesterday, include_history=True)
+        # The reports were added without updating the summary counters
+        yield summary.recount()
         yield stats.update_stats_cache()
 
     @inlineCallbacks
@@ -122,6 +150,49 @@ class StatsTest(base.TestBase):
         self.assertTrue(os.access(os.path.join(config.graph_dir, "monthly.svg"), os.R_OK), "Creation of monthly graph")
         self.assertTrue(os.access(os.path.join(config.graph_dir, "contrib.svg"), os.R_OK), "Creation of contributors graph")
 
+    @inlineCallbacks
+    def test_graphs_changed(self):
+        yield self.prepare_stats()
+        graph_data = yield Registry.DBPOOL.runInteraction(stats.fetch_graph_data_txn)
+
+        rendered = yield graphs.render_changed(graph_data)
+        self.assertEqual(rendered, [], "Unchanged graphs should not be rendered again")
+
+        cracker = yield Cracker.find(where=["ip_address=?", database.ip_param("192.168.1.1")], limit=1)
+        yield controllers.add_report_to_cracker(cracker, "127.0.0.4", when=time.time() - 2*3600)
+        graph_data = yield Registry.DBPOOL.runInteraction(stats.fetch_graph_data_txn)
+        rendered = yield graphs.render_changed(graph_data)
+        self.assertEqual(rendered, ["hourly.svg"], "Graph with new data should be rendered")
+        self.assertEqual([f for f in os.listdir(config.graph_dir) if f.endswith(".tmp")], [],
+            "No temporary files should be left behind")
+
+    @inlineCallbacks
+    def test_graph_timeout(self):
+        yield self.prepare_stats()
+        graph_data = yield Registry.DBPOOL.runInteraction(stats.fetch_graph_data_txn)
+        self.patch(graphs, "renderers", dict(graphs.renderers))
+        graphs.renderers["hourly.svg"] = hanging_renderer
+        # A worker for every graph, so the others are not queued behind it
+        config.graph_processes = len(graph_data)
+        config.graph_timeout = 1
+        graphs.close()
+        graphs._rendered.clear()
+
+        rendered = yield graphs.render_changed(graph_data)
+        self.assertFalse("hourly.svg" in rendered, "Graph that timed out should not be reported as rendered")
+        self.assertTrue("monthly.svg" in rendered, "Other graphs should still be rendered")
+        self.assertEqual(graphs._pool, None, "Worker processes should be replaced after a timeout")
+
+    @inlineCallbacks
+    def test_stats_busy_reset(self):
+        self.stats_settings()
+        def fail():
+            raise RuntimeError("history unavailable")
+        self.patch(stats, "update_recent_history", fail)
+
+        yield self.assertFailure(stats.update_stats_cache(), RuntimeError)
+        self.assertFalse(stats._stats_busy, "Failed update should not block the next ones")
+
     @inlineCallbacks
     def test_stats_render(self):
         yield self.prepare_stats()
@@ -133,4 +204,118 @@ class StatsTest(base.TestBase):
         self.assertFalse("127.0.0.1" in html, "HTML should not contain reported ip addresses")
         self.assertEqual(html.count("192.168.1.1"), 2, "HTML should contain ip address of hosts in tables")
 
+    @inlineCallbacks
+    def test_stats_page(self):
+        yield self.prepare_stats()
+        env = stats._template_env
+        yield stats.update_stats_cache()
+        self.assertIs(stats._template_env, env, "Template environment should be reused")
+
+        port = reactor.listenTCP(0, server.Site(views.WebResource()), interface="127.0.0.1")
+        self.addCleanup(port.stopListening)
+        pool = client.HTTPConnectionPool(reactor)
+        self.addCleanup(pool.closeCachedConnections)
+        agent = client.Agent(reactor, pool=pool)
+        url = "http://127.0.0.1:{}/".format(port.getHost().port)
+
+        @inlineCallbacks
+        def get(headers):
+            response = yield agent.request("GET", url, Headers(headers))
+            body = yield client.readBody(response)
+            returnValue((response, body))
+
+        response, body = yield get({"Accept-Encoding": ["gzip, deflate"]})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers.getRawHeaders("Content-Encoding"), ["gzip"],
+            "Page should be compressed")
+        html = gzip.GzipFile(fileobj=StringIO(body)).read()
+        self.assertTrue("Number of clients" in html, "Compressed page should contain the html")
+        etag = response.headers.getRawHeaders("ETag")[0]
+
+        response, body = yield get({"Accept-Encoding": ["gzip"], "If-None-Match": [etag]})
+        self.assertEqual(response.code, 304, "Unchanged page should not be sent again")
+        self.assertEqual(body, "")
+
+        response, body = yield get({})
+        self.assertEqual(response.code, 200)
+        self.assertEqual(body, html, "Uncompressed page should be sent without Accept-Encoding")
+        self.assertNotEqual(response.headers.getRawHeaders("ETag")[0], etag,
+            "Uncompressed page should have its own entity tag")
+
+    @inlineCallbacks
+    def test_daily_counters(self):
+        rng = random.Random(1)
+        now = time.time()
+        for i in range(5):
+            yield controllers.queue_reports([
+                ("127.0.0.{}".format(rng.randint(1, 8)),
+                    now - rng.randint(0, 40*3600),
+                    ["10.0.0.{}".format(rng.randint(1, 20))])
+                for j in range(20)])
+
+        def counters_txn(txn):
+            txn.execute("""SELECT date, num_reports, num_contributors, num_reported_hosts
+                FROM daily_counters""")
+            return { stats._parse_date(row[0]): tuple(row[1:]) for row in txn.fetchall() }
+
+        counters = yield Registry.DBPOOL.runInteraction(counters_txn)
+        expected = yield Registry.DBPOOL.runInteraction(stats._grouped_history_txn)
+        self.assertTrue(len(counters) >= 2, "Reports should be counted on two or three days")
+        self.assertEqual(counters, expected, "Daily counters should match the reports table")
+
+        yield Registry.DBPOOL.runInteraction(stats.rebuild_daily_counters_txn)
+        rebuilt = yield Registry.DBPOOL.runInteraction(counters_txn)
+        self.assertEqual(rebuilt, counters, "Rebuilt counters should match the incremental ones")
+
+        # Counting continues after the rebuild
+        yield controllers.queue_reports([("127.0.0.100", now, ["10.0.0.1", "10.0.0.100"])])
+        counters = yield Registry.DBPOOL.runInteraction(counters_txn)
+        expected = yield Registry.DBPOOL.runInteraction(stats._grouped_history_txn)
+        self.assertEqual(counters, expected, "Daily counters should match the reports table")
+
+        yesterday = datetime.date.fromtimestamp(now) - datetime.timedelta(days=1)
+        yield Registry.DBPOOL.runInteraction(stats.update_history_txn, yesterday)
+        rows = yield Registry.DBPOOL.runQuery(
+            "SELECT num_reports, num_contributors, num_reported_hosts FROM history")
+        self.assertEqual([tuple(row) for row in rows], [counters[yesterday]],
+            "History should be filled from the daily counters")
+
+    @inlineCallbacks
+    def test_country_history(self):
+        self.patch(geo, "_gi", FakeGeoIP())
+        self.patch(geo, "_cache", cache.LRUCache(100))
+
+        today = datetime.datetime.utcnow().date()
+        yesterday = today - datetime.timedelta(days=1)
+        def noon(date):
+            return (date - datetime.date(1970, 1, 1)).total_seconds() + 12*3600
+
+        yield controllers.queue_reports([
+            ("127.0.0.1", noon(yesterday - datetime.timedelta(days=2)), ["10.0.0.1", "192.168.1.1"]),
+            ("127.0.0.2", noon(yesterday), ["10.0.0.1", "10.0.0.2"]),
+        ])
+        rows = yield Registry.DBPOOL.runQuery("SELECT ip_address, country_code FROM crackers")
+        self.assertEqual({ database.ip_value(ip): code for (ip, code) in rows }, {"10.0.0.1": "NL", "10.0.0.2": "NL", "192.168.1.1": "ZZ"},
+            "Country of crackers should be stored")
+
+        def totals():
+            return Registry.DBPOOL.runQuery(
+                "SELECT country_code, country, num_reports FROM country_history")
+
+        yield stats.update_country_history(yesterday, include_history=True)
+        expected = set([("NL", "Netherlands", 3), ("ZZ", "(Unknown)", 1)])
+        rows = yield totals()
+        self.assertEqual(set(tuple(row) for row in rows), expected, "All reports should be counted")
+
+        yield stats.update_country_history(yesterday)
+        rows = yield totals()
+        self.assertEqual(set(tuple(row) for row in rows), expected, "Reports should be counted only once")
+
+        yield controllers.queue_reports([("127.0.0.3", noon(today), ["10.0.0.3", "172.16.0.1"])])
+        yield stats.update_country_history(today)
+        rows = yield totals()
+        self.assertEqual(set(tuple(row) for row in rows),
+            set([("NL", "Netherlands", 4), ("ZZ", "(Unknown)", 2)]),
+            "Reports of the new day should be added")
+
 # vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
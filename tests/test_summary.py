@@ -0,0 +1,74 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import time
+
+from denyhosts_server import controllers
+from denyhosts_server import database
+from denyhosts_server import summary
+
+from twisted.internet.defer import inlineCallbacks
+from twistar.registry import Registry
+
+import base
+
+class SummaryTest(base.TestBase):
+
+    @inlineCallbacks
+    def assert_counters_correct(self, message):
+        drift = yield summary.recount()
+        self.assertEqual(drift, {}, message)
+
+    @inlineCallbacks
+    def test_counters(self):
+        rng = random.Random(1)
+        now = time.time()
+        for i in range(5):
+            yield controllers.queue_reports([
+                ("127.0.0.{}".format(rng.randint(1, 8)),
+                    now - rng.randint(0, 60*24*3600),
+                    ["10.0.0.{}".format(rng.randint(1, 30))])
+                for j in range(30)])
+        yield self.assert_counters_correct("Counters should be updated by new reports")
+
+        counters = yield Registry.DBPOOL.runInteraction(summary.get_counters_txn)
+        self.assertTrue(counters["num_reports"] > 0 and counters["num_clients"] == 8,
+            "Reports and clients should be counted")
+
+        yield controllers.perform_maintenance(limit=now - 30*24*3600)
+        yield self.assert_counters_correct("Counters should be updated by maintenance")
+
+        yield controllers.purge_ip("10.0.0.1")
+        yield self.assert_counters_correct("Counters should be updated by purging an address")
+
+        yield controllers.purge_reported_addresses()
+        counters = yield Registry.DBPOOL.runInteraction(summary.get_counters_txn)
+        self.assertEqual(counters, {"num_hosts": 0, "num_reports": 0, "num_clients": 0},
+            "Counters should be reset by purging all addresses")
+
+    @inlineCallbacks
+    def test_drift(self):
+        yield controllers.queue_reports([("127.0.0.1", time.time(), ["10.0.0.1", "10.0.0.2"])])
+        yield database.run_operation("UPDATE counters SET `value`=`value`+3 WHERE name=?", "num_reports")
+
+        drift = yield summary.recount()
+        self.assertEqual(drift, {"num_reports": -3}, "Drift should be reported")
+        counters = yield Registry.DBPOOL.runInteraction(summary.get_counters_txn)
+        self.assertEqual(counters, {"num_hosts": 2, "num_reports": 2, "num_clients": 1},
+            "Counters should be corrected")
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4
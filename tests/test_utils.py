@@ -0,0 +1,152 @@
+# denyhosts sync server
+# Copyright (C) 2017 Jan-Pascal van Best <janpascal@vanbest.org>
+
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published
+# by the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import random
+import xmlrpclib
+
+from denyhosts_server import utils
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial import unittest
+from twisted.web import server, xmlrpc
+
+class HostLockTest(unittest.TestCase):
+
+    def test_lock_fifo(self):
+        order = []
+        d1 = utils.wait_and_lock_host("1.1.1.1")
+        self.assertTrue(d1.called, "Uncontended lock should be acquired immediately")
+        self.assertFalse(utils.none_waiting(), "Host should be locked")
+
+        d2 = utils.wait_and_lock_host("1.1.1.1")
+        d3 = utils.wait_and_lock_host("1.1.1.1")
+        d2.addCallback(lambda _: order.append(2))
+        d3.addCallback(lambda _: order.append(3))
+        self.assertFalse(d2.called or d3.called, "Waiters should not get the lock yet")
+
+        # Other hosts are not affected
+        d4 = utils.wait_and_lock_host("2.2.2.2")
+        self.assertTrue(d4.called, "Lock on other host should be acquired immediately")
+        self.assertEqual(utils.count_waiting(), 2, "Two hosts should be locked")
+        self.assertEqual(utils.get_lock_stats()["waiters"], 2, "Two callers should be waiting")
+
+        utils.unlock_host("1.1.1.1")
+        self.assertEqual(order, [2], "First waiter should get the lock on unlock")
+        utils.unlock_host("1.1.1.1")
+        self.assertEqual(order, [2, 3], "Second waiter should get the lock next")
+        utils.unlock_host("1.1.1.1")
+        utils.unlock_host("2.2.2.2")
+        self.assertTrue(utils.none_waiting(), "All hosts should be unlocked")
+
+    def test_lock_stats(self):
+        before = utils.get_lock_stats()
+        utils.wait_and_lock_host("1.1.1.1")
+        utils.wait_and_lock_host("1.1.1.1")
+        utils.unlock_host("1.1.1.1")
+        utils.unlock_host("1.1.1.1")
+        after = utils.get_lock_stats()
+
+        self.assertEqual(after["acquisitions"] - before["acquisitions"], 2, "Acquisitions counted")
+        self.assertEqual(after["contentions"] - before["contentions"], 1, "Contention counted")
+        self.assertEqual(sum(after["wait_counts"]) - sum(before["wait_counts"]), 2,
+            "Every acquisition should be in the wait time histogram")
+
+class Echo(xmlrpc.XMLRPC):
+
+    def xmlrpc_echo(self, *args):
+        return args
+
+    def xmlrpc_fail(self):
+        raise xmlrpc.Fault(123, "Failed")
+
+class XmlrpcCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.site = server.Site(Echo())
+        self.connections = 0
+        build_protocol = self.site.buildProtocol
+        def count_connections(addr):
+            self.connections += 1
+            return build_protocol(addr)
+        self.site.buildProtocol = count_connections
+        self.port = reactor.listenTCP(0, self.site, interface="127.0.0.1")
+        self.url = "http://127.0.0.1:{}/RPC2".format(self.port.getHost().port)
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield utils.close_http_connections()
+        yield self.port.stopListening()
+
+    @inlineCallbacks
+    def test_xmlrpc_call(self):
+        result = yield utils.xmlrpc_call(self.url, "echo", 1, "two", [3])
+        self.assertEqual(result, [1, "two", [3]], "Result should be returned")
+        yield utils.xmlrpc_call(self.url, "echo")
+        self.assertEqual(self.connections, 1, "Connection should be reused")
+
+        yield self.assertFailure(utils.xmlrpc_call(self.url, "fail"), xmlrpclib.Fault)
+
+class IPAddressTest(unittest.TestCase):
+
+    def test_pack_ip(self):
+        self.assertEqual(len(utils.pack_ip("192.0.2.1")), 16, "IPv4 addresses should be mapped to IPv6")
+        self.assertEqual(utils.pack_ip("192.0.2.1"), utils.pack_ip("::ffff:192.0.2.1"))
+        self.assertEqual(utils.unpack_ip(utils.pack_ip("192.0.2.1")), "192.0.2.1")
+        self.assertEqual(utils.normalize_ip("2001:DB8:0::1"), "2001:db8::1")
+        self.assertTrue(utils.pack_ip("192.0.2.1") < utils.pack_ip("192.0.2.10") <
+            utils.pack_ip("192.0.3.0"), "Binary addresses should sort numerically")
+        for invalid in ["", "192.0.2", "192.0.2.256", "not an address", "2001:db8::1::2", None]:
+            self.assertRaises(ValueError, utils.pack_ip, invalid)
+
+    def random_address(self, rng):
+        kind = rng.randint(0, 5)
+        if kind == 0:
+            # Near the boundaries of the invalid ranges
+            n = rng.choice(utils._ipv4_invalid_starts + utils._ipv4_invalid_ends)
+            n = (n + rng.randint(-2, 2)) % (1 << 32)
+            return "{}.{}.{}.{}".format(n >> 24, (n >> 16) & 255, (n >> 8) & 255, n & 255)
+        if kind == 1:
+            return ".".join(rng.choice(["0", "00", "01", "1", "9", "10", "127", "255", "256",
+                "999", "", " 1", "1 ", "+1", "-1", "0x1", "1e2"])
+                for i in range(rng.choice([3, 4, 4, 4, 5])))
+        if kind == 2:
+            return "".join(rng.choice("0123456789.:abcdef x\0\n") for i in range(rng.randint(0, 20)))
+        if kind == 3:
+            return rng.choice(["::1", "::", "fe80::1", "ff02::1", "2001:db8::1", "2a00:1450::1",
+                "::ffff:8.8.8.8", "fc00::1", "1:2:3:4:5:6:7:8", "1::2::3", u"8.8.8.8",
+                u"8.8.8.\u0668", None, 134744072, "8.8.8.8/32"])
+        return ".".join(str(rng.randint(0, 255)) for i in range(4))
+
+    def test_is_valid_ip_address(self):
+        for valid in ["8.8.8.8", "1.0.0.0", "223.255.255.255", "172.32.0.1", "2a00:1450::1"]:
+            self.assertTrue(utils.is_valid_ip_address(valid), valid)
+        for invalid in ["0.0.0.0", "10.1.2.3", "127.0.0.1", "169.254.1.1", "172.31.255.255",
+                "192.168.0.1", "224.0.0.1", "255.255.255.255", "01.2.3.4", "1.2.3", "::1",
+                "not an address", ""]:
+            self.assertFalse(utils.is_valid_ip_address(invalid), invalid)
+
+        # Same decisions as ipaddr on a random corpus
+        rng = random.Random(1)
+        corpus = [self.random_address(rng) for i in range(20000)]
+        expected = [utils._is_valid_ipaddr(ip) for ip in corpus]
+        self.assertEqual([utils.is_valid_ip_address(ip) for ip in corpus], expected)
+        self.assertTrue(0 < sum(expected) < len(corpus), "Corpus should have valid and invalid addresses")
+        valid, invalid = utils.split_valid_ip_addresses(corpus)
+        self.assertEqual(valid, [ip for ip, ok in zip(corpus, expected) if ok])
+        self.assertEqual(invalid, [ip for ip, ok in zip(corpus, expected) if not ok])
+
+# vim: tabstop=8 expandtab shiftwidth=4 softtabstop=4